@@ -0,0 +1,303 @@
+"""
+In-process cache of per-player state keyed by telegram_id.
+
+Caches the rows the hot endpoints re-read on every request: the players row,
+owned businesses, character slots, inventory, talents, upgrades and the income
+profile and unlocked achievements. The cache never has to be told about a mutation by hand —
+PooledConnection reports every write statement to a CacheTransaction, and when
+the unit of work commits:
+
+  * rows the transaction re-read after its last write are published
+    (write-through — the value is exactly what was committed);
+  * everything else it wrote is evicted (per table) and reloaded on the next
+    read; a write with no telegram_id key evicts that table for every player.
+
+_analyze_write only attributes a write to one player for a few strict
+statement shapes (see the comment above it); anything else on a cached table
+falls back to the table-wide eviction. PooledConnection refuses the aiosqlite
+methods (cursor(), executescript(), ...) that would write around it.
+tests/test_cache.py checks every write statement in main.py and bot.py
+against the expected (table, parameter index).
+
+Reads inside a transaction that already wrote a player's rows go to SQLite so
+the handler sees its own uncommitted changes. Fills racing a commit are dropped
+by comparing the read's start stamp with the player's last invalidation.
+
+Writes made by other processes (bot.py payments) are picked up through the
+cache_invalidations outbox, polled by backend.database.
+"""
+
+import os
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "10000"))
+
+CACHED_TABLES = (
+    "players", "player_businesses", "player_character",
+    "player_inventory", "player_talents", "player_upgrades",
+    "player_income_profile", "player_achievements",
+)
+
+_WRITE_RE = re.compile(
+    r"^\s*(INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(\w+)",
+    re.IGNORECASE,
+)
+
+# The only statement shapes whose telegram_id parameter is located; any other
+# write on a cached table flushes that table for every player.
+#   INSERT [OR x] INTO t (col, ...) VALUES (?|literal, ...) [ON CONFLICT(... telegram_id ...) DO ...] [RETURNING ...]
+#   UPDATE [OR x] t SET ... WHERE <conds> [RETURNING ...]
+#   DELETE FROM t WHERE <conds> [RETURNING ...]
+# where <conds> is `col op ?|literal|col` joined by AND, exactly one of them
+# `telegram_id = ?`, with no OR, parentheses or subqueries anywhere in the WHERE.
+_LITERAL = r"(?:\?|NULL|-?\d+(?:\.\d+)?|'[^'()]*')"
+_STRICT_INSERT_RE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?|REPLACE)\s+INTO\s+\w+\s*"
+    r"\(\s*(?P<columns>\w+(?:\s*,\s*\w+)*)\s*\)\s*"
+    rf"VALUES\s*\(\s*(?P<values>{_LITERAL}(?:\s*,\s*{_LITERAL})*)\s*\)"
+    r"(?:\s+ON\s+CONFLICT\s*\((?P<target>[\w\s,]*)\)\s+DO\s+(?P<action>.*?))?"
+    r"(?:\s+RETURNING\s+[\w\s,*]+)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_STRICT_UPDATE_RE = re.compile(
+    r"^\s*UPDATE(?:\s+OR\s+\w+)?\s+\w+\s+SET\s+(?P<set>.*?)\s+WHERE\s+(?P<where>.*?)"
+    r"(?:\s+RETURNING\s+[\w\s,*]+)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_STRICT_DELETE_RE = re.compile(
+    r"^\s*DELETE\s+FROM\s+\w+\s+WHERE\s+(?P<where>.*?)(?:\s+RETURNING\s+[\w\s,*]+)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_CONDITION_RE = re.compile(rf"^(\w+)\s*(?:==?|!=|<>|<=|>=|<|>)\s*(?:{_LITERAL}|\w+)$", re.IGNORECASE)
+_TID_CONDITION_RE = re.compile(r"^telegram_id\s*==?\s*\?$", re.IGNORECASE)
+_AND_RE = re.compile(r"\s+AND\s+", re.IGNORECASE)
+_SELECT_RE = re.compile(r"\bSELECT\b", re.IGNORECASE)
+_ASSIGNS_TID_RE = re.compile(r"(?:^|,)\s*telegram_id\s*=", re.IGNORECASE)
+
+
+def _where_tid_index(sql, where_start, where):
+    """Index of the telegram_id parameter in a strict WHERE clause, else None."""
+    if "(" in where or ")" in where or re.search(r"\bOR\b", where, re.IGNORECASE):
+        return None
+    conditions = _AND_RE.split(where.strip())
+    if not all(_CONDITION_RE.match(c) for c in conditions):
+        return None
+    tid = [i for i, c in enumerate(conditions) if _TID_CONDITION_RE.match(c)]
+    if len(tid) != 1 or sum(1 for c in conditions if c.lower().startswith("telegram_id")) != 1:
+        return None
+    before = sql[:where_start] + " ".join(conditions[:tid[0]])
+    return before.count("?")
+
+
+@lru_cache(maxsize=512)
+def _analyze_write(sql):
+    """(table, index of the telegram_id parameter or None) for a write on a cached table."""
+    m = _WRITE_RE.match(sql)
+    if not m or m.group(2) not in CACHED_TABLES:
+        return None
+    table = m.group(2)
+    verb = m.group(1).upper()
+    if verb.endswith("INTO"):
+        ins = _STRICT_INSERT_RE.match(sql)
+        if not ins or _SELECT_RE.search(sql):
+            return table, None
+        if ins.group("target") is not None:
+            # An upsert may only update the row it tried to insert
+            target = [c.strip().lower() for c in ins.group("target").split(",")]
+            if "telegram_id" not in target or _ASSIGNS_TID_RE.search(re.sub(r"^UPDATE\s+SET\s+", "", ins.group("action"), flags=re.I)):
+                return table, None
+        columns = [c.strip().lower() for c in ins.group("columns").split(",")]
+        values = [v.strip() for v in ins.group("values").split(",")]
+        if columns.count("telegram_id") != 1 or len(columns) != len(values):
+            return table, None
+        pos = columns.index("telegram_id")
+        if values[pos] != "?":
+            return table, None
+        return table, sql[:ins.start("values")].count("?") + sum(1 for v in values[:pos] if v == "?")
+    if _SELECT_RE.search(sql) or len(re.findall(r"\bWHERE\b", sql, re.IGNORECASE)) != 1:
+        return table, None
+    if verb.startswith("UPDATE"):
+        upd = _STRICT_UPDATE_RE.match(sql)
+        if not upd or _ASSIGNS_TID_RE.search(upd.group("set")):
+            return table, None
+        return table, _where_tid_index(sql, upd.start("where"), upd.group("where"))
+    dele = _STRICT_DELETE_RE.match(sql)
+    if not dele:
+        return table, None
+    return table, _where_tid_index(sql, dele.start("where"), dele.group("where"))
+
+
+def _clone(value):
+    if isinstance(value, list):
+        return [dict(r) for r in value]
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+class CacheTransaction:
+    """Per-connection record of which cached rows the open transaction wrote and re-read."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._seq = 0
+        self.writes: dict[tuple[int, str], int] = {}
+        self.reads: dict[tuple[int, str], tuple[int, object]] = {}
+        self.flushed: set[str] = set()
+
+    def record_write(self, sql, parameters):
+        info = _analyze_write(sql)
+        if info is None:
+            return
+        table, index = info
+        self._seq += 1
+        try:
+            tid = int(parameters[index])
+        except (TypeError, IndexError, KeyError, ValueError):
+            # Multi-row or unkeyed write — invalidate the whole table on commit
+            self.flushed.add(table)
+            return
+        self.writes[(tid, table)] = self._seq
+
+    def wrote(self, tid, table):
+        return table in self.flushed or (tid, table) in self.writes
+
+    def remember(self, tid, table, value):
+        self.reads[(tid, table)] = (self._seq, value)
+
+    @property
+    def dirty(self):
+        return bool(self.writes or self.flushed)
+
+
+class PlayerCache:
+    """Bounded LRU of {telegram_id: {table: value}} with per-player invalidation stamps."""
+
+    def __init__(self, max_players=PLAYER_CACHE_SIZE):
+        self.max_players = max(1, max_players)
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        # telegram_id -> clock value of its last invalidation, oldest first.
+        # Pruned entries fold into _floor so stale fills stay rejected.
+        self._stamps: OrderedDict[int, int] = OrderedDict()
+        self._floor = 0
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self._listeners = []
+
+    def add_listener(self, fn):
+        """Call fn(telegram_id) after a player's rows change; fn(None) after a table-wide flush."""
+        self._listeners.append(fn)
+
+    def _notify(self, tid):
+        for fn in self._listeners:
+            fn(tid)
+
+    # ── Lookup ──
+
+    def peek(self, tid, table):
+        """Cached value without touching SQLite; None when not cached."""
+        entry = self._entries.get(tid)
+        if entry is None or table not in entry:
+            return None
+        self._entries.move_to_end(tid)
+        self.hits += 1
+        return _clone(entry[table])
+
+    async def read(self, db, tid, table, loader):
+        """Return loader(db, tid) through the cache (always a private copy)."""
+        tx = getattr(db, "cache_tx", None)
+        if tx is not None and tx.wrote(tid, table):
+            value = await loader(db, tid)
+            tx.remember(tid, table, value)
+            return _clone(value)
+        entry = self._entries.get(tid)
+        if entry is not None and table in entry:
+            self._entries.move_to_end(tid)
+            self.hits += 1
+            return _clone(entry[table])
+        self.misses += 1
+        token = self._clock
+        value = await loader(db, tid)
+        if tx is not None and tx.wrote(tid, table):
+            # The loader itself wrote the row (e.g. rebuilt a derived row) —
+            # publish it with the transaction instead of before commit
+            tx.remember(tid, table, value)
+        elif self._stamps.get(tid, self._floor) <= token:
+            self._store(tid, table, value)
+        return _clone(value)
+
+    # ── Mutation ──
+
+    def _store(self, tid, table, value):
+        entry = self._entries.get(tid)
+        if entry is None:
+            entry = self._entries[tid] = {}
+        else:
+            self._entries.move_to_end(tid)
+        entry[table] = _clone(value)
+        while len(self._entries) > self.max_players:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tid, tables=None):
+        """Drop a player's cached rows (only `tables` if given)."""
+        self._clock += 1
+        if tables is None:
+            self._entries.pop(tid, None)
+        else:
+            entry = self._entries.get(tid)
+            if entry is not None:
+                for table in tables:
+                    entry.pop(table, None)
+        self._stamps.pop(tid, None)
+        self._stamps[tid] = self._clock
+        while len(self._stamps) > 4 * self.max_players:
+            _, stamp = self._stamps.popitem(last=False)
+            self._floor = max(self._floor, stamp)
+        self._notify(tid)
+
+    def clear(self, tables=None):
+        """Drop `tables` (default: everything) for every player."""
+        self._clock += 1
+        if tables is None:
+            self._entries.clear()
+        else:
+            for entry in self._entries.values():
+                for table in tables:
+                    entry.pop(table, None)
+        self._stamps.clear()
+        self._floor = self._clock
+        self._notify(None)
+
+    def apply(self, tx, committed=True):
+        """Fold a finished transaction into the cache and reset it."""
+        if tx.flushed:
+            self.clear(tx.flushed)
+        written: dict[int, set] = {}
+        for tid, table in tx.writes:
+            written.setdefault(tid, set()).add(table)
+        for tid, tables in written.items():
+            self.invalidate(tid, tables)
+        if committed:
+            for (tid, table), (seq, value) in tx.reads.items():
+                if table in tx.flushed:
+                    continue
+                if seq >= tx.writes.get((tid, table), 0):
+                    self._store(tid, table, value)
+        tx.reset()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "players": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+player_cache = PlayerCache()
@@ -1,436 +1,954 @@
 import aiosqlite
+import asyncio
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from backend.cache import CacheTransaction, player_cache
 
 _data_dir = os.getenv("DATA_DIR", os.path.join(os.path.dirname(__file__), ".."))
 DB_PATH = os.path.join(_data_dir, "game.db")
 
+logger = logging.getLogger(__name__)
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "1"))
+
+
+_WRITE_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+# aiosqlite entry points that would reach SQLite without going through cache_tx
+# (executescript would also commit the open transaction)
+_UNTRACKED_METHODS = frozenset(("cursor", "execute_insert", "execute_fetchall", "executescript"))
+
+# Request-scoped async hook(db), awaited by transaction() just before it commits a
+# transaction that wrote (backend.idempotency records its key this way)
+before_commit: ContextVar = ContextVar("before_commit", default=None)
+
+
+class PooledConnection:
+    """Checked-out pool connection. close() hands it back to the pool instead of closing it.
+
+    SQLite admits one writer at a time; rather than letting pooled connections
+    spin in SQLite's busy handler, the first write of a transaction queues on the
+    pool's writer lock and holds it until commit/rollback.
+
+    Every write is also reported to cache_tx so the player cache is updated
+    when the transaction commits (see backend.cache). on_commit() queues side
+    effects (pushes, notifications) that must only happen once the data is durable.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._writing = False
+        self.cache_tx = CacheTransaction()
+        self._after_commit = []
+        self.last_used = time.monotonic()
+
+    def __getattr__(self, name):
+        if name in _UNTRACKED_METHODS:
+            raise AttributeError(f"{name}() bypasses the player cache; use execute()/executemany()")
+        return getattr(self._conn, name)
+
+    async def _before(self, sql):
+        if not self._writing and sql.lstrip()[:7].upper().startswith(_WRITE_VERBS):
+            await self._pool.writer.acquire()
+            self._writing = True
+
+    def _done_writing(self):
+        if self._writing:
+            self._writing = False
+            self._pool.writer.release()
+
+    async def execute(self, sql, parameters=None):
+        await self._before(sql)
+        if self._writing:
+            self.cache_tx.record_write(sql, parameters)
+        return await self._conn.execute(sql, parameters)
+
+    async def executemany(self, sql, parameters):
+        await self._before(sql)
+        if self._writing:
+            parameters = list(parameters)
+            for params in parameters:
+                self.cache_tx.record_write(sql, params)
+        return await self._conn.executemany(sql, parameters)
+
+    def on_commit(self, callback):
+        """Run callback() after the current transaction commits; dropped on rollback."""
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        committed = False
+        try:
+            await self._conn.commit()
+            committed = True
+        finally:
+            player_cache.apply(self.cache_tx, committed)
+            self._done_writing()
+            callbacks, self._after_commit = self._after_commit, []
+        if committed:
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("on_commit callback failed")
+
+    async def rollback(self):
+        try:
+            await self._conn.rollback()
+        finally:
+            self.cache_tx.reset()
+            self._after_commit = []
+            self._done_writing()
+
+    async def close(self):
+        await self._pool.release(self)
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived aiosqlite connections (each one is a worker thread)."""
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE):
+        self.path = path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._idle: list[PooledConnection] = []
+        self._slots = asyncio.Semaphore(self.size)
+        self.writer = asyncio.Lock()
+        self._closed = False
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA foreign_keys=ON")
+        return PooledConnection(self, conn)
+
+    async def _is_healthy(self, pc):
+        try:
+            await pc._conn.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        try:
+            while self._idle:
+                pc = self._idle.pop()  # LIFO: reuse the warmest connection
+                if time.monotonic() - pc.last_used < self.healthcheck_idle or await self._is_healthy(pc):
+                    return pc
+                await self._discard(pc)
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, pc):
+        try:
+            if self._closed:
+                await self._discard(pc)
+                return
+            # Anything left uncommitted (e.g. an HTTPException mid-handler) is dropped,
+            # exactly as closing a dedicated connection used to do.
+            if pc._conn.in_transaction:
+                await pc.rollback()
+            if pc.cache_tx.dirty:
+                player_cache.apply(pc.cache_tx, committed=False)
+            pc._after_commit = []
+            pc._done_writing()
+            pc.last_used = time.monotonic()
+            self._idle.append(pc)
+        except Exception:
+            pc._done_writing()
+            await self._discard(pc)
+        finally:
+            self._slots.release()
+
+    async def _discard(self, pc):
+        try:
+            await pc._conn.close()
+        except Exception:
+            pass
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for pc in idle:
+            await self._discard(pc)
+
+
+_pool: ConnectionPool | None = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(DB_PATH)
+    return _pool
+
 
 async def get_db():
-    db = await aiosqlite.connect(DB_PATH)
-    db.row_factory = aiosqlite.Row
-    await db.execute("PRAGMA journal_mode=WAL")
-    await db.execute("PRAGMA foreign_keys=ON")
-    return db
+    """Check out a pooled connection; callers still release it with `await db.close()`."""
+    return await get_pool().acquire()
 
 
-async def init_db():
+@asynccontextmanager
+async def transaction():
+    """Request-scoped unit of work.
+
+    Helpers receive the yielded connection and never commit themselves: the
+    block commits exactly once when it exits normally and rolls everything
+    back if it raises (HTTPException included).
+    """
     db = await get_db()
-    await db.executescript("""
-    CREATE TABLE IF NOT EXISTS players (
-        telegram_id INTEGER PRIMARY KEY,
-        username TEXT DEFAULT '',
-        cash REAL DEFAULT 1000.0,
-        reputation_fear INTEGER DEFAULT 0,
-        reputation_respect INTEGER DEFAULT 0,
-        suspicion REAL DEFAULT 0.0,
-        last_collect_ts REAL DEFAULT 0.0,
-        robbery_cooldown_ts REAL DEFAULT 0.0,
-        total_earned REAL DEFAULT 0.0,
-        total_taps INTEGER DEFAULT 0,
-        total_robberies INTEGER DEFAULT 0,
-        gang_id INTEGER DEFAULT 0,
-        referral_code TEXT DEFAULT '',
-        referred_by INTEGER DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS player_businesses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        business_id TEXT NOT NULL,
-        level INTEGER DEFAULT 1,
-        has_manager INTEGER DEFAULT 0,
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
-        UNIQUE(telegram_id, business_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS robbery_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        target TEXT NOT NULL,
-        success INTEGER DEFAULT 0,
-        reward REAL DEFAULT 0.0,
-        suspicion_gain REAL DEFAULT 0.0,
-        created_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS player_character (
-        telegram_id INTEGER PRIMARY KEY,
-        nickname TEXT DEFAULT 'Новичок',
-        avatar TEXT DEFAULT 'default',
-        hat TEXT DEFAULT 'none',
-        jacket TEXT DEFAULT 'none',
-        accessory TEXT DEFAULT 'none',
-        weapon TEXT DEFAULT 'none',
-        car TEXT DEFAULT 'none',
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS player_inventory (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        item_id TEXT NOT NULL,
-        equipped INTEGER DEFAULT 0,
-        purchased_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
-        UNIQUE(telegram_id, item_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS player_cases (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        case_id TEXT NOT NULL,
-        purchased_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS gangs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        tag TEXT NOT NULL,
-        leader_id INTEGER NOT NULL,
-        cash_bank REAL DEFAULT 0.0,
-        power INTEGER DEFAULT 0,
-        territory INTEGER DEFAULT 0,
-        last_territory_attack_ts REAL DEFAULT 0.0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS gang_members (
-        telegram_id INTEGER PRIMARY KEY,
-        gang_id INTEGER NOT NULL,
-        role TEXT DEFAULT 'member',
-        joined_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (gang_id) REFERENCES gangs(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS gang_upgrades (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        gang_id INTEGER NOT NULL,
-        upgrade_id TEXT NOT NULL,
-        level INTEGER DEFAULT 1,
-        UNIQUE(gang_id, upgrade_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS gang_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        gang_id INTEGER NOT NULL,
-        message TEXT NOT NULL,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS pvp_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        attacker_id INTEGER NOT NULL,
-        defender_id INTEGER NOT NULL,
-        winner_id INTEGER NOT NULL,
-        cash_stolen REAL DEFAULT 0.0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS casino_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        game TEXT NOT NULL,
-        bet REAL DEFAULT 0.0,
-        result TEXT DEFAULT '',
-        payout REAL DEFAULT 0.0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS daily_missions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        mission_id TEXT NOT NULL,
-        progress INTEGER DEFAULT 0,
-        target INTEGER DEFAULT 1,
-        reward REAL DEFAULT 0.0,
-        completed INTEGER DEFAULT 0,
-        claimed INTEGER DEFAULT 0,
-        day TEXT NOT NULL,
-        UNIQUE(telegram_id, mission_id, day)
-    );
-
-    CREATE TABLE IF NOT EXISTS player_upgrades (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        upgrade_id TEXT NOT NULL,
-        level INTEGER DEFAULT 1,
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
-        UNIQUE(telegram_id, upgrade_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS referrals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        referrer_id INTEGER NOT NULL,
-        referred_id INTEGER NOT NULL,
-        bonus_claimed INTEGER DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now')),
-        UNIQUE(referred_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS daily_login (
-        telegram_id INTEGER PRIMARY KEY,
-        streak INTEGER DEFAULT 0,
-        last_claim_date TEXT DEFAULT ''
-    );
-
-    CREATE TABLE IF NOT EXISTS territories (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        emoji TEXT DEFAULT '',
-        bonus_percent REAL DEFAULT 0.0,
-        owner_gang_id INTEGER DEFAULT 0,
-        captured_at REAL DEFAULT 0.0
-    );
-
-    CREATE TABLE IF NOT EXISTS territory_wars_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        territory_id INTEGER NOT NULL,
-        attacker_gang_id INTEGER NOT NULL,
-        defender_gang_id INTEGER DEFAULT 0,
-        winner_gang_id INTEGER NOT NULL,
-        attacker_power REAL DEFAULT 0,
-        defender_power REAL DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS player_achievements (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        achievement_id TEXT NOT NULL,
-        unlocked_at REAL DEFAULT (strftime('%s','now')),
-        claimed INTEGER DEFAULT 0,
-        UNIQUE(telegram_id, achievement_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS premium_transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        package_id TEXT NOT NULL,
-        payment_method TEXT NOT NULL,
-        amount TEXT DEFAULT '',
-        status TEXT DEFAULT 'completed',
-        created_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS player_skins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        skin_id TEXT NOT NULL,
-        purchased_at REAL DEFAULT (strftime('%s','now')),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS business_equipped_skins (
-        telegram_id INTEGER NOT NULL,
-        business_id TEXT NOT NULL,
-        skin_id TEXT NOT NULL,
-        PRIMARY KEY (telegram_id, business_id),
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS tournament_scores (
-        telegram_id INTEGER NOT NULL,
-        day TEXT NOT NULL,
-        score INTEGER DEFAULT 0,
-        UNIQUE(telegram_id, day)
-    );
-
-    CREATE TABLE IF NOT EXISTS tournament_prizes_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        day TEXT NOT NULL,
-        place INTEGER DEFAULT 0,
-        cash_prize REAL DEFAULT 0,
-        cases_prize INTEGER DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS player_event_progress (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        event_id TEXT NOT NULL,
-        progress INTEGER DEFAULT 0,
-        rewards_claimed TEXT DEFAULT '',
-        UNIQUE(telegram_id, event_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS active_bosses (
-        gang_id INTEGER UNIQUE,
-        boss_id TEXT NOT NULL,
-        current_health REAL NOT NULL,
-        max_health REAL NOT NULL,
-        defeated INTEGER DEFAULT 0,
-        boss_index INTEGER DEFAULT 0,
-        spawned_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS boss_attack_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        gang_id INTEGER NOT NULL,
-        telegram_id INTEGER NOT NULL,
-        damage REAL DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS boss_rewards_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        gang_id INTEGER NOT NULL,
-        boss_id TEXT NOT NULL,
-        telegram_id INTEGER NOT NULL,
-        cash_reward REAL DEFAULT 0,
-        created_at REAL DEFAULT (strftime('%s','now'))
-    );
-
-    CREATE TABLE IF NOT EXISTS player_talents (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER NOT NULL,
-        talent_id TEXT NOT NULL,
-        level INTEGER DEFAULT 1,
-        FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
-        UNIQUE(telegram_id, talent_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS bounties (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        poster_id INTEGER NOT NULL,
-        target_id INTEGER NOT NULL,
-        reward REAL NOT NULL,
-        status TEXT DEFAULT 'active',
-        claimed_by INTEGER DEFAULT NULL,
-        created_at REAL DEFAULT (strftime('%s','now')),
-        completed_at REAL DEFAULT 0,
-        FOREIGN KEY (poster_id) REFERENCES players(telegram_id),
-        FOREIGN KEY (target_id) REFERENCES players(telegram_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS gang_wars (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        attacker_gang_id INTEGER NOT NULL,
-        defender_gang_id INTEGER NOT NULL,
-        attacker_score INTEGER DEFAULT 0,
-        defender_score INTEGER DEFAULT 0,
-        status TEXT DEFAULT 'active',
-        started_at REAL DEFAULT (strftime('%s','now')),
-        ended_at REAL DEFAULT 0,
-        winner_gang_id INTEGER DEFAULT 0
-    );
-
-    CREATE TABLE IF NOT EXISTS player_season_pass (
-        telegram_id INTEGER PRIMARY KEY,
-        season_id TEXT NOT NULL,
-        xp INTEGER DEFAULT 0,
-        is_premium INTEGER DEFAULT 0,
-        free_claimed TEXT DEFAULT '',
-        premium_claimed TEXT DEFAULT '',
-        purchased_at REAL DEFAULT 0
-    );
-    """)
-
-    # ── Migrations (safe ALTER TABLE) ──
-    migrations = [
-        ("players", "prestige_level", "ALTER TABLE players ADD COLUMN prestige_level INTEGER DEFAULT 0"),
-        ("players", "prestige_multiplier", "ALTER TABLE players ADD COLUMN prestige_multiplier REAL DEFAULT 1.0"),
-        ("players", "pvp_wins", "ALTER TABLE players ADD COLUMN pvp_wins INTEGER DEFAULT 0"),
-        ("gangs", "last_territory_attack_ts", "ALTER TABLE gangs ADD COLUMN last_territory_attack_ts REAL DEFAULT 0"),
-        ("players", "is_vip", "ALTER TABLE players ADD COLUMN is_vip INTEGER DEFAULT 0"),
-        ("players", "vip_until", "ALTER TABLE players ADD COLUMN vip_until REAL DEFAULT 0"),
-        ("players", "last_ad_ts", "ALTER TABLE players ADD COLUMN last_ad_ts REAL DEFAULT 0"),
-        ("players", "ad_boost_until", "ALTER TABLE players ADD COLUMN ad_boost_until REAL DEFAULT 0"),
-        ("players", "last_vip_case_claim", "ALTER TABLE players ADD COLUMN last_vip_case_claim TEXT DEFAULT ''"),
-        ("players", "last_vip_skin_claim", "ALTER TABLE players ADD COLUMN last_vip_skin_claim TEXT DEFAULT ''"),
-        ("player_achievements", "tier", "ALTER TABLE player_achievements ADD COLUMN tier TEXT DEFAULT 'bronze'"),
-        ("players", "last_boss_attack_ts", "ALTER TABLE players ADD COLUMN last_boss_attack_ts REAL DEFAULT 0"),
-        ("players", "casino_plays", "ALTER TABLE players ADD COLUMN casino_plays INTEGER DEFAULT 0"),
-        ("players", "casino_wins", "ALTER TABLE players ADD COLUMN casino_wins INTEGER DEFAULT 0"),
-        ("players", "market_sales", "ALTER TABLE players ADD COLUMN market_sales INTEGER DEFAULT 0"),
-        ("players", "tournament_top10", "ALTER TABLE players ADD COLUMN tournament_top10 INTEGER DEFAULT 0"),
-        ("players", "tournament_top3", "ALTER TABLE players ADD COLUMN tournament_top3 INTEGER DEFAULT 0"),
-        ("players", "bosses_killed", "ALTER TABLE players ADD COLUMN bosses_killed INTEGER DEFAULT 0"),
-        ("players", "talent_points", "ALTER TABLE players ADD COLUMN talent_points INTEGER DEFAULT 0"),
-        ("players", "pvp_cooldown_ts", "ALTER TABLE players ADD COLUMN pvp_cooldown_ts REAL DEFAULT 0"),
-        ("players", "notifications_enabled", "ALTER TABLE players ADD COLUMN notifications_enabled INTEGER DEFAULT 1"),
-        ("gangs", "last_heist_ts", "ALTER TABLE gangs ADD COLUMN last_heist_ts REAL DEFAULT 0"),
-        ("players", "bribe_cooldown_ts", "ALTER TABLE players ADD COLUMN bribe_cooldown_ts REAL DEFAULT 0"),
-    ]
-    for table, column, sql in migrations:
+    try:
+        yield db
+        hook = before_commit.get()
+        if hook is not None and db._writing:
+            await hook(db)
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+@asynccontextmanager
+async def savepoint(db, name="sp"):
+    """Nested unit inside transaction(): an exception rolls back only this block."""
+    if not db.in_transaction:
+        # A savepoint opened outside a transaction would commit on RELEASE
+        await db.execute("BEGIN")
+    callbacks = len(db._after_commit)
+    await db.execute(f"SAVEPOINT {name}")
+    try:
+        yield db
+    except BaseException:
+        await db.execute(f"ROLLBACK TO {name}")
+        await db.execute(f"RELEASE {name}")
+        # Rows re-read inside the block may have been rolled back; the writes
+        # stay recorded so their cache entries are still evicted on commit
+        db.cache_tx.reads.clear()
+        del db._after_commit[callbacks:]
+        raise
+    else:
+        await db.execute(f"RELEASE {name}")
+
+
+async def close_db():
+    global _pool, _cache_sync_task
+    if _cache_sync_task is not None:
+        _cache_sync_task.cancel()
         try:
+            await _cache_sync_task
+        except asyncio.CancelledError:
+            pass
+        _cache_sync_task = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+# ── Schema & migrations ──
+#
+# The schema version lives in PRAGMA user_version. init_db() applies only the
+# MIGRATIONS steps newer than the stored version, each in its own transaction,
+# so an up-to-date database boots without touching any table.
+
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    telegram_id INTEGER PRIMARY KEY,
+    username TEXT DEFAULT '',
+    cash REAL DEFAULT 1000.0,
+    reputation_fear INTEGER DEFAULT 0,
+    reputation_respect INTEGER DEFAULT 0,
+    suspicion REAL DEFAULT 0.0,
+    last_collect_ts REAL DEFAULT 0.0,
+    robbery_cooldown_ts REAL DEFAULT 0.0,
+    total_earned REAL DEFAULT 0.0,
+    total_taps INTEGER DEFAULT 0,
+    total_robberies INTEGER DEFAULT 0,
+    gang_id INTEGER DEFAULT 0,
+    referral_code TEXT DEFAULT '',
+    referred_by INTEGER DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS player_businesses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    business_id TEXT NOT NULL,
+    level INTEGER DEFAULT 1,
+    has_manager INTEGER DEFAULT 0,
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
+    UNIQUE(telegram_id, business_id)
+);
+
+CREATE TABLE IF NOT EXISTS robbery_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    target TEXT NOT NULL,
+    success INTEGER DEFAULT 0,
+    reward REAL DEFAULT 0.0,
+    suspicion_gain REAL DEFAULT 0.0,
+    created_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS player_character (
+    telegram_id INTEGER PRIMARY KEY,
+    nickname TEXT DEFAULT 'Новичок',
+    avatar TEXT DEFAULT 'default',
+    hat TEXT DEFAULT 'none',
+    jacket TEXT DEFAULT 'none',
+    accessory TEXT DEFAULT 'none',
+    weapon TEXT DEFAULT 'none',
+    car TEXT DEFAULT 'none',
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS player_inventory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    equipped INTEGER DEFAULT 0,
+    purchased_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
+    UNIQUE(telegram_id, item_id)
+);
+
+CREATE TABLE IF NOT EXISTS player_cases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    case_id TEXT NOT NULL,
+    purchased_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS gangs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    leader_id INTEGER NOT NULL,
+    cash_bank REAL DEFAULT 0.0,
+    power INTEGER DEFAULT 0,
+    territory INTEGER DEFAULT 0,
+    last_territory_attack_ts REAL DEFAULT 0.0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS gang_members (
+    telegram_id INTEGER PRIMARY KEY,
+    gang_id INTEGER NOT NULL,
+    role TEXT DEFAULT 'member',
+    joined_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (gang_id) REFERENCES gangs(id)
+);
+
+CREATE TABLE IF NOT EXISTS gang_upgrades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gang_id INTEGER NOT NULL,
+    upgrade_id TEXT NOT NULL,
+    level INTEGER DEFAULT 1,
+    UNIQUE(gang_id, upgrade_id)
+);
+
+CREATE TABLE IF NOT EXISTS gang_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gang_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS pvp_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    attacker_id INTEGER NOT NULL,
+    defender_id INTEGER NOT NULL,
+    winner_id INTEGER NOT NULL,
+    cash_stolen REAL DEFAULT 0.0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS casino_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    game TEXT NOT NULL,
+    bet REAL DEFAULT 0.0,
+    result TEXT DEFAULT '',
+    payout REAL DEFAULT 0.0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS daily_missions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    mission_id TEXT NOT NULL,
+    progress INTEGER DEFAULT 0,
+    target INTEGER DEFAULT 1,
+    reward REAL DEFAULT 0.0,
+    completed INTEGER DEFAULT 0,
+    claimed INTEGER DEFAULT 0,
+    day TEXT NOT NULL,
+    UNIQUE(telegram_id, mission_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS player_upgrades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    upgrade_id TEXT NOT NULL,
+    level INTEGER DEFAULT 1,
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
+    UNIQUE(telegram_id, upgrade_id)
+);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    referrer_id INTEGER NOT NULL,
+    referred_id INTEGER NOT NULL,
+    bonus_claimed INTEGER DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now')),
+    UNIQUE(referred_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_login (
+    telegram_id INTEGER PRIMARY KEY,
+    streak INTEGER DEFAULT 0,
+    last_claim_date TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS territories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    emoji TEXT DEFAULT '',
+    bonus_percent REAL DEFAULT 0.0,
+    owner_gang_id INTEGER DEFAULT 0,
+    captured_at REAL DEFAULT 0.0
+);
+
+CREATE TABLE IF NOT EXISTS territory_wars_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    territory_id INTEGER NOT NULL,
+    attacker_gang_id INTEGER NOT NULL,
+    defender_gang_id INTEGER DEFAULT 0,
+    winner_gang_id INTEGER NOT NULL,
+    attacker_power REAL DEFAULT 0,
+    defender_power REAL DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS player_achievements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    achievement_id TEXT NOT NULL,
+    unlocked_at REAL DEFAULT (strftime('%s','now')),
+    claimed INTEGER DEFAULT 0,
+    UNIQUE(telegram_id, achievement_id)
+);
+
+CREATE TABLE IF NOT EXISTS premium_transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    package_id TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    amount TEXT DEFAULT '',
+    status TEXT DEFAULT 'completed',
+    created_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS player_skins (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    skin_id TEXT NOT NULL,
+    purchased_at REAL DEFAULT (strftime('%s','now')),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS business_equipped_skins (
+    telegram_id INTEGER NOT NULL,
+    business_id TEXT NOT NULL,
+    skin_id TEXT NOT NULL,
+    PRIMARY KEY (telegram_id, business_id),
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS tournament_scores (
+    telegram_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    score INTEGER DEFAULT 0,
+    UNIQUE(telegram_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS tournament_prizes_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    place INTEGER DEFAULT 0,
+    cash_prize REAL DEFAULT 0,
+    cases_prize INTEGER DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS player_event_progress (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    event_id TEXT NOT NULL,
+    progress INTEGER DEFAULT 0,
+    rewards_claimed TEXT DEFAULT '',
+    UNIQUE(telegram_id, event_id)
+);
+
+CREATE TABLE IF NOT EXISTS active_bosses (
+    gang_id INTEGER UNIQUE,
+    boss_id TEXT NOT NULL,
+    current_health REAL NOT NULL,
+    max_health REAL NOT NULL,
+    defeated INTEGER DEFAULT 0,
+    boss_index INTEGER DEFAULT 0,
+    spawned_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS boss_attack_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gang_id INTEGER NOT NULL,
+    telegram_id INTEGER NOT NULL,
+    damage REAL DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS boss_rewards_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    gang_id INTEGER NOT NULL,
+    boss_id TEXT NOT NULL,
+    telegram_id INTEGER NOT NULL,
+    cash_reward REAL DEFAULT 0,
+    created_at REAL DEFAULT (strftime('%s','now'))
+);
+
+CREATE TABLE IF NOT EXISTS player_talents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    talent_id TEXT NOT NULL,
+    level INTEGER DEFAULT 1,
+    FOREIGN KEY (telegram_id) REFERENCES players(telegram_id),
+    UNIQUE(telegram_id, talent_id)
+);
+
+CREATE TABLE IF NOT EXISTS bounties (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    poster_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    reward REAL NOT NULL,
+    status TEXT DEFAULT 'active',
+    claimed_by INTEGER DEFAULT NULL,
+    created_at REAL DEFAULT (strftime('%s','now')),
+    completed_at REAL DEFAULT 0,
+    FOREIGN KEY (poster_id) REFERENCES players(telegram_id),
+    FOREIGN KEY (target_id) REFERENCES players(telegram_id)
+);
+
+CREATE TABLE IF NOT EXISTS gang_wars (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    attacker_gang_id INTEGER NOT NULL,
+    defender_gang_id INTEGER NOT NULL,
+    attacker_score INTEGER DEFAULT 0,
+    defender_score INTEGER DEFAULT 0,
+    status TEXT DEFAULT 'active',
+    started_at REAL DEFAULT (strftime('%s','now')),
+    ended_at REAL DEFAULT 0,
+    winner_gang_id INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS player_season_pass (
+    telegram_id INTEGER PRIMARY KEY,
+    season_id TEXT NOT NULL,
+    xp INTEGER DEFAULT 0,
+    is_premium INTEGER DEFAULT 0,
+    free_claimed TEXT DEFAULT '',
+    premium_claimed TEXT DEFAULT '',
+    purchased_at REAL DEFAULT 0
+);
+"""
+
+# Columns that older databases patched in on every boot via "ALTER TABLE, ignore errors".
+LEGACY_COLUMNS = [
+    ("players", "prestige_level", "ALTER TABLE players ADD COLUMN prestige_level INTEGER DEFAULT 0"),
+    ("players", "prestige_multiplier", "ALTER TABLE players ADD COLUMN prestige_multiplier REAL DEFAULT 1.0"),
+    ("players", "pvp_wins", "ALTER TABLE players ADD COLUMN pvp_wins INTEGER DEFAULT 0"),
+    ("gangs", "last_territory_attack_ts", "ALTER TABLE gangs ADD COLUMN last_territory_attack_ts REAL DEFAULT 0"),
+    ("players", "is_vip", "ALTER TABLE players ADD COLUMN is_vip INTEGER DEFAULT 0"),
+    ("players", "vip_until", "ALTER TABLE players ADD COLUMN vip_until REAL DEFAULT 0"),
+    ("players", "last_ad_ts", "ALTER TABLE players ADD COLUMN last_ad_ts REAL DEFAULT 0"),
+    ("players", "ad_boost_until", "ALTER TABLE players ADD COLUMN ad_boost_until REAL DEFAULT 0"),
+    ("players", "last_vip_case_claim", "ALTER TABLE players ADD COLUMN last_vip_case_claim TEXT DEFAULT ''"),
+    ("players", "last_vip_skin_claim", "ALTER TABLE players ADD COLUMN last_vip_skin_claim TEXT DEFAULT ''"),
+    ("player_achievements", "tier", "ALTER TABLE player_achievements ADD COLUMN tier TEXT DEFAULT 'bronze'"),
+    ("players", "last_boss_attack_ts", "ALTER TABLE players ADD COLUMN last_boss_attack_ts REAL DEFAULT 0"),
+    ("players", "casino_plays", "ALTER TABLE players ADD COLUMN casino_plays INTEGER DEFAULT 0"),
+    ("players", "casino_wins", "ALTER TABLE players ADD COLUMN casino_wins INTEGER DEFAULT 0"),
+    ("players", "market_sales", "ALTER TABLE players ADD COLUMN market_sales INTEGER DEFAULT 0"),
+    ("players", "tournament_top10", "ALTER TABLE players ADD COLUMN tournament_top10 INTEGER DEFAULT 0"),
+    ("players", "tournament_top3", "ALTER TABLE players ADD COLUMN tournament_top3 INTEGER DEFAULT 0"),
+    ("players", "bosses_killed", "ALTER TABLE players ADD COLUMN bosses_killed INTEGER DEFAULT 0"),
+    ("players", "talent_points", "ALTER TABLE players ADD COLUMN talent_points INTEGER DEFAULT 0"),
+    ("players", "pvp_cooldown_ts", "ALTER TABLE players ADD COLUMN pvp_cooldown_ts REAL DEFAULT 0"),
+    ("players", "notifications_enabled", "ALTER TABLE players ADD COLUMN notifications_enabled INTEGER DEFAULT 1"),
+    ("gangs", "last_heist_ts", "ALTER TABLE gangs ADD COLUMN last_heist_ts REAL DEFAULT 0"),
+    ("players", "bribe_cooldown_ts", "ALTER TABLE players ADD COLUMN bribe_cooldown_ts REAL DEFAULT 0"),
+]
+
+BASE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_pb_tid ON player_businesses(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pi_tid ON player_inventory(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pc_tid ON player_cases(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_gm_gang ON gang_members(gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_gu_gang ON gang_upgrades(gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_gl_gang ON gang_log(gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_dm_tid_day ON daily_missions(telegram_id, day)",
+    "CREATE INDEX IF NOT EXISTS idx_pu_tid ON player_upgrades(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_rl_tid ON robbery_log(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_cl_tid ON casino_log(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pvp_att ON pvp_log(attacker_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pvp_def ON pvp_log(defender_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ts_day ON tournament_scores(day)",
+    "CREATE INDEX IF NOT EXISTS idx_pa_tid ON player_achievements(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bal_gang ON boss_attack_log(gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pep_tid ON player_event_progress(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ps_tid ON player_skins(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pt_tid ON player_talents(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_gw_att ON gang_wars(attacker_gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_gw_def ON gang_wars(defender_gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ref_referrer ON referrals(referrer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_terr_owner ON territories(owner_gang_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bounty_target ON bounties(target_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bounty_poster ON bounties(poster_id)",
+]
+
+TERRITORY_SEEDS = [
+    ("Порт", "🚢", 5.0),
+    ("Промзона", "🏭", 4.0),
+    ("Казино-квартал", "🎰", 7.0),
+    ("Мэрия", "🏛", 6.0),
+    ("Торговый район", "🏬", 5.0),
+    ("Доки", "⚓", 4.0),
+    ("Аэропорт", "✈️", 8.0),
+    ("Старый город", "🏚", 3.0),
+    ("Финансовый центр", "🏦", 10.0),
+    ("Ночной квартал", "🌙", 6.0),
+]
+
+
+def _split_statements(script):
+    return [s.strip() for s in script.split(";") if s.strip()]
+
+
+async def _table_columns(db, table):
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return {r["name"] for r in await cursor.fetchall()}
+
+
+async def _migration_baseline(db):
+    """Tables, legacy columns, indexes and territory seeds as of the pre-versioned schema."""
+    for stmt in _split_statements(BASE_SCHEMA):
+        await db.execute(stmt)
+
+    columns = {}
+    for table, column, sql in LEGACY_COLUMNS:
+        if table not in columns:
+            columns[table] = await _table_columns(db, table)
+        if column not in columns[table]:
             await db.execute(sql)
-        except Exception:
-            pass  # column already exists
+            columns[table].add(column)
 
-    # ── Unique index for tournament prizes dedup ──
+    for stmt in BASE_INDEXES:
+        await db.execute(stmt)
+
+    # Unique index for tournament prizes dedup (old databases may hold duplicates)
     try:
         await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tournament_prizes_dedup ON tournament_prizes_log (telegram_id, day)")
     except Exception:
-        pass
+        logger.warning("Skipping idx_tournament_prizes_dedup: duplicate prize rows present")
 
-    # ── Backfill talent_points for existing prestige players ──
-    try:
-        await db.execute(
-            "UPDATE players SET talent_points = prestige_level "
-            "WHERE prestige_level > 0 AND talent_points = 0"
-        )
-    except Exception:
-        pass
+    # Backfill talent_points for existing prestige players
+    await db.execute(
+        "UPDATE players SET talent_points = prestige_level "
+        "WHERE prestige_level > 0 AND talent_points = 0"
+    )
 
-    # ── Seed territories ──
     cursor = await db.execute("SELECT COUNT(*) as cnt FROM territories")
     row = await cursor.fetchone()
     if row["cnt"] == 0:
-        territory_seeds = [
-            ("Порт", "🚢", 5.0),
-            ("Промзона", "🏭", 4.0),
-            ("Казино-квартал", "🎰", 7.0),
-            ("Мэрия", "🏛", 6.0),
-            ("Торговый район", "🏬", 5.0),
-            ("Доки", "⚓", 4.0),
-            ("Аэропорт", "✈️", 8.0),
-            ("Старый город", "🏚", 3.0),
-            ("Финансовый центр", "🏦", 10.0),
-            ("Ночной квартал", "🌙", 6.0),
-        ]
-        for name, emoji, bonus in territory_seeds:
-            await db.execute(
-                "INSERT INTO territories (name, emoji, bonus_percent) VALUES (?, ?, ?)",
-                (name, emoji, bonus),
-            )
-
-    # ── Performance indexes ──
-    index_statements = [
-        "CREATE INDEX IF NOT EXISTS idx_pb_tid ON player_businesses(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pi_tid ON player_inventory(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pc_tid ON player_cases(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_gm_gang ON gang_members(gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_gu_gang ON gang_upgrades(gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_gl_gang ON gang_log(gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_dm_tid_day ON daily_missions(telegram_id, day)",
-        "CREATE INDEX IF NOT EXISTS idx_pu_tid ON player_upgrades(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_rl_tid ON robbery_log(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_cl_tid ON casino_log(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pvp_att ON pvp_log(attacker_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pvp_def ON pvp_log(defender_id)",
-        "CREATE INDEX IF NOT EXISTS idx_ts_day ON tournament_scores(day)",
-        "CREATE INDEX IF NOT EXISTS idx_pa_tid ON player_achievements(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_bal_gang ON boss_attack_log(gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pep_tid ON player_event_progress(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_ps_tid ON player_skins(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_pt_tid ON player_talents(telegram_id)",
-        "CREATE INDEX IF NOT EXISTS idx_gw_att ON gang_wars(attacker_gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_gw_def ON gang_wars(defender_gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_ref_referrer ON referrals(referrer_id)",
-        "CREATE INDEX IF NOT EXISTS idx_terr_owner ON territories(owner_gang_id)",
-        "CREATE INDEX IF NOT EXISTS idx_bounty_target ON bounties(target_id)",
-        "CREATE INDEX IF NOT EXISTS idx_bounty_poster ON bounties(poster_id)",
-    ]
-    for stmt in index_statements:
+        await db.executemany(
+            "INSERT INTO territories (name, emoji, bonus_percent) VALUES (?, ?, ?)",
+            TERRITORY_SEEDS,
+        )
+
+
+async def _migration_cache_invalidations(db):
+    """Outbox through which other processes (bot.py) evict players from the backend cache."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS cache_invalidations ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "telegram_id INTEGER NOT NULL, "
+        "created_at REAL DEFAULT (strftime('%s','now')))"
+    )
+
+
+async def _migration_income_profile(db):
+    """Materialized income multipliers per player (rebuilt lazily by backend.main)."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS player_income_profile ("
+        "telegram_id INTEGER PRIMARY KEY, "
+        "gang_id INTEGER DEFAULT 0, "
+        "territory_bonus REAL DEFAULT 0, "
+        "equip_income_bonus REAL DEFAULT 0, "
+        "upgrade_income_bonus REAL DEFAULT 0, "
+        "gang_income_bonus REAL DEFAULT 0, "
+        "gang_raid_reduction REAL DEFAULT 0, "
+        "talent_income_bonus REAL DEFAULT 0, "
+        "talent_suspicion_reduce REAL DEFAULT 0, "
+        "talent_offline_hours REAL DEFAULT 0, "
+        "talent_raid_reduce REAL DEFAULT 0, "
+        "updated_at REAL DEFAULT 0)"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_income_profile_gang ON player_income_profile(gang_id)")
+
+
+async def _migration_tournament_settlement(db):
+    """Once-a-day tournament settlement: settled days, and which prize notices were shown."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS tournament_settlements ("
+        "day TEXT PRIMARY KEY, "
+        "winners INTEGER DEFAULT 0, "
+        "settled_at REAL DEFAULT (strftime('%s','now')))"
+    )
+    # Prizes paid under the old claim-on-login scheme were shown when paid
+    await db.execute("ALTER TABLE tournament_prizes_log ADD COLUMN notified INTEGER DEFAULT 1")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ts_day_score ON tournament_scores(day, score)")
+
+
+async def _migration_scheduled_jobs(db):
+    """Due-time job queue for backend.scheduler; one row per (kind, key)."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS scheduled_jobs ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "kind TEXT NOT NULL, "
+        "key TEXT NOT NULL, "
+        "due_at REAL NOT NULL, "
+        "payload TEXT, "
+        "attempts INTEGER DEFAULT 0, "
+        "created_at REAL DEFAULT (strftime('%s','now')), "
+        "UNIQUE(kind, key))"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs(due_at)")
+
+
+async def _migration_ton_index(db):
+    """Incoming wallet transactions indexed by backend.ton_indexer, and its lt cursor."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS ton_transactions ("
+        "hash TEXT PRIMARY KEY, "
+        "lt INTEGER NOT NULL, "
+        "utime REAL NOT NULL, "
+        "source TEXT DEFAULT '', "
+        "value INTEGER NOT NULL, "
+        "comment TEXT DEFAULT '', "
+        "claimed_by INTEGER, "
+        "claimed_at REAL)"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ton_transactions_comment ON ton_transactions(comment)")
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS ton_indexer_state ("
+        "address TEXT PRIMARY KEY, "
+        "last_lt INTEGER NOT NULL, "
+        "last_hash TEXT NOT NULL, "
+        "updated_at REAL NOT NULL)"
+    )
+
+
+async def _migration_gang_aggregates(db):
+    """Member count, summed business level and summed fear kept on gangs, backfilled here."""
+    for column in ("member_count INTEGER DEFAULT 0", "total_business_level INTEGER DEFAULT 0", "total_fear INTEGER DEFAULT 0"):
+        await db.execute(f"ALTER TABLE gangs ADD COLUMN {column}")
+    await db.execute(
+        "UPDATE gangs SET "
+        "member_count=(SELECT COUNT(*) FROM gang_members gm WHERE gm.gang_id=gangs.id), "
+        "total_business_level=(SELECT COALESCE(SUM(pb.level), 0) FROM gang_members gm "
+        "JOIN player_businesses pb ON pb.telegram_id=gm.telegram_id WHERE gm.gang_id=gangs.id), "
+        "total_fear=(SELECT COALESCE(SUM(p.reputation_fear), 0) FROM gang_members gm "
+        "JOIN players p ON p.telegram_id=gm.telegram_id WHERE gm.gang_id=gangs.id)"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_gangs_power ON gangs(power DESC)")
+
+
+async def _migration_boss_damage(db):
+    """Per-attacker damage on each gang's live boss, replacing the append-only boss_attack_log."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS boss_damage ("
+        "gang_id INTEGER NOT NULL, "
+        "boss_id TEXT NOT NULL, "
+        "telegram_id INTEGER NOT NULL, "
+        "damage REAL DEFAULT 0, "
+        "updated_at REAL DEFAULT (strftime('%s','now')), "
+        "PRIMARY KEY (gang_id, boss_id, telegram_id))"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_boss_damage_board ON boss_damage(gang_id, boss_id, damage DESC)")
+    # The log only ever held attacks on the current boss; it was cleared on each defeat
+    await db.execute(
+        "INSERT INTO boss_damage (gang_id, boss_id, telegram_id, damage, updated_at) "
+        "SELECT bal.gang_id, b.boss_id, bal.telegram_id, SUM(bal.damage), MAX(bal.created_at) "
+        "FROM boss_attack_log bal JOIN active_bosses b ON b.gang_id=bal.gang_id AND b.defeated=0 "
+        "GROUP BY bal.gang_id, bal.telegram_id"
+    )
+    await db.execute("DROP TABLE boss_attack_log")
+
+
+async def _migration_idempotency_keys(db):
+    """Responses stored by Idempotency-Key for backend.idempotency (hash and body as blobs)."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+        "key TEXT PRIMARY KEY, "
+        "request_hash BLOB NOT NULL, "
+        "status INTEGER NOT NULL, "
+        "content_type TEXT NOT NULL, "
+        "body BLOB NOT NULL, "
+        "expires_at REAL NOT NULL) WITHOUT ROWID"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+
+
+async def _migration_counter_deltas(db):
+    """Append-only log of counter increments that backend.counters folds into their rows."""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS counter_deltas ("
+        "id INTEGER PRIMARY KEY, "
+        "counter TEXT NOT NULL, "
+        "telegram_id INTEGER NOT NULL, "
+        "key TEXT NOT NULL, "
+        "delta INTEGER NOT NULL)"
+    )
+
+
+async def _migration_drop_counter_deltas(db):
+    """Counters are written directly again; fold any logged deltas in and drop the log."""
+    for sql in (
+        "INSERT INTO tournament_scores (telegram_id, day, score) "
+        "SELECT telegram_id, key, SUM(delta) FROM counter_deltas WHERE counter='tournament' GROUP BY telegram_id, key "
+        "ON CONFLICT(telegram_id, day) DO UPDATE SET score=score+excluded.score",
+        "INSERT INTO player_event_progress (telegram_id, event_id, progress) "
+        "SELECT telegram_id, key, SUM(delta) FROM counter_deltas WHERE counter='event' GROUP BY telegram_id, key "
+        "ON CONFLICT(telegram_id, event_id) DO UPDATE SET progress=progress+excluded.progress",
+        "INSERT INTO player_season_pass (telegram_id, season_id, xp) "
+        "SELECT telegram_id, key, SUM(delta) FROM counter_deltas WHERE counter='season' GROUP BY telegram_id, key "
+        "ON CONFLICT(telegram_id) DO UPDATE SET xp=xp+excluded.xp",
+    ):
+        await db.execute(sql)
+    await db.execute("DROP TABLE counter_deltas")
+
+
+# (version, name, step) — append new steps at the end, never edit applied ones.
+MIGRATIONS = [
+    (1, "baseline schema", _migration_baseline),
+    (2, "cache invalidation outbox", _migration_cache_invalidations),
+    (3, "player income profile", _migration_income_profile),
+    (4, "tournament settlement", _migration_tournament_settlement),
+    (5, "scheduled jobs", _migration_scheduled_jobs),
+    (6, "ton transaction index", _migration_ton_index),
+    (7, "gang aggregates", _migration_gang_aggregates),
+    (8, "boss damage board", _migration_boss_damage),
+    (9, "idempotency keys", _migration_idempotency_keys),
+    (10, "counter delta log", _migration_counter_deltas),
+    (11, "drop counter delta log", _migration_drop_counter_deltas),
+]
+
+
+async def _user_version(db):
+    cursor = await db.execute("PRAGMA user_version")
+    return (await cursor.fetchone())[0]
+
+
+async def run_migrations(db):
+    """Apply pending MIGRATIONS in order; returns the resulting schema version."""
+    current = await _user_version(db)
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        await db.execute("BEGIN IMMEDIATE")
         try:
-            await db.execute(stmt)
+            # Another process may have applied it while we waited for the write lock
+            current = await _user_version(db)
+            if version <= current:
+                await db.rollback()
+                continue
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
         except Exception:
-            pass
+            await db.rollback()
+            logger.exception("Migration %d (%s) failed", version, name)
+            raise
+        current = version
+        logger.info("Applied migration %d (%s) in %.1f ms", version, name, (time.perf_counter() - started) * 1000)
+    return current
 
-    await db.commit()
-    await db.close()
+
+# ── Cross-process cache invalidation ──
+
+_cache_sync_task: asyncio.Task | None = None
+
+
+async def _sync_cache_invalidations(interval):
+    """Evict players whose rows another process changed (see cache_invalidations)."""
+    last_id = None
+    last_prune = 0.0
+    while True:
+        try:
+            db = await get_db()
+            try:
+                if last_id is None:
+                    # The cache starts empty, so older outbox rows are irrelevant
+                    cursor = await db.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations")
+                    last_id = (await cursor.fetchone())[0]
+                else:
+                    cursor = await db.execute(
+                        "SELECT id, telegram_id FROM cache_invalidations WHERE id > ? ORDER BY id",
+                        (last_id,),
+                    )
+                    for row in await cursor.fetchall():
+                        player_cache.invalidate(row["telegram_id"])
+                        last_id = row["id"]
+                if time.time() - last_prune > 3600:
+                    await db.execute("DELETE FROM cache_invalidations WHERE created_at < ?", (time.time() - 3600,))
+                    await db.commit()
+                    last_prune = time.time()
+            finally:
+                await db.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Cache invalidation sync failed")
+        await asyncio.sleep(interval)
+
+
+async def init_db():
+    global _cache_sync_task
+    started = time.perf_counter()
+    db = await get_db()
+    try:
+        version = await run_migrations(db)
+    finally:
+        await db.close()
+    logger.info("Database ready at schema version %d in %.1f ms", version, (time.perf_counter() - started) * 1000)
+    if _cache_sync_task is None and CACHE_SYNC_INTERVAL > 0:
+        _cache_sync_task = asyncio.create_task(_sync_cache_invalidations(CACHE_SYNC_INTERVAL))
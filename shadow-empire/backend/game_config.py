@@ -443,6 +443,9 @@ CASES = {
     },
 }
 
+# Cash for a case drop the player already owns: half the case price times this
+CASE_DUPLICATE_RARITY_MULT = {"common": 1, "uncommon": 2, "rare": 4, "epic": 8, "legendary": 20}
+
 # Suspicion thresholds
 RAID_THRESHOLD = 80.0
 SUSPICION_DECAY_PER_SEC = 0.08
@@ -455,6 +458,18 @@ RESPECT_LEGAL_DISCOUNT = 0.01
 FEAR_INCOME_BONUS = 0.005
 RESPECT_SUSPICION_REDUCE = 0.005
 
+# Most business levels one /api/buy request may add (count / max)
+BUY_MAX_COUNT = 100
+
+# Most cases one /api/case/open or /api/case/spin request may open (count)
+CASE_OPEN_MAX_COUNT = 50
+
+# Most skin cases one /api/skin/open request may open (count, clamped)
+SKIN_CASE_OPEN_MAX_COUNT = 50
+
+# Most spins one /api/casino/autoplay request may play (rounds)
+CASINO_AUTOPLAY_MAX_ROUNDS = 100
+
 # Referral bonus
 REFERRAL_BONUS = 1000
 
@@ -462,6 +477,7 @@ REFERRAL_BONUS = 1000
 PVP_COOLDOWN_SECONDS = 600
 PVP_STEAL_PERCENT = 0.15
 PVP_MIN_CASH_TO_ATTACK = 2000
+PVP_TARGET_COUNT = 5
 
 # ── Daily Missions ──
 MISSION_TEMPLATES = [
@@ -2,6 +2,7 @@
 Core game logic — income calculation, buying, upgrading, robberies, raids.
 """
 
+import math
 import time
 import random
 from backend.game_config import (
@@ -132,6 +133,17 @@ def attempt_robbery(robbery_id, player_fear=0, reward_bonus_pct=0):
         return False, 0, round(penalty_suspicion, 2)
 
 
+def _buy_discount_terms(cfg, fear, respect, talent_discount):
+    """(discount at current reputation, per-reputation-point step, cap) for a business."""
+    if cfg["type"] == "shadow":
+        rep, step = fear, FEAR_SHADOW_DISCOUNT
+    else:
+        rep, step = respect, RESPECT_LEGAL_DISCOUNT
+    # min(min(rep * step, 0.3) + talent, 0.5) == min(rep * step + talent, cap)
+    cap = min(0.3 + talent_discount / 100.0, 0.5)
+    return rep * step + talent_discount / 100.0, step, cap
+
+
 def get_buy_cost(business_id, current_level, fear=0, respect=0, talent_discount=0):
     """Get cost to buy/upgrade a business, applying reputation + talent discounts."""
     cfg = ALL_BUSINESSES.get(business_id)
@@ -152,6 +164,66 @@ def get_buy_cost(business_id, current_level, fear=0, respect=0, talent_discount=
     return round(cost * (1 - discount), 2)
 
 
+def get_bulk_buy_cost(business_id, current_level, count, fear=0, respect=0, talent_discount=0):
+    """
+    Total cost of the next `count` levels in O(1).
+    Same as calling get_buy_cost `count` times with reputation +1 after each
+    level (per-level cent rounding aside): cost grows geometrically while the
+    discount grows linearly until it hits its cap, so the sum is one
+    arithmetico-geometric series plus one geometric series.
+    """
+    cfg = ALL_BUSINESSES.get(business_id)
+    if not cfg or count <= 0:
+        return None if not cfg else 0.0
+    alpha, step, cap = _buy_discount_terms(cfg, fear, respect, talent_discount)
+    if current_level <= 0:
+        # Level 0 -> 1 is priced like level 1 -> 2; peel it off so the rest is one series
+        first = cfg["base_cost"] * (1 - min(alpha, cap))
+        if cfg["type"] == "shadow":
+            fear += 1
+        else:
+            respect += 1
+        return round(first + get_bulk_buy_cost(business_id, 1, count - 1, fear, respect, talent_discount), 2)
+
+    g = cfg["cost_multiplier"]
+    k = count
+    # Levels i < j still get a growing discount alpha + i*step; the rest are capped
+    j = 0 if alpha >= cap else min(k, math.ceil((cap - alpha) / step - 1e-9))
+    if g == 1:
+        geo_j, geo_k, arith_j = j, k, j * (j - 1) / 2
+    else:
+        geo_j = (g ** j - 1) / (g - 1)
+        geo_k = (g ** k - 1) / (g - 1)
+        arith_j = g * (1 - j * g ** (j - 1) + (j - 1) * g ** j) / (1 - g) ** 2
+    total = (1 - alpha) * geo_j - step * arith_j + (1 - cap) * (geo_k - geo_j)
+    return round(calc_business_cost(cfg, current_level) * total, 2)
+
+
+def max_affordable_levels(business_id, current_level, cash, fear=0, respect=0, talent_discount=0, limit=None):
+    """Largest count with get_bulk_buy_cost(...) <= cash (binary search over the closed form)."""
+    def cost(n):
+        try:
+            return get_bulk_buy_cost(business_id, current_level, n, fear, respect, talent_discount)
+        except OverflowError:
+            return float("inf")
+
+    hi = 1
+    while cost(hi) <= cash and (limit is None or hi < limit):
+        hi *= 2
+    if limit is not None:
+        hi = min(hi, limit)
+        if cost(hi) <= cash:
+            return hi
+    lo = 0  # cost(lo) <= cash < cost(hi)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if cost(mid) <= cash:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
 def get_player_level(owned_businesses):
     """Player level = sum of all business levels."""
     return sum(b["level"] for b in owned_businesses)
@@ -0,0 +1,299 @@
+"""
+Idempotency-Key support for the POST endpoints under /api/.
+
+The Mini App sends a fresh key with every mutating call and reuses it when it
+retries after a network error. IdempotencyMiddleware runs the handler only the
+first time a key is seen and answers every repeat with the stored response
+(marked with an Idempotent-Replayed: true header), so a retried /api/buy or
+/api/casino neither charges twice nor re-runs the game logic. Requests
+without the header, or to the naturally repeatable IDEMPOTENCY_EXEMPT_PATHS
+(the /api/collect tick, /api/init), behave as before.
+
+- A key is bound to its request: a SHA-256 of method, path and body. Reusing
+  it for a different request gets 422.
+- A repeat that arrives while the first request is still running waits for
+  it and gets the same response, instead of queueing on the player lock and
+  running again.
+- Responses are kept for IDEMPOTENCY_TTL seconds in the idempotency_keys
+  table, with an LRU of IDEMPOTENCY_CACHE_SIZE entries in front of it. 5xx
+  responses are not stored, so the client can try again, unless the handler
+  had already committed a write. A background task deletes expired rows
+  every IDEMPOTENCY_PURGE_INTERVAL seconds.
+
+The key itself is claimed inside the handler's own transaction: the first
+transaction() of the request that writes also inserts a pending row, through
+database.before_commit, so the game state and the claim commit together. The
+response body is filled in afterwards. If the server dies in between, a retry
+finds the pending row and gets 409 instead of running the action again.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from backend.database import before_commit, transaction
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "600"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Safe to repeat as-is, and hot: the keys would cost two extra transactions per call
+IDEMPOTENCY_EXEMPT_PATHS = frozenset(("/api/collect", "/api/init"))
+# status of a key claimed by a committed handler transaction whose response isn't stored yet
+PENDING_STATUS = 0
+
+logger = logging.getLogger(__name__)
+
+
+class StoredResponse:
+    __slots__ = ("request_hash", "status", "content_type", "body", "expires_at")
+
+    def __init__(self, request_hash, status, content_type, body, expires_at):
+        self.request_hash = request_hash
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.expires_at = expires_at
+
+
+class _Claim:
+    """before_commit hook that records key as pending in the request's first writing transaction."""
+
+    __slots__ = ("key", "request_hash", "expires_at", "task", "committed")
+
+    def __init__(self, key, request_hash, expires_at):
+        self.key = key
+        self.request_hash = request_hash
+        self.expires_at = expires_at
+        self.task = asyncio.current_task()
+        self.committed = False
+
+    async def __call__(self, db):
+        # Tasks spawned during the request inherit the context but aren't the request
+        if self.committed or asyncio.current_task() is not self.task:
+            return
+        await db.execute(
+            "INSERT OR REPLACE INTO idempotency_keys (key, request_hash, status, content_type, body, expires_at) "
+            "VALUES (?,?,?,'',x'',?)",
+            (self.key, self.request_hash, PENDING_STATUS, self.expires_at),
+        )
+        db.on_commit(self._commit)
+
+    def _commit(self):
+        self.committed = True
+
+
+class IdempotencyStore:
+    """Stored responses by key: an in-memory LRU over the idempotency_keys table."""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_CACHE_SIZE, purge_interval=IDEMPOTENCY_PURGE_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.purge_interval = purge_interval
+        self._entries: OrderedDict[str, StoredResponse] = OrderedDict()
+        self._inflight: dict[str, tuple[bytes, asyncio.Future]] = {}
+        self._task: asyncio.Task | None = None
+        self.metrics = {"executed": 0, "replayed": 0, "joined": 0, "mismatched": 0, "unavailable": 0, "purged": 0}
+
+    def _remember(self, key, stored):
+        self._entries[key] = stored
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        stored = self._entries.get(key)
+        if stored is not None:
+            self._entries.move_to_end(key)
+        else:
+            async with transaction() as db:
+                cursor = await db.execute(
+                    "SELECT request_hash, status, content_type, body, expires_at FROM idempotency_keys WHERE key=?",
+                    (key,),
+                )
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            stored = StoredResponse(*row)
+            self._remember(key, stored)
+        if stored.expires_at <= time.time():
+            self._entries.pop(key, None)
+            return None
+        return stored
+
+    async def put(self, key, stored):
+        async with transaction() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (key, request_hash, status, content_type, body, expires_at) "
+                "VALUES (?,?,?,?,?,?)",
+                (key, stored.request_hash, stored.status, stored.content_type, stored.body, stored.expires_at),
+            )
+        self._remember(key, stored)
+
+    async def purge(self):
+        async with transaction() as db:
+            cursor = await db.execute("DELETE FROM idempotency_keys WHERE expires_at<=?", (time.time(),))
+            purged = cursor.rowcount
+        self.metrics["purged"] += purged
+        return purged
+
+    # ── Lifecycle ──
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                await self.purge()
+            except Exception:
+                logger.exception("Idempotency key purge failed")
+
+    def start(self):
+        if self._task is None and self.purge_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._entries.clear()
+
+    def stats(self):
+        return dict(self.metrics, cached=len(self._entries), in_flight=len(self._inflight))
+
+
+idempotency_store = IdempotencyStore()
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware that deduplicates POST /api/* requests carrying an Idempotency-Key."""
+
+    def __init__(self, app, store=idempotency_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith("/api/")
+                or scope["path"] in IDEMPOTENCY_EXEMPT_PATHS):
+            return await self.app(scope, receive, send)
+        key = next((v for k, v in scope["headers"] if k == IDEMPOTENCY_HEADER), None)
+        if key is None:
+            return await self.app(scope, receive, send)
+        key = key.decode("latin-1").strip()
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return await _send_json(send, 400, {"detail": "Invalid Idempotency-Key"})
+
+        chunks, more = [], True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        body = b"".join(chunks)
+        request_hash = hashlib.sha256(b"POST " + scope["path"].encode() + b"\n" + body).digest()
+
+        store = self.store
+        inflight = store._inflight.get(key)
+        if inflight is not None:
+            if inflight[0] != request_hash:
+                store.metrics["mismatched"] += 1
+                return await _send_json(send, 422, {"detail": "Idempotency-Key reused for a different request"})
+            store.metrics["joined"] += 1
+            stored = await asyncio.shield(inflight[1])
+            if stored is None:  # the first attempt failed with a 5xx; let this one run
+                return await self(scope, _replay_body(body, receive), send)
+            return await _send_stored(send, stored)
+
+        future = asyncio.get_running_loop().create_future()
+        store._inflight[key] = (request_hash, future)
+        stored = None
+        try:
+            stored = await store.get(key)
+            if stored is not None:
+                if stored.request_hash != request_hash:
+                    store.metrics["mismatched"] += 1
+                    await _send_json(send, 422, {"detail": "Idempotency-Key reused for a different request"})
+                    stored = None
+                    return
+                if stored.status == PENDING_STATUS:
+                    store.metrics["unavailable"] += 1
+                    await _send_json(send, 409, {"detail": "Request already processed; its response was lost"})
+                    stored = None
+                    return
+                store.metrics["replayed"] += 1
+                await _send_stored(send, stored)
+                return
+
+            store.metrics["executed"] += 1
+            status, headers, out = 500, [], []
+
+            async def capture(message):
+                nonlocal status, headers
+                if message["type"] == "http.response.start":
+                    status, headers = message["status"], message.get("headers", [])
+                elif message["type"] == "http.response.body":
+                    out.append(message.get("body", b""))
+
+            token = before_commit.set(_Claim(key, request_hash, time.time() + store.ttl))
+            try:
+                await self.app(scope, _replay_body(body, receive), capture)
+            finally:
+                before_commit.reset(token)
+            content_type = next((v.decode("latin-1") for k, v in headers if k == b"content-type"), "application/json")
+            response = StoredResponse(request_hash, status, content_type, b"".join(out), time.time() + store.ttl)
+            if status < 500:
+                try:
+                    await store.put(key, response)
+                    stored = response
+                except Exception:
+                    logger.exception("Could not store idempotent response for %s", scope["path"])
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": response.body})
+        finally:
+            store._inflight.pop(key, None)
+            if not future.done():
+                future.set_result(stored)
+
+
+def _replay_body(body, receive):
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return {"type": "http.disconnect"}
+    return receive
+
+
+async def _send_stored(send, stored):
+    await send({
+        "type": "http.response.start",
+        "status": stored.status,
+        "headers": [
+            (b"content-type", stored.content_type.encode("latin-1")),
+            (b"content-length", str(len(stored.body)).encode()),
+            (b"idempotent-replayed", b"true"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": stored.body})
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
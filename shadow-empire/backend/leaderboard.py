@@ -0,0 +1,172 @@
+"""
+In-memory ranking of players by total_earned (GET /api/leaderboard).
+
+The table is loaded once at startup and then kept current by the code that
+changes total_earned (earnings sync, prestige, admin reset), which reports the
+new value with db.on_commit(), so rolled-back transactions never reach it.
+
+Ranks live in an indexable skiplist: every forward link also stores how many
+positions it skips, which gives top-N, rank-of-player and the slice around a
+player in O(log n) without touching SQLite.
+"""
+
+import logging
+import random
+
+LEADERBOARD_SIZE = 20
+LEADERBOARD_RADIUS = 2
+SKIPLIST_LEVELS = 24  # comfortably past 2**24 players
+
+logger = logging.getLogger(__name__)
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class RankedSkiplist:
+    """Sorted keys with positional access: index(key) and items(start, stop)."""
+
+    def __init__(self, levels=SKIPLIST_LEVELS):
+        self.levels = levels
+        self._size = 0
+        self._tail = _Node(None, 0)
+        self._head = _Node(None, levels)
+        self._head.next = [self._tail] * levels
+
+    def __len__(self):
+        return self._size
+
+    def _random_height(self):
+        height = 1
+        while height < self.levels and random.random() < 0.5:
+            height += 1
+        return height
+
+    def _path(self, key):
+        """Last node before key on every level, and the positions skipped on each."""
+        chain = [None] * self.levels
+        steps = [0] * self.levels
+        node = self._head
+        for level in reversed(range(self.levels)):
+            while node.next[level] is not self._tail and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+
+    def insert(self, key):
+        chain, steps = self._path(key)
+        height = self._random_height()
+        node = _Node(key, height)
+        skipped = 0
+        for level in range(height):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - skipped
+            prev.width[level] = skipped + 1
+            skipped += steps[level]
+        for level in range(height, self.levels):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is self._tail or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self.levels):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def index(self, key):
+        """0-based position of key (which must be present)."""
+        _, steps = self._path(key)
+        return sum(steps)
+
+    def items(self, start, stop):
+        """Keys at positions [start, stop)."""
+        start = max(start, 0)
+        stop = min(stop, self._size)
+        if start >= stop:
+            return []
+        node = self._head
+        remaining = start + 1
+        for level in reversed(range(self.levels)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        out = []
+        for _ in range(stop - start):
+            out.append(node.key)
+            node = node.next[0]
+        return out
+
+
+class Leaderboard:
+    def __init__(self):
+        self._scores: dict[int, float] = {}
+        self._ranks = RankedSkiplist()
+
+    def __len__(self):
+        return len(self._scores)
+
+    # ── Updates ──
+
+    def update(self, tid, score):
+        old = self._scores.get(tid)
+        if old == score:
+            return
+        if old is not None:
+            self._ranks.remove((-old, tid))
+        self._scores[tid] = score
+        self._ranks.insert((-score, tid))
+
+    def remove(self, tid):
+        old = self._scores.pop(tid, None)
+        if old is not None:
+            self._ranks.remove((-old, tid))
+
+    async def load(self, db):
+        self._scores, self._ranks = {}, RankedSkiplist()
+        cursor = await db.execute("SELECT telegram_id, total_earned FROM players")
+        for row in await cursor.fetchall():
+            self.update(row["telegram_id"], row["total_earned"] or 0.0)
+        logger.info("Leaderboard loaded: %d players", len(self))
+
+    # ── Queries ──
+
+    def top(self, n=LEADERBOARD_SIZE):
+        """[(rank, telegram_id, total_earned)] for the first n places."""
+        return self._slice(0, n)
+
+    def rank(self, tid):
+        """1-based place of tid, or None if unknown."""
+        score = self._scores.get(tid)
+        if score is None:
+            return None
+        return self._ranks.index((-score, tid)) + 1
+
+    def around(self, tid, radius=LEADERBOARD_RADIUS):
+        """[(rank, telegram_id, total_earned)] for tid and up to radius places either side."""
+        rank = self.rank(tid)
+        if rank is None:
+            return []
+        return self._slice(rank - 1 - radius, rank + radius)
+
+    def _slice(self, start, stop):
+        start = max(start, 0)
+        return [(start + i + 1, tid, -neg) for i, (neg, tid) in enumerate(self._ranks.items(start, stop))]
+
+
+leaderboard = Leaderboard()
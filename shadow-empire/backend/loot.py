@@ -0,0 +1,83 @@
+"""
+Loot engine for item cases (POST /api/case/open and /api/case/spin).
+
+Each case's loot weights depend on two modifiers: the lootbox_master talent
+boost and the weekly loot multiplier. Both scale the rare, epic and legendary
+entries. For every combination of case and modifiers, the adjusted weights are
+computed once, and each draw is O(1) from a Vose alias table.
+
+Players never get an item they already own. The old endpoints kept re-rolling
+until they hit an unowned item. Here, draws come straight from the case's
+distribution restricted to unowned items. That table is cached by a bitmask
+of the owned loot entries. A case whose every item is owned draws from the
+full table instead, which decides the cash compensation.
+"""
+
+import random
+from functools import lru_cache
+
+from backend.game_config import CASES, SHOP_ITEMS
+
+BOOSTED_RARITIES = ("rare", "epic", "legendary")
+
+
+class AliasTable:
+    """Vose's alias method: O(n) to build, O(1) per weighted draw of an index."""
+
+    __slots__ = ("prob", "alias")
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Whatever is left is 1.0 up to rounding
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+@lru_cache(maxsize=None)
+def case_weights(case_id, lootbox_boost=0, loot_mult=1.0):
+    """(item_ids, weights) for a case with the talent boost (%) and weekly multiplier applied."""
+    items, weights = [], []
+    for entry in CASES[case_id]["loot"]:
+        w = entry["weight"]
+        if SHOP_ITEMS.get(entry["item_id"], {}).get("rarity", "common") in BOOSTED_RARITIES:
+            if lootbox_boost > 0:
+                w *= 1 + lootbox_boost / 100.0
+            w *= loot_mult
+        items.append(entry["item_id"])
+        weights.append(w)
+    return tuple(items), tuple(weights)
+
+
+@lru_cache(maxsize=4096)
+def _alias_table(case_id, lootbox_boost, loot_mult, owned_mask):
+    """Alias table over the entries whose bit is clear in owned_mask, and their positions."""
+    _, weights = case_weights(case_id, lootbox_boost, loot_mult)
+    positions = [i for i in range(len(weights)) if not owned_mask >> i & 1]
+    return AliasTable([weights[i] for i in positions]), positions
+
+
+def roll_case(case_id, owned_ids, lootbox_boost=0, loot_mult=1.0, rng=random):
+    """One draw from a case: (item_id, True) for an item not in owned_ids, or
+    (item_id, False) for a duplicate when every item in the case is owned."""
+    items, _ = case_weights(case_id, lootbox_boost, loot_mult)
+    owned_mask = 0
+    for i, item_id in enumerate(items):
+        if item_id in owned_ids:
+            owned_mask |= 1 << i
+    is_new = owned_mask != (1 << len(items)) - 1
+    table, positions = _alias_table(case_id, lootbox_boost, loot_mult, owned_mask if is_new else 0)
+    return items[positions[table.sample(rng)]], is_new
@@ -7,31 +7,43 @@ import json
 import time
 import math
 import random
+import bisect
+import itertools
 import hashlib
 import hmac
 import uuid
 import urllib.parse
 import asyncio
 import base64
+import logging
 from datetime import datetime, timezone, timedelta
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import httpx
 
-from backend.database import init_db, get_db
+from backend.database import init_db, close_db, transaction, savepoint
+from backend.cache import player_cache
+from backend.stream import stream_hub, format_event, STREAM_HEARTBEAT
+from backend.leaderboard import leaderboard, LEADERBOARD_SIZE, LEADERBOARD_RADIUS
+from backend.matchmaking import pvp_index
+from backend.scheduler import scheduler
+from backend.notifications import notifier, TELEGRAM_API_BASE
+from backend.ton_indexer import ton_indexer
+from backend.idempotency import IdempotencyMiddleware, idempotency_store
+from backend.loot import roll_case
 from backend.game_config import (
     ALL_BUSINESSES, ALL_ROBBERIES,
     LEGAL_BUSINESSES, SHADOW_BUSINESSES, ROBBERIES,
     CASINO_GAMES, SLOT_SYMBOLS, SLOT_PAYOUTS, SLOT_TWO_MATCH_PAYOUT,
     ROULETTE_RED, ROULETTE_BLACK, ROULETTE_NUMBERS,
-    SHOP_ITEMS, MAX_SUSPICION, REFERRAL_BONUS, UPGRADES,
-    PVP_COOLDOWN_SECONDS, PVP_STEAL_PERCENT, PVP_MIN_CASH_TO_ATTACK,
-    CASES, RARITIES,
+    SHOP_ITEMS, MAX_SUSPICION, RAID_THRESHOLD, REFERRAL_BONUS, UPGRADES,
+    BUY_MAX_COUNT, PVP_COOLDOWN_SECONDS, PVP_STEAL_PERCENT, PVP_MIN_CASH_TO_ATTACK, PVP_TARGET_COUNT,
+    CASES, RARITIES, CASE_DUPLICATE_RARITY_MULT, CASE_OPEN_MAX_COUNT, SKIN_CASE_OPEN_MAX_COUNT, CASINO_AUTOPLAY_MAX_ROUNDS,
     MISSION_TEMPLATES, LOGIN_REWARDS, PRESTIGE_CONFIG,
     ACHIEVEMENTS, ACHIEVEMENT_CATEGORIES, TIER_INFO, TERRITORY_ATTACK_COOLDOWN,
     VIP_PACKAGES, CASH_PACKAGES, CASE_PACKAGES, TON_PRICES,
@@ -49,12 +61,14 @@ from backend.game_config import (
 )
 from backend.game_logic import (
     calc_total_income, calc_offline_earnings, attempt_robbery,
-    get_buy_cost, calc_manager_cost, get_player_level,
+    get_bulk_buy_cost, max_affordable_levels, calc_manager_cost, get_player_level,
 )
 
 BOT_TOKEN = os.environ["BOT_TOKEN"].strip()
 ADMIN_SECRET = os.environ.get("ADMIN_SECRET", "")
 
+logger = logging.getLogger(__name__)
+
 
 TELEGRAM_PUBLIC_KEY = Ed25519PublicKey.from_public_bytes(
     bytes.fromhex("e7bf03a2fa4602af4580703d88dda5bb59f32ed8b02a56c187fe7d34caed242d")
@@ -87,10 +101,24 @@ def validate_init_data(init_data: str) -> dict | None:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    async with transaction() as db:
+        await leaderboard.load(db)
+        await pvp_index.load(db)
+        await schedule_pending_jobs(db)
+    notifier.start()
+    scheduler.start()
+    ton_indexer.start()
+    idempotency_store.start()
     yield
+    await idempotency_store.stop()
+    await ton_indexer.stop()
+    await scheduler.stop()
+    await notifier.stop()
+    await close_db()
 
 app = FastAPI(title="Shadow Empire", lifespan=lifespan)
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
+app.add_middleware(IdempotencyMiddleware)
 app.add_middleware(CORSMiddleware, allow_origins=ALLOWED_ORIGINS, allow_methods=["*"], allow_headers=["*"])
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
@@ -107,8 +135,7 @@ async def admin_add_cash(req: dict):
     tid = req.get("telegram_id")
     amount = req.get("amount", 0)
     async with get_player_lock(tid):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             # Sync earnings first so we don't lose them
             player = await get_player(db, tid)
             if not player:
@@ -117,25 +144,41 @@ async def admin_add_cash(req: dict):
             await sync_earnings(db, player, owned)
             # Now safely add cash
             await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (amount, tid))
-            await db.commit()
             cursor = await db.execute("SELECT cash FROM players WHERE telegram_id=?", (tid,))
             row = await cursor.fetchone()
             return {"telegram_id": tid, "cash": row["cash"] if row else None}
-        finally:
-            await db.close()
 
 
+@app.post("/api/admin/stats")
+async def admin_stats(req: dict):
+    if not ADMIN_SECRET or req.get("secret") != ADMIN_SECRET:
+        raise HTTPException(403, "Forbidden")
+    return {
+        "notifications": notifier.stats(),
+        "scheduler": scheduler.stats(),
+        "stream": stream_hub.stats(),
+        "cache": player_cache.stats(),
+        "ton_indexer": ton_indexer.stats(),
+        "idempotency": idempotency_store.stats(),
+    }
+
+@app.post("/api/admin/gang-integrity")
+async def admin_gang_integrity(req: dict):
+    """Compare the maintained gang aggregates with a full recount; repair=true fixes drift."""
+    if not ADMIN_SECRET or req.get("secret") != ADMIN_SECRET:
+        raise HTTPException(403, "Forbidden")
+    async with transaction() as db:
+        drift = await check_gang_aggregates(db, repair=bool(req.get("repair")))
+        return {"ok": not drift, "drift": drift}
+
 @app.post("/api/admin/players")
 async def admin_list_players(req: dict):
     if not ADMIN_SECRET or req.get("secret") != ADMIN_SECRET:
         raise HTTPException(403, "Forbidden")
-    db = await get_db()
-    try:
+    async with transaction() as db:
         cursor = await db.execute("SELECT telegram_id, username, cash, prestige_level FROM players ORDER BY created_at DESC LIMIT 50")
         rows = [dict(r) for r in await cursor.fetchall()]
         return {"players": rows}
-    finally:
-        await db.close()
 
 
 @app.post("/api/admin/reset")
@@ -143,20 +186,21 @@ async def admin_reset_player(req: dict):
     if not ADMIN_SECRET or req.get("secret") != ADMIN_SECRET:
         raise HTTPException(403, "Forbidden")
     tid = req.get("telegram_id")
-    db = await get_db()
-    try:
+    async with transaction() as db:
+        player = await get_player(db, tid)
+        if player and player["gang_id"]:
+            await add_member_totals(db, player["gang_id"], player, -1)
         for table in [
             "players", "player_businesses", "player_character", "player_inventory",
             "player_cases", "player_upgrades", "player_achievements", "player_talents",
             "player_skins", "business_equipped_skins", "daily_missions", "daily_login",
-            "player_event_progress", "tournament_scores",
+            "player_event_progress", "tournament_scores", "player_income_profile",
         ]:
             await db.execute(f"DELETE FROM {table} WHERE telegram_id=?", (tid,))
         await db.execute("DELETE FROM gang_members WHERE telegram_id=?", (tid,))
-        await db.commit()
+        db.on_commit(lambda: leaderboard.remove(tid))
+        db.on_commit(lambda: pvp_index.remove(tid))
         return {"status": "ok", "telegram_id": tid}
-    finally:
-        await db.close()
 
 
 # ── Request Models ──
@@ -170,6 +214,8 @@ class PlayerInit(BaseModel):
 class BuyRequest(BaseModel):
     telegram_id: int
     business_id: str
+    count: int = 1
+    max: bool = False
 
 class ManagerRequest(BaseModel):
     telegram_id: int
@@ -188,6 +234,15 @@ class CasinoBetRequest(BaseModel):
     bet: float
     choice: str = ""
 
+class CasinoAutoplayRequest(BaseModel):
+    telegram_id: int
+    game: str
+    bet: float
+    choice: str = ""
+    rounds: int
+    stop_loss: float = 0    # stop once down this much; 0 = off
+    take_profit: float = 0  # stop once up this much; 0 = off
+
 class ShopBuyRequest(BaseModel):
     telegram_id: int
     item_id: str
@@ -239,10 +294,12 @@ class CaseBuyRequest(BaseModel):
 class CaseOpenRequest(BaseModel):
     telegram_id: int
     player_case_id: int
+    count: int = 1  # also open count-1 more cases of the same kind
 
 class CaseSpinRequest(BaseModel):
     telegram_id: int
     case_id: str
+    count: int = 1
 
 class MissionClaimRequest(BaseModel):
     telegram_id: int
@@ -251,6 +308,14 @@ class MissionClaimRequest(BaseModel):
 class LoginClaimRequest(BaseModel):
     telegram_id: int
 
+class BatchAction(BaseModel):
+    action: str
+    params: dict = {}
+
+class BatchRequest(BaseModel):
+    telegram_id: int
+    actions: list[BatchAction]
+
 class PrestigeRequest(BaseModel):
     telegram_id: int
 
@@ -279,7 +344,6 @@ class TonCreateRequest(BaseModel):
 
 class TonVerifyRequest(BaseModel):
     telegram_id: int
-    tx_hash: str
     comment: str = ""
     package_id: str = ""
 
@@ -321,28 +385,50 @@ class NicknameRequest(BaseModel):
 
 # ── Helpers ──
 
-async def get_player(db, telegram_id):
+# Player-state reads go through player_cache (backend/cache.py); the _load_*
+# functions are the SQLite fallbacks on a miss.
+
+async def _load_player(db, telegram_id):
     cursor = await db.execute("SELECT * FROM players WHERE telegram_id = ?", (telegram_id,))
     row = await cursor.fetchone()
     return dict(row) if row else None
 
-async def get_owned_businesses(db, telegram_id):
+async def _load_owned_businesses(db, telegram_id):
     cursor = await db.execute("SELECT * FROM player_businesses WHERE telegram_id = ?", (telegram_id,))
     return [dict(r) for r in await cursor.fetchall()]
 
-async def get_character(db, telegram_id):
+async def _load_character(db, telegram_id):
     cursor = await db.execute("SELECT * FROM player_character WHERE telegram_id = ?", (telegram_id,))
     row = await cursor.fetchone()
     return dict(row) if row else None
 
-async def get_inventory(db, telegram_id):
+async def _load_inventory(db, telegram_id):
     cursor = await db.execute("SELECT * FROM player_inventory WHERE telegram_id = ?", (telegram_id,))
     return [dict(r) for r in await cursor.fetchall()]
 
-async def get_upgrades(db, telegram_id):
+async def _load_upgrades(db, telegram_id):
     cursor = await db.execute("SELECT * FROM player_upgrades WHERE telegram_id = ?", (telegram_id,))
     return [dict(r) for r in await cursor.fetchall()]
 
+async def _load_talents(db, telegram_id):
+    cursor = await db.execute("SELECT talent_id, level FROM player_talents WHERE telegram_id=?", (telegram_id,))
+    return {r["talent_id"]: r["level"] for r in await cursor.fetchall()}
+
+async def get_player(db, telegram_id):
+    return await player_cache.read(db, telegram_id, "players", _load_player)
+
+async def get_owned_businesses(db, telegram_id):
+    return await player_cache.read(db, telegram_id, "player_businesses", _load_owned_businesses)
+
+async def get_character(db, telegram_id):
+    return await player_cache.read(db, telegram_id, "player_character", _load_character)
+
+async def get_inventory(db, telegram_id):
+    return await player_cache.read(db, telegram_id, "player_inventory", _load_inventory)
+
+async def get_upgrades(db, telegram_id):
+    return await player_cache.read(db, telegram_id, "player_upgrades", _load_upgrades)
+
 async def get_player_cases(db, telegram_id):
     cursor = await db.execute("SELECT * FROM player_cases WHERE telegram_id = ?", (telegram_id,))
     return [dict(r) for r in await cursor.fetchall()]
@@ -359,6 +445,12 @@ def is_vip_active(player):
     """Check if player has active VIP status."""
     return bool(player.get("is_vip") and player.get("vip_until", 0) > time.time())
 
+@scheduler.job("vip_expire")
+async def vip_expire_job(db, tid, payload):
+    await db.execute(
+        "UPDATE players SET is_vip=0 WHERE telegram_id=? AND is_vip=1 AND vip_until <= ?", (int(tid), time.time())
+    )
+
 def has_ad_boost(player):
     """Check if player currently has ad income boost."""
     return player.get("ad_boost_until", 0) > time.time()
@@ -380,42 +472,114 @@ def validate_amount(val: float, name: str = "amount"):
         raise HTTPException(400, f"Invalid {name}")
 
 
-async def sync_earnings(db, player, owned):
-    """Sync accumulated earnings before any action — fixes balance bug."""
-    now = time.time()
-    territory_bonus = await get_territory_bonus(db, player.get("gang_id", 0))
-    vip = is_vip_active(player)
-    equip_inc = await get_equip_income_bonus(db, player["telegram_id"])
-    upgrade_inc = await get_upgrade_income_bonus(db, player["telegram_id"])
-    gang_inc, gang_raid_red = 0, 0
-    if player.get("gang_id"):
-        gang_ups = await get_gang_upgrades(db, player["gang_id"])
-        gang_inc = get_gang_income_bonus(gang_ups)
-        gang_raid_red = get_gang_raid_reduction(gang_ups)
-    talents = await get_player_talents(db, player["telegram_id"])
-    tb = get_talent_bonuses(talents)
-    earnings, new_suspicion, was_raided = calc_offline_earnings(
+# ── Earnings accrual ──
+#
+# Cash accrues analytically: the players row holds (cash, suspicion) as of
+# last_collect_ts and the rate follows from the cached businesses and income
+# profile, so the balance "now" needs no write. sync_earnings makes it durable
+# and is required before a spend or anything that changes the rate (for other
+# players' rates — gang upgrades, territory — checkpoint_earnings); reads go
+# through accrued_player and only write when a sync is due — a raid, VIP running
+# out mid-interval (the rate changes), or ACCRUAL_MAX_UNSYNCED seconds without a
+# sync so the offline cap never truncates an active session.
+
+ACCRUAL_MAX_UNSYNCED = int(os.getenv("ACCRUAL_MAX_UNSYNCED", "900"))
+
+
+def preview_earnings(player, owned, profile):
+    """(earnings, new_suspicion, was_raided) if the player synced right now — no writes."""
+    return calc_offline_earnings(
         owned, player["last_collect_ts"], player["suspicion"],
         player["reputation_fear"], player["reputation_respect"],
-        player.get("prestige_multiplier", 1.0), territory_bonus,
-        is_vip=vip, equip_income_bonus=equip_inc, upgrade_income_bonus=upgrade_inc,
-        gang_income_bonus=gang_inc, gang_raid_reduction=gang_raid_red,
-        talent_offline_hours=tb["efficiency"], talent_raid_reduce=tb["evasion"],
-        talent_income_bonus=tb["passive_income"], talent_suspicion_reduce=tb["shadow_talent"],
+        player.get("prestige_multiplier", 1.0), profile["territory_bonus"],
+        is_vip=is_vip_active(player),
+        equip_income_bonus=profile["equip_income_bonus"], upgrade_income_bonus=profile["upgrade_income_bonus"],
+        gang_income_bonus=profile["gang_income_bonus"], gang_raid_reduction=profile["gang_raid_reduction"],
+        talent_offline_hours=profile["talent_offline_hours"], talent_raid_reduce=profile["talent_raid_reduce"],
+        talent_income_bonus=profile["talent_income_bonus"], talent_suspicion_reduce=profile["talent_suspicion_reduce"],
     )
-    new_cash = player["cash"] + earnings
-    await db.execute(
-        "UPDATE players SET cash = ?, suspicion = ?, last_collect_ts = ?, total_earned = total_earned + ? WHERE telegram_id = ?",
-        (new_cash, new_suspicion, now, earnings, player["telegram_id"]),
+
+_SYNC_EARNINGS_SQL = (
+    "UPDATE players SET cash = cash + ?, suspicion = ?, last_collect_ts = ?, total_earned = total_earned + ? "
+    "WHERE telegram_id = ? AND last_collect_ts = ?"
+)
+
+async def sync_earnings(db, player, owned):
+    """Sync accumulated earnings before any action — fixes balance bug.
+
+    The UPDATE only applies while last_collect_ts is still the one that was read.
+    checkpoint_earnings syncs players without holding their lock, so if it got
+    there first the row is re-read (current now: the UPDATE took the writer lock)
+    and the sync recomputed from it."""
+    now = time.time()
+    profile = await get_income_profile(db, player)
+    earnings, new_suspicion, was_raided = preview_earnings(player, owned, profile)
+    cursor = await db.execute(
+        _SYNC_EARNINGS_SQL,
+        (earnings, new_suspicion, now, earnings, player["telegram_id"], player["last_collect_ts"]),
     )
-    await db.commit()
+    if not cursor.rowcount:
+        fresh = await get_player(db, player["telegram_id"])
+        if fresh is None:
+            return player, False
+        player.update(fresh)
+        profile = await get_income_profile(db, player)
+        earnings, new_suspicion, was_raided = preview_earnings(player, owned, profile)
+        await db.execute(
+            _SYNC_EARNINGS_SQL,
+            (earnings, new_suspicion, now, earnings, player["telegram_id"], player["last_collect_ts"]),
+        )
+    new_cash = player["cash"] + earnings
     player["cash"] = new_cash
     player["suspicion"] = new_suspicion
     player["last_collect_ts"] = now
+    if earnings:
+        tid, total = player["telegram_id"], player.get("total_earned", 0) + earnings
+        player["total_earned"] = total
+        db.on_commit(lambda: leaderboard.update(tid, total))
+        if earnings > 0:
+            await track_action(db, tid, "earn_cash", int(earnings))
+            await check_achievements(db, tid, ("total_earned",), player)
     if was_raided:
         await notify_player(db, player["telegram_id"], "🚔 Полиция провела рейд! Потеряно 30% офлайн-дохода. Снижай подозрение!")
     return player, was_raided
 
+def accrued_player(player, owned, profile):
+    """(player as of now, sync_due) computed from the stored row without writing."""
+    now = time.time()
+    earnings, suspicion, was_raided = preview_earnings(player, owned, profile)
+    view = dict(player, cash=player["cash"] + earnings, suspicion=suspicion,
+                total_earned=player.get("total_earned", 0) + earnings)
+    last_ts = player["last_collect_ts"]
+    due = (
+        was_raided
+        or now - last_ts >= ACCRUAL_MAX_UNSYNCED
+        or last_ts < (player.get("vip_until") or 0) <= now
+    )
+    return view, due
+
+async def accrue_earnings(db, player, owned):
+    """Like sync_earnings, but only writes when a sync is due. Returns (player, was_raided)."""
+    profile = await get_income_profile(db, player)
+    view, due = accrued_player(player, owned, profile)
+    if due:
+        return await sync_earnings(db, player, owned)
+    return view, False
+
+async def checkpoint_earnings(db, telegram_ids):
+    """Sync other players' earnings at their current rate, before a change to it
+    (gang upgrade, territory, membership) is written, so the new rate only counts
+    from now on instead of back to their last sync."""
+    for tid in telegram_ids:
+        player = await get_player(db, tid)
+        if player:
+            await sync_earnings(db, player, await get_owned_businesses(db, tid))
+
+async def checkpoint_gang_earnings(db, gang_id):
+    if gang_id:
+        cursor = await db.execute("SELECT telegram_id FROM gang_members WHERE gang_id=?", (gang_id,))
+        await checkpoint_earnings(db, [r["telegram_id"] for r in await cursor.fetchall()])
+
 def make_referral_code(telegram_id):
     return hashlib.md5(f"shadow_{telegram_id}".encode()).hexdigest()[:8]
 
@@ -435,15 +599,13 @@ async def get_equip_income_bonus(db, telegram_id):
 
 async def get_upgrade_income_bonus(db, telegram_id):
     """Total income % bonus from laundering_boost upgrades (10% each level)."""
-    cursor = await db.execute("SELECT level FROM player_upgrades WHERE telegram_id=? AND upgrade_id='laundering_boost'", (telegram_id,))
-    row = await cursor.fetchone()
-    if row:
-        return row["level"] * 10
+    for up in await get_upgrades(db, telegram_id):
+        if up["upgrade_id"] == "laundering_boost":
+            return up["level"] * 10
     return 0
 
 async def get_player_talents(db, telegram_id):
-    cursor = await db.execute("SELECT talent_id, level FROM player_talents WHERE telegram_id=?", (telegram_id,))
-    return {r["talent_id"]: r["level"] for r in await cursor.fetchall()}
+    return await player_cache.read(db, telegram_id, "player_talents", _load_talents)
 
 def get_talent_effect(talents, talent_id, per_level):
     return talents.get(talent_id, 0) * per_level
@@ -465,6 +627,88 @@ def get_talent_bonuses(talents):
         "shadow_talent": get_talent_effect(talents, "shadow_talent", 5),
     }
 
+
+# ── Income profile ──
+#
+# Every income multiplier except the ones read off the players row (reputation,
+# prestige, VIP, ad boost), materialized in player_income_profile and cached
+# with the player. Anything that changes an input must invalidate it:
+# equip, laundering upgrade, talents, prestige, gang membership, gang
+# upgrades and territory ownership.
+
+async def build_income_profile(db, telegram_id):
+    player = await get_player(db, telegram_id)
+    gang_id = (player or {}).get("gang_id") or 0
+    tb = get_talent_bonuses(await get_player_talents(db, telegram_id))
+    gang_ups = await get_gang_upgrades(db, gang_id) if gang_id else {}
+    return {
+        "telegram_id": telegram_id,
+        "gang_id": gang_id,
+        "territory_bonus": await get_territory_bonus(db, gang_id),
+        "equip_income_bonus": await get_equip_income_bonus(db, telegram_id),
+        "upgrade_income_bonus": await get_upgrade_income_bonus(db, telegram_id),
+        "gang_income_bonus": get_gang_income_bonus(gang_ups),
+        "gang_raid_reduction": get_gang_raid_reduction(gang_ups),
+        "talent_income_bonus": tb["passive_income"],
+        "talent_suspicion_reduce": tb["shadow_talent"],
+        "talent_offline_hours": tb["efficiency"],
+        "talent_raid_reduce": tb["evasion"],
+        "updated_at": time.time(),
+    }
+
+async def _load_income_profile(db, telegram_id):
+    """The stored profile row, or None (cached either way)."""
+    cursor = await db.execute("SELECT * FROM player_income_profile WHERE telegram_id=?", (telegram_id,))
+    row = await cursor.fetchone()
+    return dict(row) if row else None
+
+async def get_income_profile(db, player, persist=True):
+    """The player's income profile, rebuilt and stored if missing or stale.
+
+    With persist=False (lock-free read paths) a missing or stale profile is
+    built in memory only, so the read never writes."""
+    tid = player["telegram_id"]
+    profile = await player_cache.read(db, tid, "player_income_profile", _load_income_profile)
+    if profile is not None and profile["gang_id"] == (player.get("gang_id") or 0):
+        return profile
+    if not persist:
+        return await build_income_profile(db, tid)
+    # The DELETE takes the writer lock first, so no invalidation can commit
+    # between reading the inputs and storing the rebuilt row.
+    await invalidate_income_profile(db, tid)
+    profile = await build_income_profile(db, tid)
+    await db.execute(
+        f"INSERT INTO player_income_profile ({', '.join(profile)}) VALUES ({', '.join('?' * len(profile))})",
+        tuple(profile.values()),
+    )
+    return await player_cache.read(db, tid, "player_income_profile", _load_income_profile)
+
+async def invalidate_income_profile(db, telegram_id):
+    await db.execute("DELETE FROM player_income_profile WHERE telegram_id=?", (telegram_id,))
+
+async def invalidate_gang_income_profiles(db, gang_id):
+    """Territory and gang-upgrade bonuses changed for every member of gang_id.
+
+    Deleted per telegram_id so only those players' cached profiles are evicted.
+    Callers have already written the change, so the writer lock is held and no
+    profile can be rebuilt between the SELECT and the DELETE."""
+    if gang_id:
+        cursor = await db.execute("SELECT telegram_id FROM player_income_profile WHERE gang_id=?", (gang_id,))
+        tids = [(r["telegram_id"],) for r in await cursor.fetchall()]
+        await db.executemany("DELETE FROM player_income_profile WHERE telegram_id=?", tids)
+
+def calc_player_income(player, owned, profile, equip_bonus=0, fear_bonus=0, respect_bonus=0):
+    """(income_per_sec, suspicion_per_sec) right now — VIP, ad boost and weekly event applied."""
+    return calc_total_income(
+        owned, player["reputation_fear"] + fear_bonus, player["reputation_respect"] + respect_bonus,
+        player.get("prestige_multiplier", 1.0), profile["territory_bonus"],
+        vip_multiplier=2.0 if is_vip_active(player) else 1.0, ad_boost=has_ad_boost(player),
+        equip_income_bonus=profile["equip_income_bonus"] + equip_bonus,
+        upgrade_income_bonus=profile["upgrade_income_bonus"],
+        gang_income_bonus=profile["gang_income_bonus"], event_income_multiplier=get_event_income_multiplier(),
+        talent_income_bonus=profile["talent_income_bonus"], talent_suspicion_reduce=profile["talent_suspicion_reduce"],
+    )
+
 def today_utc():
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
@@ -486,32 +730,35 @@ async def generate_daily_missions(db, tid):
             "INSERT OR IGNORE INTO daily_missions (telegram_id, mission_id, target, reward, day) VALUES (?,?,?,?,?)",
             (tid, m["id"], m["target"], m["reward"], day),
         )
-    await db.commit()
 
 async def get_daily_missions(db, tid):
     day = today_utc()
     cursor = await db.execute("SELECT * FROM daily_missions WHERE telegram_id=? AND day=?", (tid, day))
     return [dict(r) for r in await cursor.fetchall()]
 
-async def advance_mission(db, tid, mission_type, amount=1):
-    """Advance progress on matching missions for today."""
-    day = today_utc()
-    cursor = await db.execute(
-        "SELECT * FROM daily_missions WHERE telegram_id=? AND day=? AND completed=0",
-        (tid, day),
-    )
-    missions = [dict(r) for r in await cursor.fetchall()]
-    for m in missions:
-        tmpl = next((t for t in MISSION_TEMPLATES if t["id"] == m["mission_id"]), None)
-        if not tmpl or tmpl["type"] != mission_type:
-            continue
-        new_progress = min(m["progress"] + amount, m["target"])
-        completed = 1 if new_progress >= m["target"] else 0
-        await db.execute(
-            "UPDATE daily_missions SET progress=?, completed=? WHERE id=?",
-            (new_progress, completed, m["id"]),
+def _index_mission_templates():
+    """mission type -> (advance_mission UPDATE, template ids), built once at import."""
+    ids_by_type = {}
+    for t in MISSION_TEMPLATES:
+        ids_by_type.setdefault(t["type"], []).append(t["id"])
+    return {
+        mission_type: (
+            "UPDATE daily_missions SET progress=MIN(progress+?, target), completed=(progress+? >= target) "
+            f"WHERE telegram_id=? AND day=? AND completed=0 AND mission_id IN ({','.join('?' * len(ids))})",
+            tuple(ids),
         )
-    await db.commit()
+        for mission_type, ids in ids_by_type.items()
+    }
+
+MISSIONS_BY_TYPE = _index_mission_templates()
+
+async def advance_mission(db, tid, mission_type, amount=1):
+    """Advance progress on matching missions for today — one UPDATE, no reads."""
+    entry = MISSIONS_BY_TYPE.get(mission_type)
+    if not entry:
+        return
+    sql, ids = entry
+    await db.execute(sql, (amount, amount, tid, today_utc(), *ids))
 
 
 # ── Daily Login ──
@@ -524,7 +771,6 @@ async def check_login_streak(db, tid):
     row = await cursor.fetchone()
     if not row:
         await db.execute("INSERT INTO daily_login (telegram_id, streak, last_claim_date) VALUES (?,0,'')", (tid,))
-        await db.commit()
         return {"can_claim": True, "streak": 0, "reward_day": 1}
 
     row = dict(row)
@@ -546,74 +792,93 @@ async def check_login_streak(db, tid):
 
 # ── Achievements ──
 
-async def check_achievements(db, tid):
-    """Check and unlock new achievements."""
-    player = await get_player(db, tid)
-    if not player:
+# Per field, achievements sorted by target. Unlocks are monotonic, so a field
+# only ever needs its lowest not-yet-unlocked target compared with its value.
+ACHIEVEMENTS_BY_FIELD: dict[str, list] = {}
+for _ach in sorted(ACHIEVEMENTS, key=lambda a: a["target"]):
+    ACHIEVEMENTS_BY_FIELD.setdefault(_ach["field"], []).append(_ach)
+
+# Fields that need a COUNT query. check_achievements skips them by default;
+# the mutations that change them (skin opens, territory captures, joining a
+# gang) and the achievements screen ask for them explicitly.
+COUNTED_ACHIEVEMENT_FIELDS = ("skins_count", "gang_territories")
+CACHED_ACHIEVEMENT_FIELDS = tuple(f for f in ACHIEVEMENTS_BY_FIELD if f not in COUNTED_ACHIEVEMENT_FIELDS)
+
+async def _achievement_values(db, tid, player, fields):
+    """Current value of each requested achievement field."""
+    values = {}
+    if "level" in fields:
+        values["level"] = get_player_level(await get_owned_businesses(db, tid))
+    if "inventory_count" in fields or "legendary_count" in fields:
+        inventory = await get_inventory(db, tid)
+        values["inventory_count"] = len(inventory)
+        values["legendary_count"] = sum(1 for i in inventory if SHOP_ITEMS.get(i["item_id"], {}).get("rarity") == "legendary")
+    if "skins_count" in fields:
+        cursor = await db.execute("SELECT COUNT(*) as cnt FROM player_skins WHERE telegram_id=?", (tid,))
+        values["skins_count"] = (await cursor.fetchone())["cnt"]
+    if "gang_territories" in fields:
+        values["gang_territories"] = 0
+        if player.get("gang_id"):
+            cursor = await db.execute("SELECT COUNT(*) as cnt FROM territories WHERE owner_gang_id=?", (player["gang_id"],))
+            values["gang_territories"] = (await cursor.fetchone())["cnt"]
+    if "gang_id" in fields:
+        values["gang_id"] = 1 if (player.get("gang_id") or 0) > 0 else 0
+    for field in fields:
+        if field not in values:
+            values[field] = player.get(field, 0) or 0
+    return values
+
+async def check_achievements(db, tid, fields=None, player=None):
+    """Unlock newly reached achievements.
+
+    fields limits the check (default: every field readable from cached rows).
+    Each field only tests its next unmet target, and fields with nothing left
+    to unlock are skipped, so a player with nothing new costs no queries.
+    Mutations pass the fields they changed, and the player row if they hold a
+    current copy.
+    """
+    if player is None:
+        player = await get_player(db, tid)
+        if not player:
+            return
+    unlocked = {a["achievement_id"] for a in await get_player_achievements(db, tid)}
+    next_target = {}
+    for field in fields or CACHED_ACHIEVEMENT_FIELDS:
+        ach = next((a for a in ACHIEVEMENTS_BY_FIELD.get(field, ()) if a["id"] not in unlocked), None)
+        if ach:
+            next_target[field] = ach["target"]
+    if not next_target:
         return
-    owned = await get_owned_businesses(db, tid)
-    inventory = await get_inventory(db, tid)
-    player_level = get_player_level(owned)
-
-    inventory_count = len(inventory)
-    legendary_count = sum(1 for i in inventory if SHOP_ITEMS.get(i["item_id"], {}).get("rarity") == "legendary")
-
-    # Count skins
-    cursor = await db.execute("SELECT COUNT(*) as cnt FROM player_skins WHERE telegram_id=?", (tid,))
-    skins_row = await cursor.fetchone()
-    skins_count = skins_row["cnt"] if skins_row else 0
-
-    # Count market sales
-    market_sales = player.get("market_sales", 0)
-
-    # Casino stats
-    casino_plays = player.get("casino_plays", 0)
-    casino_wins = player.get("casino_wins", 0)
-
-    # Gang territories
-    gang_territories = 0
-    if player.get("gang_id"):
-        cursor = await db.execute("SELECT COUNT(*) as cnt FROM territories WHERE owner_gang_id=?", (player["gang_id"],))
-        t_row = await cursor.fetchone()
-        gang_territories = t_row["cnt"] if t_row else 0
-
-    values = {
-        "total_robberies": player.get("total_robberies", 0),
-        "total_earned": player.get("total_earned", 0),
-        "level": player_level,
-        "inventory_count": inventory_count,
-        "legendary_count": legendary_count,
-        "gang_id": 1 if player.get("gang_id", 0) > 0 else 0,
-        "gang_territories": gang_territories,
-        "prestige_level": player.get("prestige_level", 0),
-        "pvp_wins": player.get("pvp_wins", 0),
-        "casino_plays": casino_plays,
-        "casino_wins": casino_wins,
-        "skins_count": skins_count,
-        "market_sales": market_sales,
-        "tournament_top10": player.get("tournament_top10", 0),
-        "tournament_top3": player.get("tournament_top3", 0),
-    }
-
-    # Get existing achievements to detect new ones
-    cursor_existing = await db.execute("SELECT achievement_id FROM player_achievements WHERE telegram_id=?", (tid,))
-    existing_ids = {r["achievement_id"] for r in await cursor_existing.fetchall()}
 
-    for ach in ACHIEVEMENTS:
-        field_val = values.get(ach["field"], 0)
-        if field_val >= ach["target"]:
-            if ach["id"] not in existing_ids:
-                await notify_player(db, tid, f"🏆 Достижение разблокировано: {ach['name']}!")
+    values = await _achievement_values(db, tid, player, next_target)
+    for field, target in next_target.items():
+        value = values[field]
+        if value < target:
+            continue
+        for ach in ACHIEVEMENTS_BY_FIELD[field]:
+            if ach["target"] > value:
+                break
+            if ach["id"] in unlocked:
+                continue
+            await notify_player(db, tid, f"🏆 Достижение разблокировано: {ach['name']}!")
             await db.execute(
                 "INSERT OR IGNORE INTO player_achievements (telegram_id, achievement_id) VALUES (?,?)",
                 (tid, ach["id"]),
             )
-    await db.commit()
 
-async def get_player_achievements(db, tid):
+async def check_gang_achievements(db, gang_id, fields=("gang_territories",)):
+    """Re-check gang-wide fields for every member (e.g. after a territory changes hands)."""
+    cursor = await db.execute("SELECT telegram_id FROM gang_members WHERE gang_id=?", (gang_id,))
+    for row in await cursor.fetchall():
+        await check_achievements(db, row["telegram_id"], fields)
+
+async def _load_achievements(db, tid):
     cursor = await db.execute("SELECT * FROM player_achievements WHERE telegram_id=?", (tid,))
     return [dict(r) for r in await cursor.fetchall()]
 
+async def get_player_achievements(db, tid):
+    return await player_cache.read(db, tid, "player_achievements", _load_achievements)
+
 
 # ── Tournament (Daily) ──
 
@@ -621,55 +886,82 @@ async def advance_tournament(db, tid, event_type, amount=1):
     score = TOURNAMENT_SCORE_EVENTS.get(event_type, 0) * amount
     if score <= 0:
         return
-    day = today_utc()
     await db.execute(
         "INSERT INTO tournament_scores (telegram_id, day, score) VALUES (?,?,?) "
         "ON CONFLICT(telegram_id, day) DO UPDATE SET score=score+?",
-        (tid, day, score, score),
+        (tid, today_utc(), score, score),
     )
-    await db.commit()
 
-async def check_and_distribute_tournament_prizes(db, tid):
-    """Check yesterday's tournament and distribute prizes if not claimed."""
-    yest = yesterday_utc()
-    cursor = await db.execute(
-        "SELECT id FROM tournament_prizes_log WHERE telegram_id=? AND day=?", (tid, yest)
-    )
-    if await cursor.fetchone():
-        return None  # already claimed
+async def get_tournament_score(db, tid, day):
+    cursor = await db.execute("SELECT score FROM tournament_scores WHERE telegram_id=? AND day=?", (tid, day))
+    row = await cursor.fetchone()
+    return row["score"] if row else 0
 
+async def get_tournament_top(db, day, limit):
+    """[(telegram_id, score)] best first."""
     cursor = await db.execute(
-        "SELECT telegram_id, score FROM tournament_scores WHERE day=? ORDER BY score DESC LIMIT 10",
-        (yest,),
+        "SELECT telegram_id, score FROM tournament_scores WHERE day=? ORDER BY score DESC LIMIT ?",
+        (day, limit),
     )
-    rows = await cursor.fetchall()
-    place = 0
-    for i, r in enumerate(rows):
-        if r["telegram_id"] == tid:
-            place = i + 1
-            break
-    if place == 0 or place > len(TOURNAMENT_PRIZES):
-        return None
+    return [(r["telegram_id"], r["score"]) for r in await cursor.fetchall()]
 
-    prize = TOURNAMENT_PRIZES[place - 1]
-    await db.execute(
-        "UPDATE players SET cash=cash+? WHERE telegram_id=?", (prize["cash"], tid)
-    )
-    for _ in range(prize.get("cases", 0)):
+# Seconds past UTC midnight before settling, so actions begun before midnight commit first
+TOURNAMENT_SETTLE_DELAY = float(os.getenv("TOURNAMENT_SETTLE_DELAY", "5"))
+
+async def schedule_tournament_settlement(db, day):
+    """Settle day shortly after the following UTC midnight."""
+    end = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+    await scheduler.schedule(db, "tournament_settle", day, end.timestamp() + TOURNAMENT_SETTLE_DELAY)
+
+async def settle_tournament(db, day):
+    """Pay out day's prizes. Returns the number of winners, or None if already settled."""
+    cursor = await db.execute("INSERT OR IGNORE INTO tournament_settlements (day) VALUES (?)", (day,))
+    if not cursor.rowcount:
+        return None
+    winners = []
+    for place, (tid, _) in enumerate(await get_tournament_top(db, day, len(TOURNAMENT_PRIZES)), 1):
+        prize = TOURNAMENT_PRIZES[place - 1]
+        # Already paid by the old claim-on-login path (idx_tournament_prizes_dedup may be missing)
+        cursor = await db.execute("SELECT 1 FROM tournament_prizes_log WHERE telegram_id=? AND day=?", (tid, day))
+        if await cursor.fetchone():
+            continue
         await db.execute(
-            "INSERT INTO player_cases (telegram_id, case_id) VALUES (?, 'case_premium')", (tid,)
+            "INSERT INTO tournament_prizes_log (telegram_id, day, place, cash_prize, cases_prize, notified) VALUES (?,?,?,?,?,0)",
+            (tid, day, place, prize["cash"], prize.get("cases", 0)),
         )
-    await db.execute(
-        "INSERT OR IGNORE INTO tournament_prizes_log (telegram_id, day, place, cash_prize, cases_prize) VALUES (?,?,?,?,?)",
-        (tid, yest, place, prize["cash"], prize.get("cases", 0)),
+        winners.append((tid, place, prize))
+
+    await db.executemany(
+        "UPDATE players SET cash=cash+?, tournament_top10=tournament_top10+?, tournament_top3=tournament_top3+? WHERE telegram_id=?",
+        [(prize["cash"], int(place <= 10), int(place <= 3), tid) for tid, place, prize in winners],
+    )
+    await db.executemany(
+        "INSERT INTO player_cases (telegram_id, case_id) VALUES (?, 'case_premium')",
+        [(tid,) for tid, _, prize in winners for _ in range(prize.get("cases", 0))],
     )
-    # Track for achievements
-    if place <= 10:
-        await db.execute("UPDATE players SET tournament_top10=tournament_top10+1 WHERE telegram_id=?", (tid,))
-    if place <= 3:
-        await db.execute("UPDATE players SET tournament_top3=tournament_top3+1 WHERE telegram_id=?", (tid,))
-    await db.commit()
-    return {"place": place, "prize": prize}
+    await db.execute("UPDATE tournament_settlements SET winners=? WHERE day=?", (len(winners), day))
+    for tid, place, prize in winners:
+        await notify_player(db, tid, f"🏆 Турнир {day}: {place} место! +${prize['cash']:,}")
+    logger.info("Tournament %s settled: %d winners", day, len(winners))
+    return len(winners)
+
+@scheduler.job("tournament_settle")
+async def tournament_settle_job(db, day, payload):
+    await settle_tournament(db, day)
+    next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    await schedule_tournament_settlement(db, next_day)
+
+async def take_tournament_prize_notice(db, tid):
+    """Latest settled prize not yet shown to tid (the /api/init popup), marked shown."""
+    cursor = await db.execute(
+        "SELECT day, place FROM tournament_prizes_log WHERE telegram_id=? AND notified=0 ORDER BY day DESC LIMIT 1",
+        (tid,),
+    )
+    row = await cursor.fetchone()
+    if not row:
+        return None
+    await db.execute("UPDATE tournament_prizes_log SET notified=1 WHERE telegram_id=? AND notified=0", (tid,))
+    return {"day": row["day"], "place": row["place"], "prize": TOURNAMENT_PRIZES[row["place"] - 1]}
 
 
 # ── Seasonal Events ──
@@ -692,7 +984,6 @@ async def advance_event(db, tid, event_type, amount=1):
         "ON CONFLICT(telegram_id, event_id) DO UPDATE SET progress=progress+?",
         (tid, ev["id"], score, score),
     )
-    await db.commit()
 
 async def get_event_progress(db, tid, event_id):
     cursor = await db.execute(
@@ -728,7 +1019,6 @@ async def advance_season_pass(db, tid, action_type, amount=1):
         "ON CONFLICT(telegram_id) DO UPDATE SET xp=xp+?",
         (tid, season_id, xp, xp),
     )
-    await db.commit()
 
 def get_active_weekly_event():
     """Get the active weekly event based on current day of week (Mon=0, Sun=6)."""
@@ -791,44 +1081,57 @@ async def spawn_boss_for_gang(db, gang_id):
     boss_index = ((last["boss_index"] + 1) if last else 0) % len(BOSSES)
     boss = BOSSES[boss_index]
     # Scale HP by gang member count
-    cursor = await db.execute("SELECT COUNT(*) as cnt FROM gang_members WHERE gang_id=?", (gang_id,))
-    members = (await cursor.fetchone())["cnt"]
+    cursor = await db.execute("SELECT member_count FROM gangs WHERE id=?", (gang_id,))
+    gang = await cursor.fetchone()
+    members = gang["member_count"] if gang else 0
     max_hp = boss["base_hp"] + boss["hp_per_gang_level"] * members
     await db.execute(
         "INSERT OR REPLACE INTO active_bosses (gang_id, boss_id, current_health, max_health, defeated, boss_index) VALUES (?,?,?,?,0,?)",
         (gang_id, boss["id"], max_hp, max_hp, boss_index),
     )
-    await db.commit()
     return {"gang_id": gang_id, "boss_id": boss["id"], "current_health": max_hp, "max_health": max_hp, "defeated": 0, "boss_index": boss_index}
 
+@scheduler.job("boss_spawn")
+async def boss_spawn_job(db, gang_id, payload):
+    cursor = await db.execute("SELECT id FROM gangs WHERE id=?", (int(gang_id),))
+    if await cursor.fetchone():
+        await spawn_boss_for_gang(db, int(gang_id))
+
 def calc_attack_damage(player_level, fear, equip_bonus=0, armory_bonus=0):
     base = 50 + player_level * 5 + fear * 2 + equip_bonus + armory_bonus
     variance = random.uniform(0.8, 1.2)
     return round(base * variance)
 
+async def add_boss_damage(db, gang_id, damage):
+    """Take damage off the gang's live boss in one statement. Returns the updated
+    row, or None if there is no live boss. Exactly one attacker sees defeated=1."""
+    cursor = await db.execute(
+        "UPDATE active_bosses SET current_health=MAX(0, current_health-?), defeated=(current_health<=?) "
+        "WHERE gang_id=? AND defeated=0 RETURNING boss_id, current_health, defeated",
+        (damage, damage, gang_id),
+    )
+    row = await cursor.fetchone()
+    return dict(row) if row else None
+
 async def distribute_boss_rewards(db, gang_id, boss_id):
     boss_cfg = next((b for b in BOSSES if b["id"] == boss_id), None)
-    if not boss_cfg:
-        return
     cursor = await db.execute(
-        "SELECT telegram_id, SUM(damage) as total_dmg FROM boss_attack_log WHERE gang_id=? GROUP BY telegram_id",
-        (gang_id,),
+        "DELETE FROM boss_damage WHERE gang_id=? AND boss_id=? RETURNING telegram_id, damage",
+        (gang_id, boss_id),
     )
     attackers = [dict(r) for r in await cursor.fetchall()]
-    total_dmg = sum(a["total_dmg"] for a in attackers)
-    if total_dmg <= 0:
+    total_dmg = sum(a["damage"] for a in attackers)
+    if not boss_cfg or total_dmg <= 0:
         return
-    for a in attackers:
-        share = a["total_dmg"] / total_dmg
-        cash_reward = round(boss_cfg["reward_pool"] * share)
-        await db.execute("UPDATE players SET cash=cash+?, bosses_killed=bosses_killed+1 WHERE telegram_id=?", (cash_reward, a["telegram_id"]))
-        await db.execute(
-            "INSERT INTO boss_rewards_log (gang_id, boss_id, telegram_id, cash_reward) VALUES (?,?,?,?)",
-            (gang_id, boss_id, a["telegram_id"], cash_reward),
-        )
-    # Clear attack log for this gang
-    await db.execute("DELETE FROM boss_attack_log WHERE gang_id=?", (gang_id,))
-    await db.commit()
+    payouts = [(a["telegram_id"], round(boss_cfg["reward_pool"] * a["damage"] / total_dmg)) for a in attackers]
+    await db.executemany(
+        "UPDATE players SET cash=cash+?, bosses_killed=bosses_killed+1 WHERE telegram_id=?",
+        [(cash, tid) for tid, cash in payouts],
+    )
+    await db.executemany(
+        "INSERT INTO boss_rewards_log (gang_id, boss_id, telegram_id, cash_reward) VALUES (?,?,?,?)",
+        [(gang_id, boss_id, tid, cash) for tid, cash in payouts],
+    )
 
 async def get_boss_data(db, gang_id):
     cursor = await db.execute("SELECT * FROM active_bosses WHERE gang_id=? AND defeated=0", (gang_id,))
@@ -841,12 +1144,12 @@ async def get_boss_data(db, gang_id):
         boss_data["name"] = boss_cfg["name"]
         boss_data["emoji"] = boss_cfg["emoji"]
         boss_data["reward_pool"] = boss_cfg["reward_pool"]
-    # Get attack log
+    # Top attackers straight off the (gang_id, boss_id, damage DESC) index
     cursor = await db.execute(
-        "SELECT bal.telegram_id, p.username, SUM(bal.damage) as total_dmg "
-        "FROM boss_attack_log bal JOIN players p ON p.telegram_id=bal.telegram_id "
-        "WHERE bal.gang_id=? GROUP BY bal.telegram_id ORDER BY total_dmg DESC LIMIT 20",
-        (gang_id,),
+        "SELECT bd.telegram_id, p.username, bd.damage as total_dmg "
+        "FROM boss_damage bd JOIN players p ON p.telegram_id=bd.telegram_id "
+        "WHERE bd.gang_id=? AND bd.boss_id=? ORDER BY bd.damage DESC LIMIT 20",
+        (gang_id, boss_data["boss_id"]),
     )
     boss_data["attackers"] = [dict(r) for r in await cursor.fetchall()]
     return boss_data
@@ -855,13 +1158,80 @@ async def get_boss_data(db, gang_id):
 # ── Unified Action Tracker ──
 
 async def track_action(db, tid, action_type, amount=1):
-    """Central tracker — advances missions, tournament, events, and season pass."""
+    """Central tracker — advances missions, tournament, events, and season pass.
+
+    Runs in the caller's transaction and never commits. Each advance_* looks its
+    delta up in memory first and issues at most one set-based statement, so an
+    action nothing listens to costs no SQL at all.
+    """
     await advance_mission(db, tid, action_type, amount)
     await advance_tournament(db, tid, action_type, amount)
     await advance_event(db, tid, action_type, amount)
     await advance_season_pass(db, tid, action_type, amount)
 
 
+# ── Static Config ──
+#
+# Everything the client needs that only changes with a deploy. Served once per
+# version from /api/config; /api/init only carries config_version.
+
+STATIC_CONFIG = {
+    "legal_businesses": LEGAL_BUSINESSES,
+    "shadow_businesses": SHADOW_BUSINESSES,
+    "robberies": ROBBERIES,
+    "casino_games": CASINO_GAMES,
+    "shop_items": SHOP_ITEMS,
+    "upgrades_config": UPGRADES,
+    "cases_config": CASES,
+    "rarities": RARITIES,
+    "login_rewards": LOGIN_REWARDS,
+    "achievements_config": ACHIEVEMENTS,
+    "prestige_config": PRESTIGE_CONFIG,
+    "vip_packages": VIP_PACKAGES,
+    "cash_packages": CASH_PACKAGES,
+    "case_packages": CASE_PACKAGES,
+    "ton_prices": TON_PRICES,
+    "vip_items": VIP_ITEMS,
+    "skins_config": BUSINESS_SKINS,
+    "skin_rarities": SKIN_RARITIES,
+    "skin_case": SKIN_CASE,
+    "skin_case_vip": SKIN_CASE_VIP,
+    "achievement_categories": ACHIEVEMENT_CATEGORIES,
+    "tier_info": TIER_INFO,
+    "talent_tree_config": TALENT_TREE,
+    "gang_war_config": GANG_WAR_CONFIG,
+    "season_pass_config": SEASON_PASS_CONFIG,
+    "season_pass_rewards": SEASON_PASS_REWARDS,
+    "ranks_config": RANKS,
+    "bribe_config": BRIBE_CONFIG,
+    "bounty_config": BOUNTY_CONFIG,
+    "item_sets": ITEM_SETS,
+    "trade_up_config": TRADE_UP_CONFIG,
+}
+
+def _encode_config(config):
+    return json.dumps(config, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+CONFIG_VERSION = hashlib.sha256(_encode_config(STATIC_CONFIG)).hexdigest()[:16]
+CONFIG_BODY = _encode_config({"version": CONFIG_VERSION, **STATIC_CONFIG})
+CONFIG_ETAG = f'"{CONFIG_VERSION}"'
+
+
+@app.get("/api/config")
+async def get_config(request: Request, v: str = ""):
+    """Static game config. `?v=<config_version>` URLs never change, so they are cached for a year."""
+    if v == CONFIG_VERSION:
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        # Unversioned or stale URL — let caches keep it but revalidate every time
+        cache_control = "public, no-cache"
+    headers = {"ETag": CONFIG_ETAG, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or CONFIG_ETAG in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=CONFIG_BODY, media_type="application/json", headers=headers)
+
+
 # ── Player Init ──
 
 @app.post("/api/init")
@@ -871,8 +1241,7 @@ async def player_init(req: PlayerInit):
         user = validate_init_data(req.init_data)
         if not user or user.get("id") != req.telegram_id:
             raise HTTPException(403, "Invalid initData")
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player:
             ref_code = f"ref_{req.telegram_id}"
@@ -880,6 +1249,7 @@ async def player_init(req: PlayerInit):
                 "INSERT INTO players (telegram_id, username, last_collect_ts, referral_code) VALUES (?, ?, ?, ?)",
                 (req.telegram_id, req.username, time.time(), ref_code),
             )
+            db.on_commit(lambda: leaderboard.update(req.telegram_id, 0.0))
             await db.execute(
                 "INSERT INTO player_character (telegram_id) VALUES (?)", (req.telegram_id,)
             )
@@ -912,38 +1282,26 @@ async def player_init(req: PlayerInit):
                             "UPDATE players SET cash = cash + ? WHERE telegram_id = ?",
                             (REFERRAL_BONUS, referrer_id),
                         )
-            await db.commit()
             player = await get_player(db, req.telegram_id)
 
         owned = await get_owned_businesses(db, req.telegram_id)
-        player, was_raided = await sync_earnings(db, player, owned)
+        player, was_raided = await accrue_earnings(db, player, owned)
 
         character = await get_character(db, req.telegram_id)
         inventory = await get_inventory(db, req.telegram_id)
         upgrades = await get_upgrades(db, req.telegram_id)
         player_cases = await get_player_cases(db, req.telegram_id)
-        territory_bonus = await get_territory_bonus(db, player.get("gang_id", 0))
+        profile = await get_income_profile(db, player)
+        territory_bonus = profile["territory_bonus"]
 
         # VIP status
         vip = is_vip_active(player)
-        vip_mult = 2.0 if vip else 1.0
-        ad_boost = has_ad_boost(player)
 
-        # Auto-expire VIP
+        # Lapsed VIP (the vip_expire job clears the stored flag)
         if player.get("is_vip") and not vip:
-            await db.execute("UPDATE players SET is_vip=0 WHERE telegram_id=?", (req.telegram_id,))
-            await db.commit()
             player["is_vip"] = 0
 
-        equip_inc = await get_equip_income_bonus(db, req.telegram_id)
-        upgrade_inc = await get_upgrade_income_bonus(db, req.telegram_id)
-        gang_inc = 0
-        if player.get("gang_id"):
-            gang_ups = await get_gang_upgrades(db, player["gang_id"])
-            gang_inc = get_gang_income_bonus(gang_ups)
-        event_mult = get_event_income_multiplier()
         talents = await get_player_talents(db, req.telegram_id)
-        tb = get_talent_bonuses(talents)
 
         # Item set bonuses
         set_income_bonus = 0
@@ -960,13 +1318,9 @@ async def player_init(req: PlayerInit):
                 elif cfg["bonus_type"] == "respect":
                     set_respect_bonus += cfg["bonus_value"]
 
-        income_per_sec, suspicion_per_sec = calc_total_income(
-            owned, player["reputation_fear"] + set_fear_bonus, player["reputation_respect"] + set_respect_bonus,
-            player.get("prestige_multiplier", 1.0), territory_bonus,
-            vip_multiplier=vip_mult, ad_boost=ad_boost,
-            equip_income_bonus=equip_inc + set_income_bonus, upgrade_income_bonus=upgrade_inc,
-            gang_income_bonus=gang_inc, event_income_multiplier=event_mult,
-            talent_income_bonus=tb["passive_income"], talent_suspicion_reduce=tb["shadow_talent"],
+        income_per_sec, suspicion_per_sec = calc_player_income(
+            player, owned, profile,
+            equip_bonus=set_income_bonus, fear_bonus=set_fear_bonus, respect_bonus=set_respect_bonus,
         )
 
         cursor = await db.execute("SELECT COUNT(*) as cnt FROM referrals WHERE referrer_id = ?", (req.telegram_id,))
@@ -984,12 +1338,10 @@ async def player_init(req: PlayerInit):
         await check_achievements(db, req.telegram_id)
         achievements = await get_player_achievements(db, req.telegram_id)
 
-        # Tournament — check yesterday's prizes
-        tournament_prize = await check_and_distribute_tournament_prizes(db, req.telegram_id)
+        # Tournament — prize from the last settlement, shown once
+        tournament_prize = await take_tournament_prize_notice(db, req.telegram_id)
         # Today's score
-        cursor = await db.execute("SELECT score FROM tournament_scores WHERE telegram_id=? AND day=?", (req.telegram_id, today_utc()))
-        ts_row = await cursor.fetchone()
-        tournament_score = ts_row["score"] if ts_row else 0
+        tournament_score = await get_tournament_score(db, req.telegram_id, today_utc())
 
         # Event
         active_event = get_active_event()
@@ -1001,7 +1353,6 @@ async def player_init(req: PlayerInit):
         # Boss
         boss_data = None
         if player.get("gang_id"):
-            await spawn_boss_for_gang(db, player["gang_id"])
             boss_data = await get_boss_data(db, player["gang_id"])
 
         # Territories
@@ -1021,7 +1372,10 @@ async def player_init(req: PlayerInit):
             "days_left": vip_days_left,
         }
 
+        await index_pvp_player(db, player, owned)
+
         return {
+            "config_version": CONFIG_VERSION,
             "player": player,
             "businesses": owned,
             "character": character,
@@ -1032,37 +1386,17 @@ async def player_init(req: PlayerInit):
             "suspicion_per_sec": suspicion_per_sec,
             "player_level": get_player_level(owned),
             "was_raided": was_raided,
-            "legal_businesses": LEGAL_BUSINESSES,
-            "shadow_businesses": SHADOW_BUSINESSES,
-            "robberies": ROBBERIES,
-            "casino_games": CASINO_GAMES,
-            "shop_items": SHOP_ITEMS,
-            "upgrades_config": UPGRADES,
-            "cases_config": CASES,
-            "rarities": RARITIES,
             "referral_count": referral_count,
             "daily_missions": daily_missions,
             "login_data": login_data,
-            "login_rewards": LOGIN_REWARDS,
             "achievements": achievements,
-            "achievements_config": ACHIEVEMENTS,
-            "prestige_config": PRESTIGE_CONFIG,
             "territories": territories,
             "territory_bonus": territory_bonus,
             "vip_status": vip_status,
             "ad_boost_until": player.get("ad_boost_until", 0),
-            "vip_packages": VIP_PACKAGES,
-            "cash_packages": CASH_PACKAGES,
-            "case_packages": CASE_PACKAGES,
-            "ton_prices": TON_PRICES,
-            "vip_items": VIP_ITEMS,
             # Skins
             "player_skins": await get_player_skins(db, req.telegram_id),
             "equipped_skins": await get_equipped_skins(db, req.telegram_id),
-            "skins_config": BUSINESS_SKINS,
-            "skin_rarities": SKIN_RARITIES,
-            "skin_case": SKIN_CASE,
-            "skin_case_vip": SKIN_CASE_VIP,
             # Tournament
             "tournament_score": tournament_score,
             "tournament_prize": tournament_prize,
@@ -1071,37 +1405,21 @@ async def player_init(req: PlayerInit):
             "event_progress": event_progress,
             # Boss
             "boss_data": boss_data,
-            # Achievements extended
-            "achievement_categories": ACHIEVEMENT_CATEGORIES,
-            "tier_info": TIER_INFO,
             # Talent Tree
-            "talent_tree_config": TALENT_TREE,
             "player_talents": talents,
             "talent_points": player.get("talent_points", 0),
             # Weekly event
             "weekly_event": get_active_weekly_event(),
-            # Gang war config
-            "gang_war_config": GANG_WAR_CONFIG,
             # Season Pass
             "season_pass": await get_season_pass(db, req.telegram_id),
-            "season_pass_config": SEASON_PASS_CONFIG,
-            "season_pass_rewards": SEASON_PASS_REWARDS,
             # Ranks
             "rank": get_rank(calc_rank_score(player, get_player_level(owned))),
             "rank_score": round(calc_rank_score(player, get_player_level(owned))),
-            "ranks_config": RANKS,
             # Bounties
             "bounties_on_me": await _get_bounties_on(db, req.telegram_id),
-            "bribe_config": BRIBE_CONFIG,
-            "bounty_config": BOUNTY_CONFIG,
             # Item Sets
-            "item_sets": ITEM_SETS,
             "completed_sets": _calc_completed_sets(inventory),
-            # Trade-Up
-            "trade_up_config": TRADE_UP_CONFIG,
         }
-    finally:
-        await db.close()
 
 
 async def _get_bounties_on(db, tid):
@@ -1130,138 +1448,226 @@ def _calc_completed_sets(inventory):
 
 # ── Business ──
 
-@app.post("/api/buy")
-async def buy_business(req: BuyRequest):
-    async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
-            player = await get_player(db, req.telegram_id)
-            if not player: raise HTTPException(404, "Player not found")
-            owned = await get_owned_businesses(db, req.telegram_id)
-            player, _ = await sync_earnings(db, player, owned)
-            owned = await get_owned_businesses(db, req.telegram_id)
-
-            cfg = ALL_BUSINESSES.get(req.business_id)
-            if not cfg: raise HTTPException(400, "Unknown business")
-            player_level = get_player_level(owned)
-            if player_level < cfg["unlock_level"]:
-                raise HTTPException(400, f"Need level {cfg['unlock_level']}")
+async def sync_player(db, telegram_id):
+    """Load the player and sync earnings — the first step of every spending action."""
+    player = await get_player(db, telegram_id)
+    if not player: raise HTTPException(404, "Player not found")
+    owned = await get_owned_businesses(db, telegram_id)
+    player, _ = await sync_earnings(db, player, owned)
+    return player
+
+# The _do_* helpers below are the bodies of single actions, shared by their own
+# endpoint and /api/batch. The caller holds the player lock, runs them inside a
+# transaction and has already called sync_player. They return only what the
+# action itself produced; callers re-read whatever state they respond with.
+
+async def _do_buy_business(db, req: BuyRequest):
+    player = await get_player(db, req.telegram_id)
+    owned = await get_owned_businesses(db, req.telegram_id)
+
+    cfg = ALL_BUSINESSES.get(req.business_id)
+    if not cfg: raise HTTPException(400, "Unknown business")
+    player_level = get_player_level(owned)
+    if player_level < cfg["unlock_level"]:
+        raise HTTPException(400, f"Need level {cfg['unlock_level']}")
 
-            cash_before = player["cash"]
-            existing = next((b for b in owned if b["business_id"] == req.business_id), None)
-            current_level = existing["level"] if existing else 0
-            talents = await get_player_talents(db, req.telegram_id)
-            tb = get_talent_bonuses(talents)
-            cost = get_buy_cost(req.business_id, max(current_level, 1), player["reputation_fear"], player["reputation_respect"], talent_discount=tb["trade_grip"])
-            if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
+    existing = next((b for b in owned if b["business_id"] == req.business_id), None)
+    current_level = existing["level"] if existing else 0
+    talents = await get_player_talents(db, req.telegram_id)
+    tb = get_talent_bonuses(talents)
+    fear, respect = player["reputation_fear"], player["reputation_respect"]
+    if req.max:
+        count = max_affordable_levels(req.business_id, current_level, player["cash"], fear, respect, tb["trade_grip"], limit=BUY_MAX_COUNT)
+        if count == 0: raise HTTPException(400, "Not enough cash")
+    else:
+        count = req.count
+        if not 1 <= count <= BUY_MAX_COUNT: raise HTTPException(400, f"count must be 1..{BUY_MAX_COUNT}")
+    # Each level adds +1 reputation, which lowers the next level's price
+    cost = get_bulk_buy_cost(req.business_id, current_level, count, fear, respect, talent_discount=tb["trade_grip"])
+    if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
+
+    if existing:
+        await db.execute("UPDATE player_businesses SET level = level + ? WHERE id = ? AND telegram_id = ?", (count, existing["id"], req.telegram_id))
+    else:
+        await db.execute("INSERT INTO player_businesses (telegram_id, business_id, level) VALUES (?, ?, ?)", (req.telegram_id, req.business_id, count))
 
-            new_cash = player["cash"] - cost
-            if existing:
-                await db.execute("UPDATE player_businesses SET level = ? WHERE id = ?", (existing["level"] + 1, existing["id"]))
-            else:
-                await db.execute("INSERT INTO player_businesses (telegram_id, business_id, level) VALUES (?, ?, 1)", (req.telegram_id, req.business_id))
+    rep_col = "reputation_fear" if cfg["type"] == "shadow" else "reputation_respect"
+    await db.execute(f"UPDATE players SET cash = cash - ?, {rep_col} = {rep_col} + ? WHERE telegram_id = ?", (cost, count, req.telegram_id))
+    await add_gang_totals(db, player["gang_id"], business_level=count, fear=count if cfg["type"] == "shadow" else 0)
 
-            rep_col = "reputation_fear" if cfg["type"] == "shadow" else "reputation_respect"
-            await db.execute(f"UPDATE players SET cash = ?, {rep_col} = {rep_col} + 1 WHERE telegram_id = ?", (new_cash, req.telegram_id))
-            await db.commit()
+    await track_action(db, req.telegram_id, "buy_business", count)
+    return {"business_id": req.business_id, "level": current_level + count, "count": count, "cost": cost, "cash_before": player["cash"]}
 
-            await track_action(db, req.telegram_id, "buy_business")
+@app.post("/api/buy")
+async def buy_business(req: BuyRequest):
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            await sync_player(db, req.telegram_id)
+            cash_before = (await _do_buy_business(db, req))["cash_before"]
 
             player = await get_player(db, req.telegram_id)
             owned = await get_owned_businesses(db, req.telegram_id)
-            territory_bonus = await get_territory_bonus(db, player.get("gang_id", 0))
-            vip_mult = 2.0 if is_vip_active(player) else 1.0
-            ad_boost = has_ad_boost(player)
-            equip_inc = await get_equip_income_bonus(db, req.telegram_id)
-            upgrade_inc = await get_upgrade_income_bonus(db, req.telegram_id)
-            gang_inc = 0
-            if player.get("gang_id"):
-                gang_ups = await get_gang_upgrades(db, player["gang_id"])
-                gang_inc = get_gang_income_bonus(gang_ups)
-            event_mult = get_event_income_multiplier()
-            income_per_sec, suspicion_per_sec = calc_total_income(
-                owned, player["reputation_fear"], player["reputation_respect"],
-                player.get("prestige_multiplier", 1.0), territory_bonus,
-                vip_multiplier=vip_mult, ad_boost=ad_boost,
-                equip_income_bonus=equip_inc, upgrade_income_bonus=upgrade_inc,
-                gang_income_bonus=gang_inc, event_income_multiplier=event_mult,
-                talent_income_bonus=tb["passive_income"], talent_suspicion_reduce=tb["shadow_talent"],
-            )
+            profile = await get_income_profile(db, player)
+            income_per_sec, suspicion_per_sec = calc_player_income(player, owned, profile)
             return {"player": player, "businesses": owned, "income_per_sec": income_per_sec, "suspicion_per_sec": suspicion_per_sec, "player_level": get_player_level(owned), "cash_before": cash_before}
 
-        finally:
-            await db.close()
 
+async def _do_hire_manager(db, req: ManagerRequest):
+    player = await get_player(db, req.telegram_id)
+    owned = await get_owned_businesses(db, req.telegram_id)
 
-@app.post("/api/manager")
-async def hire_manager(req: ManagerRequest):
-    async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
-            player = await get_player(db, req.telegram_id)
-            if not player: raise HTTPException(404, "Player not found")
-            owned = await get_owned_businesses(db, req.telegram_id)
-            player, _ = await sync_earnings(db, player, owned)
+    existing = next((b for b in owned if b["business_id"] == req.business_id), None)
+    if not existing: raise HTTPException(400, "Not owned")
+    if existing["has_manager"]: raise HTTPException(400, "Already has manager")
 
-            existing = next((b for b in owned if b["business_id"] == req.business_id), None)
-            if not existing: raise HTTPException(400, "Not owned")
-            if existing["has_manager"]: raise HTTPException(400, "Already has manager")
+    cost = calc_manager_cost(ALL_BUSINESSES[req.business_id])
+    if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
 
-            cost = calc_manager_cost(ALL_BUSINESSES[req.business_id])
-            if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
+    await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (cost, req.telegram_id))
+    await db.execute("UPDATE player_businesses SET has_manager = 1 WHERE id = ? AND telegram_id = ?", (existing["id"], req.telegram_id))
+    return {"business_id": req.business_id, "cost": cost}
 
-            await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (cost, req.telegram_id))
-            await db.execute("UPDATE player_businesses SET has_manager = 1 WHERE id = ?", (existing["id"],))
-            await db.commit()
+@app.post("/api/manager")
+async def hire_manager(req: ManagerRequest):
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            await sync_player(db, req.telegram_id)
+            await _do_hire_manager(db, req)
 
             player = await get_player(db, req.telegram_id)
             owned = await get_owned_businesses(db, req.telegram_id)
             return {"player": player, "businesses": owned}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/collect")
 async def collect_income(req: CollectRequest):
+    # Usually a pure read: no player lock, no write
+    async with transaction() as db:
+        player = await get_player(db, req.telegram_id)
+        if not player: raise HTTPException(404, "Player not found")
+        owned = await get_owned_businesses(db, req.telegram_id)
+        profile = await get_income_profile(db, player, persist=False)
+        view, due = accrued_player(player, owned, profile)
+        if not due:
+            income_per_sec, suspicion_per_sec = calc_player_income(view, owned, profile)
+            return {"player": view, "was_raided": False, "income_per_sec": income_per_sec, "suspicion_per_sec": suspicion_per_sec}
+
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
-            old_earned = player.get("total_earned", 0)
             player, was_raided = await sync_earnings(db, player, owned)
-            new_earned = player.get("total_earned", 0)
-            earnings = new_earned - old_earned
-
-            if earnings > 0:
-                await track_action(db, req.telegram_id, "earn_cash", int(earnings))
-
-            territory_bonus = await get_territory_bonus(db, player.get("gang_id", 0))
-            vip_mult = 2.0 if is_vip_active(player) else 1.0
-            ad_boost = has_ad_boost(player)
-            equip_inc = await get_equip_income_bonus(db, req.telegram_id)
-            upgrade_inc = await get_upgrade_income_bonus(db, req.telegram_id)
-            gang_inc = 0
-            if player.get("gang_id"):
-                gang_ups = await get_gang_upgrades(db, player["gang_id"])
-                gang_inc = get_gang_income_bonus(gang_ups)
-            event_mult = get_event_income_multiplier()
-            talents = await get_player_talents(db, req.telegram_id)
-            tb = get_talent_bonuses(talents)
-            income_per_sec, suspicion_per_sec = calc_total_income(
-                owned, player["reputation_fear"], player["reputation_respect"],
-                player.get("prestige_multiplier", 1.0), territory_bonus,
-                vip_multiplier=vip_mult, ad_boost=ad_boost,
-                equip_income_bonus=equip_inc, upgrade_income_bonus=upgrade_inc,
-                gang_income_bonus=gang_inc, event_income_multiplier=event_mult,
-                talent_income_bonus=tb["passive_income"], talent_suspicion_reduce=tb["shadow_talent"],
-            )
+            profile = await get_income_profile(db, player)
+            income_per_sec, suspicion_per_sec = calc_player_income(player, owned, profile)
             return {"player": player, "was_raided": was_raided, "income_per_sec": income_per_sec, "suspicion_per_sec": suspicion_per_sec}
 
+
+# ── Live state stream ──
+#
+# Replaces the client's 10-second /api/collect poll. A connected client gets a
+# "state" event whenever a commit touches its player rows (via the player cache)
+# and otherwise extrapolates locally from income_per_sec. Clock-driven changes —
+# a due accrual sync, crossing the raid threshold, boost/VIP expiry — are
+# handled by one server-side timer per online player.
+
+STREAM_RESYNC_INTERVAL = int(os.getenv("STREAM_RESYNC_INTERVAL", "300"))
+STREAM_RETRY_MS = 3000
+
+
+def next_wake_ts(player, profile, income_per_sec, suspicion_per_sec, suspicion):
+    """When the server has to look again for the client's extrapolation to stay right."""
+    now = time.time()
+    wake = []
+    if income_per_sec > 0 or suspicion_per_sec > 0:
+        max_offline = ((8 if is_vip_active(player) else 4) + profile["talent_offline_hours"]) * 3600
+        wake.append(player["last_collect_ts"] + min(max_offline - 60, ACCRUAL_MAX_UNSYNCED))
+        wake.append(now + STREAM_RESYNC_INTERVAL)
+    if suspicion_per_sec > 0:
+        wake.append(now + max(0.0, (RAID_THRESHOLD - suspicion) / suspicion_per_sec))
+    for key in ("ad_boost_until", "vip_until"):
+        until = player.get(key) or 0
+        if until > now:
+            wake.append(until)
+    return min(wake) if wake else None
+
+
+async def player_state(telegram_id):
+    """Read-only snapshot pushed to the stream: committed player row plus unsynced earnings."""
+    async with transaction() as db:
+        player = await get_player(db, telegram_id)
+        if not player:
+            return None
+        owned = await get_owned_businesses(db, telegram_id)
+        profile = await get_income_profile(db, player, persist=False)
+    earnings, suspicion, was_raided = preview_earnings(player, owned, profile)
+    income_per_sec, suspicion_per_sec = calc_player_income(player, owned, profile)
+    wake = time.time() if was_raided else next_wake_ts(player, profile, income_per_sec, suspicion_per_sec, suspicion)
+    if wake is not None:
+        stream_hub.wake_at(telegram_id, wake)
+    return {
+        "player": player,
+        "pending_cash": earnings,
+        "suspicion": suspicion,
+        "income_per_sec": income_per_sec,
+        "suspicion_per_sec": suspicion_per_sec,
+        "ts": time.time(),
+    }
+
+
+async def wake_player(telegram_id):
+    """Timer callback: sync earnings if due (raid, VIP expiry, ...), then re-push state."""
+    async with get_player_lock(telegram_id):
+        async with transaction() as db:
+            player = await get_player(db, telegram_id)
+            if not player:
+                return
+            owned = await get_owned_businesses(db, telegram_id)
+            await accrue_earnings(db, player, owned)
+    # A sync pushes through the cache listener; this also re-arms the timer when nothing changed
+    stream_hub.players_changed(telegram_id)
+
+
+stream_hub.load_state = player_state
+stream_hub.wake = wake_player
+stream_hub.volatile_keys = ("ts", "pending_cash", "suspicion")
+player_cache.add_listener(stream_hub.players_changed)
+
+
+@app.get("/api/stream/{telegram_id}")
+async def player_stream(telegram_id: int, request: Request, last_event_id: str = ""):
+    state = await player_state(telegram_id)
+    if state is None:
+        raise HTTPException(404, "Player not found")
+    resume_from = request.headers.get("last-event-id") or last_event_id
+
+    async def events():
+        queue = stream_hub.subscribe(telegram_id)
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            missed = stream_hub.replay(telegram_id, resume_from)
+            if missed is None:
+                stream_hub.forget_state(telegram_id)
+                stream_hub.publish_state(telegram_id, state)
+            else:
+                for item in missed:
+                    yield format_event(*item)
+            # Covers commits that landed between the snapshot and subscribing
+            stream_hub.players_changed(telegram_id)
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield format_event(*item)
         finally:
-            await db.close()
+            stream_hub.unsubscribe(telegram_id, queue)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # ── Robbery ──
@@ -1269,8 +1675,7 @@ async def collect_income(req: CollectRequest):
 @app.post("/api/robbery")
 async def do_robbery(req: RobberyRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -1295,132 +1700,146 @@ async def do_robbery(req: RobberyRequest):
             actual_cd = max(5, cfg["cooldown_seconds"] * (1 - tb["robbery_master"] / 100.0))
 
             await db.execute(
-                "UPDATE players SET cash=?, suspicion=?, robbery_cooldown_ts=?, reputation_fear=reputation_fear+2, total_robberies=total_robberies+1 WHERE telegram_id=?",
-                (new_cash, new_suspicion, now + actual_cd, req.telegram_id),
+                "UPDATE players SET cash=cash+?, suspicion=?, robbery_cooldown_ts=?, reputation_fear=reputation_fear+2, total_robberies=total_robberies+1 WHERE telegram_id=?",
+                (reward, new_suspicion, now + actual_cd, req.telegram_id),
             )
+            await add_gang_totals(db, player["gang_id"], fear=2)
             await db.execute(
                 "INSERT INTO robbery_log (telegram_id, target, success, reward, suspicion_gain) VALUES (?,?,?,?,?)",
                 (req.telegram_id, req.robbery_id, int(success), reward, suspicion_gain),
             )
-            await db.commit()
 
             await track_action(db, req.telegram_id, "robbery")
             if success:
                 await track_action(db, req.telegram_id, "robbery_success")
 
             player = await get_player(db, req.telegram_id)
+            await check_achievements(db, req.telegram_id, ("total_robberies",), player)
             return {"success": success, "reward": reward, "suspicion_gain": suspicion_gain, "player": player, "cash_before": cash_before}
 
-        finally:
-            await db.close()
-
 
 # ── Casino ──
 
+CASINO_CHOICES = {"coinflip": ("heads", "tails"), "dice": ("over", "under", "seven")}
+ROULETTE_RED_SET = frozenset(ROULETTE_RED)
+ROULETTE_BLACK_SET = frozenset(ROULETTE_BLACK)
+SLOT_SYMBOL_INDEX = {sym: i for i, sym in enumerate(SLOT_SYMBOLS)}
+
+async def check_casino_bet(db, player, game: str, bet: float, choice: str):
+    """Raise unless game, bet and choice are playable for this player (cash aside)."""
+    game_cfg = CASINO_GAMES.get(game)
+    if not game_cfg: raise HTTPException(400, "Unknown game")
+    validate_amount(bet, "bet")
+    talents = await get_player_talents(db, player["telegram_id"])
+    tb = get_talent_bonuses(talents)
+    effective_max_bet = game_cfg["max_bet"] + tb["lucky"]
+    if bet < game_cfg["min_bet"] or bet > effective_max_bet:
+        raise HTTPException(400, f"Bet must be {game_cfg['min_bet']}-{effective_max_bet}")
+    if game == "coinflip" and choice not in CASINO_CHOICES["coinflip"]:
+        raise HTTPException(400, "Choice must be heads or tails")
+    if game == "dice" and choice not in CASINO_CHOICES["dice"]:
+        raise HTTPException(400, "Choice must be over, under, or seven")
+
+def draw_casino_outcomes(game: str, n: int):
+    """Outcomes of n rounds, taken from one batched draw."""
+    if game == "coinflip":
+        return random.choices(("heads", "tails"), k=n)
+    if game == "dice":
+        dice = random.choices(range(1, 7), k=2 * n)
+        return list(zip(dice[::2], dice[1::2]))
+    if game == "slots":
+        reels = random.choices(SLOT_SYMBOLS, k=3 * n)
+        return [reels[i:i + 3] for i in range(0, 3 * n, 3)]
+    return random.choices(ROULETTE_NUMBERS, k=n)
+
+def settle_casino_round(game: str, choice: str, bet: float, outcome):
+    """(payout before the weekly bonus, result_data) of one round."""
+    payout = 0
+    if game == "coinflip":
+        win = outcome == choice
+        payout = bet * 2 if win else 0
+        return payout, {"flip": outcome, "win": win}
+
+    if game == "dice":
+        dice1, dice2 = outcome
+        total = dice1 + dice2
+        if choice == "over":
+            win = total > 7
+            payout = bet * 2 if win else 0
+        elif choice == "under":
+            win = total < 7
+            payout = bet * 2 if win else 0
+        else:
+            win = total == 7
+            payout = bet * 5 if win else 0
+        return payout, {"dice1": dice1, "dice2": dice2, "total": total, "win": win}
+
+    if game == "slots":
+        reels = outcome
+        combo = "".join(reels)
+        if combo in SLOT_PAYOUTS:
+            payout = bet * SLOT_PAYOUTS[combo]
+        elif reels[0] == reels[1] or reels[1] == reels[2]:
+            payout = bet * SLOT_TWO_MATCH_PAYOUT
+        return payout, {"reels": reels, "win": payout > 0}
+
+    number = outcome
+    if choice in ("red", "black", "even", "odd"):
+        win = {
+            "red": number in ROULETTE_RED_SET,
+            "black": number in ROULETTE_BLACK_SET,
+            "even": number != 0 and number % 2 == 0,
+            "odd": number % 2 == 1,
+        }[choice]
+        payout = bet * 2 if win else 0
+    else:
+        try:
+            win = number == int(choice)
+        except ValueError:
+            win = False
+        payout = bet * 36 if win else 0
+    color = "red" if number in ROULETTE_RED_SET else "black" if number in ROULETTE_BLACK_SET else "green"
+    return payout, {"number": number, "win": win, "color": color}
+
+def encode_casino_outcome(game: str, outcome) -> str:
+    """Fixed-width code of one outcome for the autoplay log: h/t, two dice, three reel indexes, or 00-36."""
+    if game == "coinflip":
+        return outcome[0]
+    if game == "dice":
+        return f"{outcome[0]}{outcome[1]}"
+    if game == "slots":
+        return "".join(str(SLOT_SYMBOL_INDEX[sym]) for sym in outcome)
+    return f"{outcome:02d}"
+
 @app.post("/api/casino")
 async def casino_play(req: CasinoBetRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
             player, _ = await sync_earnings(db, player, owned)
 
-            game_cfg = CASINO_GAMES.get(req.game)
-            if not game_cfg: raise HTTPException(400, "Unknown game")
-            validate_amount(req.bet, "bet")
-            talents = await get_player_talents(db, req.telegram_id)
-            tb = get_talent_bonuses(talents)
-            effective_max_bet = game_cfg["max_bet"] + tb["lucky"]
-            if req.bet < game_cfg["min_bet"] or req.bet > effective_max_bet:
-                raise HTTPException(400, f"Bet must be {game_cfg['min_bet']}-{effective_max_bet}")
+            await check_casino_bet(db, player, req.game, req.bet, req.choice)
             if player["cash"] < req.bet:
                 raise HTTPException(400, "Not enough cash")
 
-            payout = 0
-            result_data = {}
-
-            if req.game == "coinflip":
-                if req.choice not in ("heads", "tails"):
-                    raise HTTPException(400, "Choice must be heads or tails")
-                flip = random.choice(["heads", "tails"])
-                win = flip == req.choice
-                payout = req.bet * 2 if win else 0
-                result_data = {"flip": flip, "win": win}
-
-            elif req.game == "dice":
-                if req.choice not in ("over", "under", "seven"):
-                    raise HTTPException(400, "Choice must be over, under, or seven")
-                dice1 = random.randint(1, 6)
-                dice2 = random.randint(1, 6)
-                total = dice1 + dice2
-                if req.choice == "over":
-                    win = total > 7
-                    payout = req.bet * 2 if win else 0
-                elif req.choice == "under":
-                    win = total < 7
-                    payout = req.bet * 2 if win else 0
-                elif req.choice == "seven":
-                    win = total == 7
-                    payout = req.bet * 5 if win else 0
-                else:
-                    win = False
-                result_data = {"dice1": dice1, "dice2": dice2, "total": total, "win": win}
-
-            elif req.game == "slots":
-                reels = [random.choice(SLOT_SYMBOLS) for _ in range(3)]
-                combo = "".join(reels)
-                if combo in SLOT_PAYOUTS:
-                    payout = req.bet * SLOT_PAYOUTS[combo]
-                elif reels[0] == reels[1] or reels[1] == reels[2]:
-                    payout = req.bet * SLOT_TWO_MATCH_PAYOUT
-                else:
-                    payout = 0
-                result_data = {"reels": reels, "win": payout > 0}
-
-            elif req.game == "roulette":
-                number = random.choice(ROULETTE_NUMBERS)
-                win = False
-                if req.choice == "red":
-                    win = number in ROULETTE_RED
-                    payout = req.bet * 2 if win else 0
-                elif req.choice == "black":
-                    win = number in ROULETTE_BLACK
-                    payout = req.bet * 2 if win else 0
-                elif req.choice == "even":
-                    win = number != 0 and number % 2 == 0
-                    payout = req.bet * 2 if win else 0
-                elif req.choice == "odd":
-                    win = number % 2 == 1
-                    payout = req.bet * 2 if win else 0
-                else:
-                    try:
-                        chosen_num = int(req.choice)
-                        win = number == chosen_num
-                        payout = req.bet * 36 if win else 0
-                    except ValueError:
-                        pass
-                result_data = {"number": number, "win": win, "color": "red" if number in ROULETTE_RED else "black" if number in ROULETTE_BLACK else "green"}
+            payout, result_data = settle_casino_round(req.game, req.choice, req.bet, draw_casino_outcomes(req.game, 1)[0])
 
             # Apply weekly casino bonus (Thursday)
             if payout > 0:
                 payout = round(payout * get_weekly_casino_multiplier(), 2)
             net = payout - req.bet
-            new_cash = player["cash"] + net
 
-            await db.execute("UPDATE players SET cash = ? WHERE telegram_id = ?", (new_cash, req.telegram_id))
+            await db.execute(
+                "UPDATE players SET cash = cash + ?, casino_plays = casino_plays + 1, casino_wins = casino_wins + ? "
+                "WHERE telegram_id = ?",
+                (net, int(payout > 0), req.telegram_id),
+            )
             await db.execute(
                 "INSERT INTO casino_log (telegram_id, game, bet, result, payout) VALUES (?,?,?,?,?)",
                 (req.telegram_id, req.game, req.bet, str(result_data), payout),
             )
-            await db.commit()
-
-            # Track casino stats
-            await db.execute("UPDATE players SET casino_plays=casino_plays+1 WHERE telegram_id=?", (req.telegram_id,))
-            if payout > 0:
-                await db.execute("UPDATE players SET casino_wins=casino_wins+1 WHERE telegram_id=?", (req.telegram_id,))
-            await db.commit()
 
             await track_action(db, req.telegram_id, "casino_play")
             if payout > 0:
@@ -1429,11 +1848,85 @@ async def casino_play(req: CasinoBetRequest):
                 await notify_player(db, req.telegram_id, f"🎰 Крупный выигрыш в казино: +${int(net):,}!")
 
             player = await get_player(db, req.telegram_id)
+            await check_achievements(db, req.telegram_id, ("casino_plays", "casino_wins"), player)
 
             return {"payout": payout, "net": net, "result": result_data, "player": player}
 
-        finally:
-            await db.close()
+
+@app.post("/api/casino/autoplay")
+async def casino_autoplay(req: CasinoAutoplayRequest):
+    """Play up to `rounds` spins of one bet in a single pass.
+
+    Stops early when the running net reaches -stop_loss or +take_profit (0 turns
+    either off) or the next bet is unaffordable. Writes one casino_log row whose
+    result holds the summary and the fixed-width code of every round, and
+    applies stats and mission progress once for all rounds.
+    """
+    if not 1 <= req.rounds <= CASINO_AUTOPLAY_MAX_ROUNDS:
+        raise HTTPException(400, f"rounds must be 1..{CASINO_AUTOPLAY_MAX_ROUNDS}")
+    if not (math.isfinite(req.stop_loss) and math.isfinite(req.take_profit)) or req.stop_loss < 0 or req.take_profit < 0:
+        raise HTTPException(400, "Invalid stop_loss or take_profit")
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            player = await get_player(db, req.telegram_id)
+            if not player: raise HTTPException(404, "Player not found")
+            owned = await get_owned_businesses(db, req.telegram_id)
+            player, _ = await sync_earnings(db, player, owned)
+
+            await check_casino_bet(db, player, req.game, req.bet, req.choice)
+            if player["cash"] < req.bet:
+                raise HTTPException(400, "Not enough cash")
+
+            casino_mult = get_weekly_casino_multiplier()
+            net = total_payout = best_net = 0
+            wins = 0
+            rounds, codes = [], []
+            stopped = None
+            for outcome in draw_casino_outcomes(req.game, req.rounds):
+                if player["cash"] + net < req.bet:
+                    stopped = "cash"
+                    break
+                payout, result_data = settle_casino_round(req.game, req.choice, req.bet, outcome)
+                if payout > 0:
+                    payout = round(payout * casino_mult, 2)
+                    wins += 1
+                    if payout / req.bet >= 10:
+                        best_net = max(best_net, payout - req.bet)
+                net += payout - req.bet
+                total_payout += payout
+                rounds.append({"payout": payout, "result": result_data})
+                codes.append(encode_casino_outcome(req.game, outcome))
+                if req.stop_loss and net <= -req.stop_loss:
+                    stopped = "stop_loss"
+                    break
+                if req.take_profit and net >= req.take_profit:
+                    stopped = "take_profit"
+                    break
+            played = len(rounds)
+
+            await db.execute(
+                "UPDATE players SET cash = cash + ?, casino_plays = casino_plays + ?, casino_wins = casino_wins + ? "
+                "WHERE telegram_id = ?",
+                (net, played, wins, req.telegram_id),
+            )
+            summary = {"autoplay": played, "choice": req.choice, "wins": wins, "stopped": stopped, "outcomes": "".join(codes)}
+            await db.execute(
+                "INSERT INTO casino_log (telegram_id, game, bet, result, payout) VALUES (?,?,?,?,?)",
+                (req.telegram_id, req.game, req.bet * played, json.dumps(summary, separators=(",", ":")), total_payout),
+            )
+
+            await track_action(db, req.telegram_id, "casino_play", played)
+            if wins:
+                await track_action(db, req.telegram_id, "casino_win", wins)
+            if best_net > 0:
+                await notify_player(db, req.telegram_id, f"🎰 Крупный выигрыш в казино: +${int(best_net):,}!")
+
+            player = await get_player(db, req.telegram_id)
+            await check_achievements(db, req.telegram_id, ("casino_plays", "casino_wins"), player)
+            return {
+                "played": played, "wins": wins, "payout": total_payout, "net": net,
+                "stopped": stopped, "rounds": rounds, "player": player,
+            }
 
 
 # ── Shop & Character ──
@@ -1441,8 +1934,7 @@ async def casino_play(req: CasinoBetRequest):
 @app.post("/api/shop/buy")
 async def shop_buy(req: ShopBuyRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -1458,7 +1950,6 @@ async def shop_buy(req: ShopBuyRequest):
 
             await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (item["price"], req.telegram_id))
             await db.execute("INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)", (req.telegram_id, req.item_id))
-            await db.commit()
 
             await track_action(db, req.telegram_id, "shop_buy")
 
@@ -1466,62 +1957,59 @@ async def shop_buy(req: ShopBuyRequest):
             inventory = await get_inventory(db, req.telegram_id)
             return {"player": player, "inventory": inventory}
 
-        finally:
-            await db.close()
 
+async def _do_equip_item(db, req: EquipRequest):
+    item = SHOP_ITEMS.get(req.item_id)
+    if not item: raise HTTPException(400, "Unknown item")
 
-@app.post("/api/shop/equip")
-async def equip_item(req: EquipRequest):
-    async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
-            item = SHOP_ITEMS.get(req.item_id)
-            if not item: raise HTTPException(400, "Unknown item")
+    cursor = await db.execute(
+        "SELECT id FROM player_inventory WHERE telegram_id=? AND item_id=?",
+        (req.telegram_id, req.item_id)
+    )
+    if not await cursor.fetchone():
+        raise HTTPException(400, "Item not owned")
 
-            cursor = await db.execute(
-                "SELECT id FROM player_inventory WHERE telegram_id=? AND item_id=?",
-                (req.telegram_id, req.item_id)
-            )
-            if not await cursor.fetchone():
-                raise HTTPException(400, "Item not owned")
+    inv = await get_inventory(db, req.telegram_id)
+    for inv_item in inv:
+        inv_cfg = SHOP_ITEMS.get(inv_item["item_id"])
+        if inv_cfg and inv_cfg["slot"] == item["slot"] and inv_item["equipped"]:
+            await db.execute("UPDATE player_inventory SET equipped=0 WHERE id=? AND telegram_id=?", (inv_item["id"], req.telegram_id))
 
-            inv = await get_inventory(db, req.telegram_id)
-            for inv_item in inv:
-                inv_cfg = SHOP_ITEMS.get(inv_item["item_id"])
-                if inv_cfg and inv_cfg["slot"] == item["slot"] and inv_item["equipped"]:
-                    await db.execute("UPDATE player_inventory SET equipped=0 WHERE id=?", (inv_item["id"],))
+    await db.execute(
+        "UPDATE player_inventory SET equipped=1 WHERE telegram_id=? AND item_id=?",
+        (req.telegram_id, req.item_id)
+    )
 
-            await db.execute(
-                "UPDATE player_inventory SET equipped=1 WHERE telegram_id=? AND item_id=?",
-                (req.telegram_id, req.item_id)
-            )
+    allowed_slots = ("hat", "jacket", "accessory", "weapon", "car")
+    slot = item["slot"]
+    if slot in allowed_slots:
+        await db.execute(
+            f"UPDATE player_character SET {slot}=? WHERE telegram_id=?",
+            (req.item_id, req.telegram_id)
+        )
+        await invalidate_income_profile(db, req.telegram_id)
+    return {"item_id": req.item_id, "slot": slot}
 
-            allowed_slots = ("hat", "jacket", "accessory", "weapon", "car")
-            slot = item["slot"]
-            if slot in allowed_slots:
-                await db.execute(
-                    f"UPDATE player_character SET {slot}=? WHERE telegram_id=?",
-                    (req.item_id, req.telegram_id)
-                )
-            await db.commit()
+@app.post("/api/shop/equip")
+async def equip_item(req: EquipRequest):
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            await _do_equip_item(db, req)
 
             character = await get_character(db, req.telegram_id)
             inventory = await get_inventory(db, req.telegram_id)
             return {"character": character, "inventory": inventory}
 
-        finally:
-            await db.close()
-
 
 @app.get("/api/character/{telegram_id}")
 async def get_character_info(telegram_id: int):
-    db = await get_db()
-    try:
-        character = await get_character(db, telegram_id)
-        inventory = await get_inventory(db, telegram_id)
-        return {"character": character, "inventory": inventory}
-    finally:
-        await db.close()
+    character = player_cache.peek(telegram_id, "player_character")
+    inventory = player_cache.peek(telegram_id, "player_inventory")
+    if character is None or inventory is None:
+        async with transaction() as db:
+            character = await get_character(db, telegram_id)
+            inventory = await get_inventory(db, telegram_id)
+    return {"character": character, "inventory": inventory}
 
 
 @app.post("/api/nickname")
@@ -1534,17 +2022,13 @@ async def set_nickname(req: NicknameRequest):
     if not re.match(r'^[\w\s\-а-яА-ЯёЁ]+$', nick):
         raise HTTPException(400, "Недопустимые символы в никнейме")
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             await db.execute(
                 "UPDATE player_character SET nickname=? WHERE telegram_id=?",
                 (nick, req.telegram_id),
             )
-            await db.commit()
             character = await get_character(db, req.telegram_id)
             return {"character": character}
-        finally:
-            await db.close()
 
 
 # ── Cases ──
@@ -1552,8 +2036,7 @@ async def set_nickname(req: NicknameRequest):
 @app.post("/api/case/buy")
 async def buy_case(req: CaseBuyRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -1565,21 +2048,59 @@ async def buy_case(req: CaseBuyRequest):
 
             await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (case_cfg["price"], req.telegram_id))
             await db.execute("INSERT INTO player_cases (telegram_id, case_id) VALUES (?, ?)", (req.telegram_id, req.case_id))
-            await db.commit()
 
             player = await get_player(db, req.telegram_id)
             player_cases = await get_player_cases(db, req.telegram_id)
             return {"player": player, "player_cases": player_cases}
 
-        finally:
-            await db.close()
+
+async def open_item_cases(db, tid: int, case_id: str, count: int):
+    """Roll count cases of case_id: new items go to the inventory, duplicates are
+    paid out in cash. Returns (won item ids, total cash compensation)."""
+    case_cfg = CASES[case_id]
+    inventory = await get_inventory(db, tid)
+    owned_ids = {i["item_id"] for i in inventory}
+    talents = await get_player_talents(db, tid)
+    lootbox_boost = get_talent_bonuses(talents)["lootbox_master"]  # % boost for rare+
+    loot_mult = get_weekly_loot_multiplier()
+
+    won, cash_compensation = [], 0
+    for _ in range(count):
+        item_id, is_new = roll_case(case_id, owned_ids, lootbox_boost, loot_mult)
+        if is_new:
+            won.append(item_id)
+            owned_ids.add(item_id)
+        else:
+            rarity = SHOP_ITEMS.get(item_id, {}).get("rarity", "common")
+            cash_compensation += case_cfg["price"] * 0.5 * CASE_DUPLICATE_RARITY_MULT.get(rarity, 1)
+
+    if won:
+        await db.executemany("INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)", [(tid, i) for i in won])
+    if cash_compensation:
+        await db.execute("UPDATE players SET cash = cash + ? WHERE telegram_id = ?", (cash_compensation, tid))
+    await track_action(db, tid, "case_open", count)
+    return won, cash_compensation
+
+async def case_open_result(db, tid: int, won: list, cash_compensation: float):
+    player = await get_player(db, tid)
+    inventory = await get_inventory(db, tid)
+    player_cases = await get_player_cases(db, tid)
+    return {
+        "player": player,
+        "inventory": inventory,
+        "player_cases": player_cases,
+        "won_item_id": won[0] if won else None,
+        "won_item": SHOP_ITEMS.get(won[0], {}) if won else None,
+        "won_item_ids": won,
+        "cash_compensation": cash_compensation,
+    }
 
 
 @app.post("/api/case/open")
 async def open_case(req: CaseOpenRequest):
+    if not 1 <= req.count <= CASE_OPEN_MAX_COUNT: raise HTTPException(400, f"count must be 1..{CASE_OPEN_MAX_COUNT}")
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
 
@@ -1595,79 +2116,30 @@ async def open_case(req: CaseOpenRequest):
             case_cfg = CASES.get(pc["case_id"])
             if not case_cfg: raise HTTPException(400, "Invalid case")
 
-            # Get owned items to avoid duplicates
-            inventory = await get_inventory(db, req.telegram_id)
-            owned_ids = {i["item_id"] for i in inventory}
-
-            # Weighted random selection, re-roll on duplicate
-            # Apply lootbox_master talent: boost weights for rare+ items
-            talents = await get_player_talents(db, req.telegram_id)
-            tb = get_talent_bonuses(talents)
-            lootbox_boost = tb["lootbox_master"]  # % boost for rare+
-            weekly_loot_mult = get_weekly_loot_multiplier()
-            loot = case_cfg["loot"]
-            items = [l["item_id"] for l in loot]
-            weights = []
-            for l in loot:
-                w = l["weight"]
-                item_rarity = SHOP_ITEMS.get(l["item_id"], {}).get("rarity", "common")
-                if item_rarity in ("rare", "epic", "legendary"):
-                    if lootbox_boost > 0:
-                        w *= (1 + lootbox_boost / 100.0)
-                    w *= weekly_loot_mult
-                weights.append(w)
-
-            won_item_id = None
-            cash_compensation = 0
-
-            for _ in range(20):  # max 20 re-rolls
-                chosen = random.choices(items, weights=weights, k=1)[0]
-                if chosen not in owned_ids:
-                    won_item_id = chosen
-                    break
-
-            if won_item_id:
-                await db.execute("INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)", (req.telegram_id, won_item_id))
-            else:
-                # All items owned — give cash compensation
-                chosen = random.choices(items, weights=weights, k=1)[0]
-                item_cfg = SHOP_ITEMS.get(chosen, {})
-                rarity = item_cfg.get("rarity", "common")
-                rarity_mult = {"common": 1, "uncommon": 2, "rare": 4, "epic": 8, "legendary": 20}
-                cash_compensation = case_cfg["price"] * 0.5 * rarity_mult.get(rarity, 1)
-                await db.execute("UPDATE players SET cash = cash + ? WHERE telegram_id = ?", (cash_compensation, req.telegram_id))
-
-            # Remove the case
-            await db.execute("DELETE FROM player_cases WHERE id=?", (req.player_case_id,))
-            await db.commit()
-
-            await track_action(db, req.telegram_id, "case_open")
-
-            player = await get_player(db, req.telegram_id)
-            inventory = await get_inventory(db, req.telegram_id)
-            player_cases = await get_player_cases(db, req.telegram_id)
+            # The requested case first, then the oldest others of the same kind
+            cursor = await db.execute(
+                "SELECT id FROM player_cases WHERE telegram_id=? AND case_id=? ORDER BY id=? DESC, id LIMIT ?",
+                (req.telegram_id, pc["case_id"], req.player_case_id, req.count),
+            )
+            case_ids = [r["id"] for r in await cursor.fetchall()]
+            if len(case_ids) < req.count: raise HTTPException(400, "Not enough cases")
 
-            won_item = SHOP_ITEMS.get(won_item_id, {}) if won_item_id else None
+            won, cash_compensation = await open_item_cases(db, req.telegram_id, pc["case_id"], req.count)
 
-            return {
-                "player": player,
-                "inventory": inventory,
-                "player_cases": player_cases,
-                "won_item_id": won_item_id,
-                "won_item": won_item,
-                "cash_compensation": cash_compensation,
-            }
+            # Remove the cases
+            await db.execute(
+                f"DELETE FROM player_cases WHERE id IN ({','.join('?' * len(case_ids))})", tuple(case_ids)
+            )
 
-        finally:
-            await db.close()
+            return await case_open_result(db, req.telegram_id, won, cash_compensation)
 
 
 @app.post("/api/case/spin")
 async def spin_case(req: CaseSpinRequest):
     """Buy + open case in one action."""
+    if not 1 <= req.count <= CASE_OPEN_MAX_COUNT: raise HTTPException(400, f"count must be 1..{CASE_OPEN_MAX_COUNT}")
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -1675,75 +2147,70 @@ async def spin_case(req: CaseSpinRequest):
 
             case_cfg = CASES.get(req.case_id)
             if not case_cfg: raise HTTPException(400, "Unknown case")
-            if player["cash"] < case_cfg["price"]: raise HTTPException(400, "Not enough cash")
+            price = case_cfg["price"] * req.count
+            if player["cash"] < price: raise HTTPException(400, "Not enough cash")
 
             # Deduct cash
-            await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (case_cfg["price"], req.telegram_id))
-
-            # Get owned items to avoid duplicates
-            inventory = await get_inventory(db, req.telegram_id)
-            owned_ids = {i["item_id"] for i in inventory}
-
-            # Weighted random selection with lootbox_master talent boost
-            talents = await get_player_talents(db, req.telegram_id)
-            tb = get_talent_bonuses(talents)
-            lootbox_boost = tb["lootbox_master"]
-            weekly_loot_mult = get_weekly_loot_multiplier()
-            loot = case_cfg["loot"]
-            items = [l["item_id"] for l in loot]
-            weights = []
-            for l in loot:
-                w = l["weight"]
-                item_rarity = SHOP_ITEMS.get(l["item_id"], {}).get("rarity", "common")
-                if item_rarity in ("rare", "epic", "legendary"):
-                    if lootbox_boost > 0:
-                        w *= (1 + lootbox_boost / 100.0)
-                    w *= weekly_loot_mult
-                weights.append(w)
-
-            won_item_id = None
-            cash_compensation = 0
+            await db.execute("UPDATE players SET cash = cash - ? WHERE telegram_id = ?", (price, req.telegram_id))
 
-            for _ in range(20):
-                chosen = random.choices(items, weights=weights, k=1)[0]
-                if chosen not in owned_ids:
-                    won_item_id = chosen
-                    break
+            won, cash_compensation = await open_item_cases(db, req.telegram_id, req.case_id, req.count)
+            return await case_open_result(db, req.telegram_id, won, cash_compensation)
 
-            if won_item_id:
-                await db.execute("INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)", (req.telegram_id, won_item_id))
-            else:
-                chosen = random.choices(items, weights=weights, k=1)[0]
-                item_cfg = SHOP_ITEMS.get(chosen, {})
-                rarity = item_cfg.get("rarity", "common")
-                rarity_mult = {"common": 1, "uncommon": 2, "rare": 4, "epic": 8, "legendary": 20}
-                cash_compensation = case_cfg["price"] * 0.5 * rarity_mult.get(rarity, 1)
-                await db.execute("UPDATE players SET cash = cash + ? WHERE telegram_id = ?", (cash_compensation, req.telegram_id))
 
-            await db.commit()
-            await track_action(db, req.telegram_id, "case_open")
+# ── Gangs ──
 
-            player = await get_player(db, req.telegram_id)
-            inventory = await get_inventory(db, req.telegram_id)
-            player_cases = await get_player_cases(db, req.telegram_id)
-            won_item = SHOP_ITEMS.get(won_item_id, {}) if won_item_id else None
+async def gang_log(db, gang_id, message):
+    await db.execute("INSERT INTO gang_log (gang_id, message) VALUES (?, ?)", (gang_id, message))
 
-            return {
-                "player": player,
-                "inventory": inventory,
-                "player_cases": player_cases,
-                "won_item_id": won_item_id,
-                "won_item": won_item,
-                "cash_compensation": cash_compensation,
-            }
-        finally:
-            await db.close()
+# gangs.member_count / total_business_level / total_fear are maintained in the
+# same transaction as every change to membership, business levels or fear, so
+# list and territory queries read them instead of aggregating members.
 
+async def add_gang_totals(db, gang_id, members=0, business_level=0, fear=0):
+    """Apply deltas to a gang's maintained aggregates; no-op without a gang."""
+    if gang_id and (members or business_level or fear):
+        await db.execute(
+            "UPDATE gangs SET member_count=member_count+?, total_business_level=total_business_level+?, "
+            "total_fear=total_fear+? WHERE id=?",
+            (members, business_level, fear, gang_id),
+        )
 
-# ── Gangs ──
+async def add_member_totals(db, gang_id, player, sign=1):
+    """Add (sign=1) or remove (sign=-1) one member's level and fear from a gang's aggregates."""
+    owned = await get_owned_businesses(db, player["telegram_id"])
+    await add_gang_totals(db, gang_id, sign, sign * get_player_level(owned), sign * player["reputation_fear"])
+
+GANG_AGGREGATES_ACTUAL = (
+    "SELECT g.id, g.member_count, g.total_business_level, g.total_fear, "
+    "(SELECT COUNT(*) FROM gang_members gm WHERE gm.gang_id=g.id) AS actual_member_count, "
+    "(SELECT COALESCE(SUM(pb.level), 0) FROM gang_members gm "
+    "JOIN player_businesses pb ON pb.telegram_id=gm.telegram_id WHERE gm.gang_id=g.id) AS actual_total_business_level, "
+    "(SELECT COALESCE(SUM(p.reputation_fear), 0) FROM gang_members gm "
+    "JOIN players p ON p.telegram_id=gm.telegram_id WHERE gm.gang_id=g.id) AS actual_total_fear "
+    "FROM gangs g"
+)
 
-async def gang_log(db, gang_id, message):
-    await db.execute("INSERT INTO gang_log (gang_id, message) VALUES (?, ?)", (gang_id, message))
+async def check_gang_aggregates(db, repair=False):
+    """Recompute every gang's aggregates from members; return the gangs that drifted
+    (and overwrite them with the recomputed values when repair is set)."""
+    cursor = await db.execute(GANG_AGGREGATES_ACTUAL)
+    drift = []
+    for row in await cursor.fetchall():
+        diff = {
+            col: {"stored": row[col], "actual": row[f"actual_{col}"]}
+            for col in ("member_count", "total_business_level", "total_fear")
+            if row[col] != row[f"actual_{col}"]
+        }
+        if diff:
+            drift.append({"gang_id": row["id"], **diff})
+            if repair:
+                await db.execute(
+                    "UPDATE gangs SET member_count=?, total_business_level=?, total_fear=? WHERE id=?",
+                    (row["actual_member_count"], row["actual_total_business_level"], row["actual_total_fear"], row["id"]),
+                )
+    if drift:
+        logger.warning("Gang aggregates drifted for %d gangs%s", len(drift), " (repaired)" if repair else "")
+    return drift
 
 async def get_gang_upgrades(db, gang_id):
     cursor = await db.execute("SELECT upgrade_id, level FROM gang_upgrades WHERE gang_id=?", (gang_id,))
@@ -1767,8 +2234,7 @@ def get_gang_raid_reduction(gang_ups):
 @app.post("/api/gang/create")
 async def create_gang(req: GangCreateRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if player["gang_id"]: raise HTTPException(400, "Already in a gang")
@@ -1784,23 +2250,22 @@ async def create_gang(req: GangCreateRequest):
             )
             gang_id = cursor.lastrowid
             await db.execute("INSERT INTO gang_members (telegram_id, gang_id, role) VALUES (?, ?, 'leader')", (req.telegram_id, gang_id))
+            await add_gang_totals(db, gang_id, 1, get_player_level(owned), player["reputation_fear"])
             await db.execute("UPDATE players SET gang_id=?, cash=cash-? WHERE telegram_id=?", (gang_id, GANG_CREATE_COST, req.telegram_id))
+            await invalidate_income_profile(db, req.telegram_id)
             await gang_log(db, gang_id, f"🎉 {player['username']} создал банду")
-            await db.commit()
+            await scheduler.schedule(db, "boss_spawn", gang_id, time.time())
             await track_action(db, req.telegram_id, "gang_join")
+            await check_achievements(db, req.telegram_id, ("gang_id",))
 
             player = await get_player(db, req.telegram_id)
             return {"player": player, "gang_id": gang_id, "gang_name": req.name}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/join")
 async def join_gang(req: GangJoinRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if player["gang_id"]: raise HTTPException(400, "Already in a gang")
@@ -1809,29 +2274,26 @@ async def join_gang(req: GangJoinRequest):
             gang = await cursor.fetchone()
             if not gang: raise HTTPException(404, "Gang not found")
 
-            cursor = await db.execute("SELECT COUNT(*) as cnt FROM gang_members WHERE gang_id=?", (req.gang_id,))
-            count = (await cursor.fetchone())["cnt"]
-            if count >= GANG_MAX_MEMBERS: raise HTTPException(400, "Gang is full")
+            if gang["member_count"] >= GANG_MAX_MEMBERS: raise HTTPException(400, "Gang is full")
 
+            player, _ = await sync_earnings(db, player, await get_owned_businesses(db, req.telegram_id))
             await db.execute("INSERT INTO gang_members (telegram_id, gang_id) VALUES (?, ?)", (req.telegram_id, req.gang_id))
+            await add_member_totals(db, req.gang_id, player)
             await db.execute("UPDATE players SET gang_id=? WHERE telegram_id=?", (req.gang_id, req.telegram_id))
+            await invalidate_income_profile(db, req.telegram_id)
             await db.execute("UPDATE gangs SET power=power+1 WHERE id=?", (req.gang_id,))
             await gang_log(db, req.gang_id, f"👤 {player['username']} вступил в банду")
-            await db.commit()
             await track_action(db, req.telegram_id, "gang_join")
+            await check_achievements(db, req.telegram_id, ("gang_id", "gang_territories"))
 
             player = await get_player(db, req.telegram_id)
             return {"player": player, "gang": dict(gang)}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/leave")
 async def leave_gang(req: GangLeaveRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if not player["gang_id"]: raise HTTPException(400, "Not in a gang")
@@ -1841,8 +2303,11 @@ async def leave_gang(req: GangLeaveRequest):
             member = await cursor.fetchone()
             is_leader = member and member["role"] == "leader"
 
+            player, _ = await sync_earnings(db, player, await get_owned_businesses(db, req.telegram_id))
             await db.execute("DELETE FROM gang_members WHERE telegram_id=?", (req.telegram_id,))
+            await add_member_totals(db, gang_id, player, -1)
             await db.execute("UPDATE players SET gang_id=0 WHERE telegram_id=?", (req.telegram_id,))
+            await invalidate_income_profile(db, req.telegram_id)
             await db.execute("UPDATE gangs SET power=MAX(0,power-1) WHERE id=?", (gang_id,))
             await gang_log(db, gang_id, f"🚪 {player['username']} покинул банду")
 
@@ -1857,20 +2322,16 @@ async def leave_gang(req: GangLeaveRequest):
                     await db.execute("DELETE FROM gangs WHERE id=?", (gang_id,))
                     await db.execute("DELETE FROM gang_upgrades WHERE gang_id=?", (gang_id,))
                     await db.execute("UPDATE territories SET owner_gang_id=NULL WHERE owner_gang_id=?", (gang_id,))
+                    await invalidate_gang_income_profiles(db, gang_id)
 
-            await db.commit()
             player = await get_player(db, req.telegram_id)
             return {"player": player}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/kick")
 async def kick_member(req: GangKickRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player or not player["gang_id"]: raise HTTPException(400, "Not in a gang")
 
@@ -1884,23 +2345,21 @@ async def kick_member(req: GangKickRequest):
             target = await cursor.fetchone()
             if not target: raise HTTPException(404, "Member not found")
 
+            await checkpoint_earnings(db, [req.target_id])
             target_player = await get_player(db, req.target_id)
             await db.execute("DELETE FROM gang_members WHERE telegram_id=?", (req.target_id,))
+            await add_member_totals(db, player["gang_id"], target_player, -1)
             await db.execute("UPDATE players SET gang_id=0 WHERE telegram_id=?", (req.target_id,))
+            await invalidate_income_profile(db, req.target_id)
             await db.execute("UPDATE gangs SET power=MAX(0,power-1) WHERE id=?", (player["gang_id"],))
             await gang_log(db, player["gang_id"], f"❌ {target_player['username']} кикнут из банды")
-            await db.commit()
             return {"ok": True}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/deposit")
 async def gang_deposit(req: GangDepositRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player or not player["gang_id"]: raise HTTPException(400, "Not in a gang")
             validate_amount(req.amount, "amount")
@@ -1912,22 +2371,17 @@ async def gang_deposit(req: GangDepositRequest):
             await db.execute("UPDATE players SET cash=cash-? WHERE telegram_id=?", (req.amount, req.telegram_id))
             await db.execute("UPDATE gangs SET cash_bank=cash_bank+? WHERE id=?", (req.amount, player["gang_id"]))
             await gang_log(db, player["gang_id"], f"💰 {player['username']} внёс ${int(req.amount):,}")
-            await db.commit()
 
             player = await get_player(db, req.telegram_id)
             cursor = await db.execute("SELECT * FROM gangs WHERE id=?", (player["gang_id"],))
             gang = dict(await cursor.fetchone())
             return {"player": player, "gang": gang}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/withdraw")
 async def gang_withdraw(req: GangWithdrawRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player or not player["gang_id"]: raise HTTPException(400, "Not in a gang")
 
@@ -1944,22 +2398,17 @@ async def gang_withdraw(req: GangWithdrawRequest):
             await db.execute("UPDATE gangs SET cash_bank=cash_bank-? WHERE id=?", (req.amount, player["gang_id"]))
             await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (req.amount, req.telegram_id))
             await gang_log(db, player["gang_id"], f"💸 Лидер снял ${int(req.amount):,} из банка")
-            await db.commit()
 
             player = await get_player(db, req.telegram_id)
             cursor = await db.execute("SELECT * FROM gangs WHERE id=?", (player["gang_id"],))
             gang = dict(await cursor.fetchone())
             return {"player": player, "gang": gang}
 
-        finally:
-            await db.close()
-
 
 @app.post("/api/gang/upgrade")
 async def gang_upgrade(req: GangUpgradeRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player or not player["gang_id"]: raise HTTPException(400, "Not in a gang")
 
@@ -1980,40 +2429,34 @@ async def gang_upgrade(req: GangUpgradeRequest):
             if gang["cash_bank"] < cost: raise HTTPException(400, f"Need ${cost:,} in gang bank")
 
             await db.execute("UPDATE gangs SET cash_bank=cash_bank-? WHERE id=?", (cost, player["gang_id"]))
+            await checkpoint_gang_earnings(db, player["gang_id"])
             await db.execute(
                 "INSERT INTO gang_upgrades (gang_id, upgrade_id, level) VALUES (?,?,1) ON CONFLICT(gang_id, upgrade_id) DO UPDATE SET level=?",
                 (player["gang_id"], req.upgrade_id, current_level + 1),
             )
+            await invalidate_gang_income_profiles(db, player["gang_id"])
 
             new_level = current_level + 1
             bonus = cfg["bonuses"][new_level - 1]
             await gang_log(db, player["gang_id"], f"⬆️ {cfg['emoji']} {cfg['name']} улучшен до ур.{new_level} (+{bonus}{'%' if cfg['bonus_type'] != 'attack_power' else ''})")
-            await db.commit()
 
             cursor = await db.execute("SELECT * FROM gangs WHERE id=?", (player["gang_id"],))
             gang = dict(await cursor.fetchone())
             gang_ups = await get_gang_upgrades(db, player["gang_id"])
             return {"gang": gang, "gang_upgrades": gang_ups}
 
-        finally:
-            await db.close()
-
 
 @app.get("/api/gangs")
 async def list_gangs():
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT g.*, COUNT(gm.telegram_id) as members FROM gangs g LEFT JOIN gang_members gm ON g.id=gm.gang_id GROUP BY g.id ORDER BY g.power DESC LIMIT 50")
+    async with transaction() as db:
+        cursor = await db.execute("SELECT *, member_count AS members FROM gangs ORDER BY power DESC LIMIT 50")
         gangs = [dict(r) for r in await cursor.fetchall()]
         return {"gangs": gangs}
-    finally:
-        await db.close()
 
 
 @app.get("/api/gang/{gang_id}")
 async def get_gang(gang_id: int):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         cursor = await db.execute("SELECT * FROM gangs WHERE id=?", (gang_id,))
         gang = await cursor.fetchone()
         if not gang: raise HTTPException(404, "Not found")
@@ -2027,19 +2470,26 @@ async def get_gang(gang_id: int):
         cursor = await db.execute("SELECT message, created_at FROM gang_log WHERE gang_id=? ORDER BY id DESC LIMIT 20", (gang_id,))
         log = [dict(r) for r in await cursor.fetchall()]
         return {"gang": gang, "members": members, "gang_upgrades": gang_ups, "gang_log": log, "gang_upgrades_config": GANG_UPGRADES}
-    finally:
-        await db.close()
 
 
 # ── PvP ──
 
+async def index_pvp_player(db, player, owned=None):
+    """Refresh the player's matchmaking entry once the transaction commits. Returns their power."""
+    tid = player["telegram_id"]
+    if owned is None:
+        owned = await get_owned_businesses(db, tid)
+    power = get_player_level(owned) + player["reputation_fear"] + player["reputation_respect"]
+    gang_id, cooldown_until = player.get("gang_id"), player.get("pvp_cooldown_ts", 0)
+    db.on_commit(lambda: pvp_index.update(tid, power, gang_id, cooldown_until))
+    return power
+
 @app.post("/api/pvp/attack")
 async def pvp_attack(req: PvpAttackRequest):
     lock1_id, lock2_id = sorted([req.telegram_id, req.target_id])
     async with get_player_lock(lock1_id):
       async with get_player_lock(lock2_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             attacker = await get_player(db, req.telegram_id)
             if not attacker: raise HTTPException(404, "Player not found")
             defender = await get_player(db, req.target_id)
@@ -2099,12 +2549,13 @@ async def pvp_attack(req: PvpAttackRequest):
 
             # Set PvP cooldown
             await db.execute("UPDATE players SET pvp_cooldown_ts=? WHERE telegram_id=?", (now + PVP_COOLDOWN_SECONDS, req.telegram_id))
+            await index_pvp_player(db, dict(attacker, pvp_cooldown_ts=now + PVP_COOLDOWN_SECONDS), a_owned)
+            await index_pvp_player(db, defender, d_owned)
 
             await db.execute(
                 "INSERT INTO pvp_log (attacker_id, defender_id, winner_id, cash_stolen) VALUES (?,?,?,?)",
                 (req.telegram_id, req.target_id, winner_id, steal),
             )
-            await db.commit()
 
             await track_action(db, req.telegram_id, "pvp_attack")
             bounty_claimed = 0
@@ -2128,13 +2579,13 @@ async def pvp_attack(req: PvpAttackRequest):
                     await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (b["reward"], req.telegram_id))
                     bounty_claimed += b["reward"]
                     await notify_player(db, b["poster_id"], f"🎯 Контракт выполнен! {attacker.get('username', 'Аноним')} устранил цель.")
-                if bounty_claimed:
-                    await db.commit()
 
             # Notify defender
             await notify_player(db, req.target_id, f"⚔️ На тебя напал {'и победил' if win else 'но проиграл'} игрок {attacker.get('username', 'Аноним')}! {'Украдено' if win else 'Ты отбился и украл'}: ${int(steal):,}")
 
             attacker = await get_player(db, req.telegram_id)
+            if win:
+                await check_achievements(db, req.telegram_id, ("pvp_wins",), attacker)
 
             return {
                 "win": win,
@@ -2145,9 +2596,6 @@ async def pvp_attack(req: PvpAttackRequest):
                 "bounty_claimed": bounty_claimed,
             }
 
-        finally:
-            await db.close()
-
 
 # ── Bribes (Взятки) ──
 
@@ -2157,8 +2605,7 @@ class BribeRequest(BaseModel):
 @app.post("/api/bribe")
 async def pay_bribe(req: BribeRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
 
@@ -2191,7 +2638,6 @@ async def pay_bribe(req: BribeRequest):
                 "UPDATE players SET cash=cash-?, suspicion=?, bribe_cooldown_ts=? WHERE telegram_id=?",
                 (cost, new_susp, now + BRIBE_CONFIG["cooldown"], req.telegram_id),
             )
-            await db.commit()
 
             player = await get_player(db, req.telegram_id)
             return {
@@ -2200,8 +2646,6 @@ async def pay_bribe(req: BribeRequest):
                 "reduction": reduction,
                 "new_suspicion": new_susp,
             }
-        finally:
-            await db.close()
 
 
 # ── Bounties (Контракты) ──
@@ -2214,8 +2658,7 @@ class BountyCreateRequest(BaseModel):
 @app.post("/api/bounty/create")
 async def create_bounty(req: BountyCreateRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             if req.telegram_id == req.target_id:
                 raise HTTPException(400, "Нельзя на себя")
 
@@ -2261,38 +2704,34 @@ async def create_bounty(req: BountyCreateRequest):
                 "UPDATE players SET cash=cash-? WHERE telegram_id=?",
                 (total_cost, req.telegram_id),
             )
-            await db.execute(
+            cursor = await db.execute(
                 "INSERT INTO bounties (poster_id, target_id, reward) VALUES (?,?,?)",
                 (req.telegram_id, req.target_id, reward),
             )
-            await db.commit()
+            await scheduler.schedule(db, "bounty_expire", cursor.lastrowid, time.time() + BOUNTY_CONFIG["duration"])
 
             # Notify target
             await notify_player(db, req.target_id, f"🎯 На тебя выставлен контракт! Награда: ${int(reward):,}")
 
             player = await get_player(db, req.telegram_id)
             return {"player": player, "cost": total_cost, "fee": fee}
-        finally:
-            await db.close()
 
 
+@scheduler.job("bounty_expire")
+async def bounty_expire_job(db, bounty_id, payload):
+    """Expire an unclaimed bounty and refund its poster."""
+    cursor = await db.execute(
+        "UPDATE bounties SET status='expired' WHERE id=? AND status='active' RETURNING poster_id, reward",
+        (int(bounty_id),),
+    )
+    bounty = await cursor.fetchone()
+    await cursor.fetchall()
+    if bounty:
+        await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (bounty["reward"], bounty["poster_id"]))
+
 @app.get("/api/bounties")
 async def list_bounties():
-    db = await get_db()
-    try:
-        now = time.time()
-        # Expire old bounties (refund poster)
-        cursor = await db.execute(
-            "SELECT * FROM bounties WHERE status='active' AND created_at + ? < ?",
-            (BOUNTY_CONFIG["duration"], now),
-        )
-        expired = [dict(r) for r in await cursor.fetchall()]
-        for b in expired:
-            await db.execute("UPDATE bounties SET status='expired' WHERE id=?", (b["id"],))
-            await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (b["reward"], b["poster_id"]))
-        if expired:
-            await db.commit()
-
+    async with transaction() as db:
         cursor = await db.execute(
             "SELECT b.*, p1.username as poster_name, p2.username as target_name "
             "FROM bounties b "
@@ -2302,8 +2741,6 @@ async def list_bounties():
         )
         bounties = [dict(r) for r in await cursor.fetchall()]
         return {"bounties": bounties}
-    finally:
-        await db.close()
 
 
 # ── Trade-Up (Обмен предметов) ──
@@ -2315,8 +2752,7 @@ class TradeUpRequest(BaseModel):
 @app.post("/api/trade-up")
 async def trade_up(req: TradeUpRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
 
@@ -2382,8 +2818,6 @@ async def trade_up(req: TradeUpRequest):
                     (req.telegram_id, won_item_id),
                 )
 
-            await db.commit()
-
             inventory = await get_inventory(db, req.telegram_id)
             player = await get_player(db, req.telegram_id)
             return {
@@ -2396,113 +2830,214 @@ async def trade_up(req: TradeUpRequest):
                 "source_rarity": rarity,
                 "result_rarity": next_rarity,
             }
-        finally:
-            await db.close()
 
 
 # ── Upgrades ──
 
-@app.post("/api/upgrade")
-async def buy_upgrade(req: UpgradeRequest):
-    async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
-            player = await get_player(db, req.telegram_id)
-            if not player: raise HTTPException(404, "Player not found")
-            owned = await get_owned_businesses(db, req.telegram_id)
-            player, _ = await sync_earnings(db, player, owned)
+async def _do_buy_upgrade(db, req: UpgradeRequest):
+    player = await get_player(db, req.telegram_id)
 
-            cfg = UPGRADES.get(req.upgrade_id)
-            if not cfg: raise HTTPException(400, "Unknown upgrade")
+    cfg = UPGRADES.get(req.upgrade_id)
+    if not cfg: raise HTTPException(400, "Unknown upgrade")
 
-            upgrades = await get_upgrades(db, req.telegram_id)
-            existing = next((u for u in upgrades if u["upgrade_id"] == req.upgrade_id), None)
-            current_level = existing["level"] if existing else 0
-            cost = cfg["base_cost"] * (cfg["cost_multiplier"] ** current_level)
+    upgrades = await get_upgrades(db, req.telegram_id)
+    existing = next((u for u in upgrades if u["upgrade_id"] == req.upgrade_id), None)
+    current_level = existing["level"] if existing else 0
+    cost = cfg["base_cost"] * (cfg["cost_multiplier"] ** current_level)
 
-            if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
+    if player["cash"] < cost: raise HTTPException(400, "Not enough cash")
 
-            new_cash = player["cash"] - cost
+    if existing:
+        await db.execute("UPDATE player_upgrades SET level=? WHERE id=? AND telegram_id=?", (current_level + 1, existing["id"], req.telegram_id))
+    else:
+        await db.execute("INSERT INTO player_upgrades (telegram_id, upgrade_id, level) VALUES (?,?,1)", (req.telegram_id, req.upgrade_id))
+    await invalidate_income_profile(db, req.telegram_id)
+
+    effect = cfg["effect"]
+    if effect == "suspicion_reset":
+        await db.execute("UPDATE players SET cash=cash-?, suspicion=0 WHERE telegram_id=?", (cost, req.telegram_id))
+    elif effect == "income_boost_10":
+        await db.execute("UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+5, reputation_fear=reputation_fear+5 WHERE telegram_id=?", (cost, req.telegram_id))
+        await add_gang_totals(db, player["gang_id"], fear=5)
+    elif effect == "territory":
+        await db.execute("UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+3, reputation_fear=reputation_fear+3 WHERE telegram_id=?", (cost, req.telegram_id))
+        await add_gang_totals(db, player["gang_id"], fear=3)
+    elif effect == "pvp_defense":
+        await db.execute("UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+5 WHERE telegram_id=?", (cost, req.telegram_id))
+    else:
+        await db.execute("UPDATE players SET cash=cash-? WHERE telegram_id=?", (cost, req.telegram_id))
+    return {"upgrade_id": req.upgrade_id, "level": current_level + 1, "cost": cost}
 
-            if existing:
-                await db.execute("UPDATE player_upgrades SET level=? WHERE id=?", (current_level + 1, existing["id"]))
-            else:
-                await db.execute("INSERT INTO player_upgrades (telegram_id, upgrade_id, level) VALUES (?,?,1)", (req.telegram_id, req.upgrade_id))
-
-            effect = cfg["effect"]
-            if effect == "suspicion_reset":
-                await db.execute("UPDATE players SET cash=?, suspicion=0 WHERE telegram_id=?", (new_cash, req.telegram_id))
-            elif effect == "income_boost_10":
-                await db.execute("UPDATE players SET cash=?, reputation_respect=reputation_respect+5, reputation_fear=reputation_fear+5 WHERE telegram_id=?", (new_cash, req.telegram_id))
-            elif effect == "territory":
-                await db.execute("UPDATE players SET cash=?, reputation_respect=reputation_respect+3, reputation_fear=reputation_fear+3 WHERE telegram_id=?", (new_cash, req.telegram_id))
-            elif effect == "pvp_defense":
-                await db.execute("UPDATE players SET cash=?, reputation_respect=reputation_respect+5 WHERE telegram_id=?", (new_cash, req.telegram_id))
-            else:
-                await db.execute("UPDATE players SET cash=? WHERE telegram_id=?", (new_cash, req.telegram_id))
+@app.post("/api/upgrade")
+async def buy_upgrade(req: UpgradeRequest):
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            await sync_player(db, req.telegram_id)
+            await _do_buy_upgrade(db, req)
 
-            await db.commit()
             player = await get_player(db, req.telegram_id)
             upgrades = await get_upgrades(db, req.telegram_id)
             return {"player": player, "upgrades": upgrades}
 
-        finally:
-            await db.close()
-
 
 @app.get("/api/pvp/targets/{telegram_id}")
 async def pvp_targets(telegram_id: int):
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT telegram_id, username, reputation_fear, reputation_respect FROM players WHERE telegram_id != ? ORDER BY RANDOM() LIMIT 5",
-            (telegram_id,),
-        )
-        targets = [dict(r) for r in await cursor.fetchall()]
-        return {"targets": targets}
-    finally:
-        await db.close()
+    """Near-power, recently active opponents from the matchmaking index."""
+    async with transaction() as db:
+        player = await get_player(db, telegram_id)
+        if not player: raise HTTPException(404, "Player not found")
+        power = await index_pvp_player(db, player)
+        gang_id = player.get("gang_id") or 0
+        # Draw spares: the index is a snapshot, so gang and cooldown are re-checked on the live rows
+        candidates = pvp_index.sample(power, PVP_TARGET_COUNT * 2, exclude_tid=telegram_id, exclude_gang=gang_id)
+        targets = []
+        if candidates:
+            cursor = await db.execute(
+                "SELECT telegram_id, username, reputation_fear, reputation_respect, gang_id, pvp_cooldown_ts FROM players "
+                f"WHERE telegram_id IN ({','.join('?' * len(candidates))})",
+                tuple(candidates),
+            )
+            rows = {r["telegram_id"]: dict(r) for r in await cursor.fetchall()}
+            now = time.time()
+            for tid in candidates:
+                row = rows.get(tid)
+                if row is None:
+                    pvp_index.remove(tid)
+                    continue
+                if (gang_id and row["gang_id"] == gang_id) or (row["pvp_cooldown_ts"] or 0) > now:
+                    continue
+                targets.append({
+                    "telegram_id": tid, "username": row["username"],
+                    "reputation_fear": row["reputation_fear"], "reputation_respect": row["reputation_respect"],
+                    "power": pvp_index.power(tid),
+                })
+                if len(targets) >= PVP_TARGET_COUNT:
+                    break
+        return {"targets": targets, "power": power}
 
 
 # ── Leaderboard ──
 
+async def leaderboard_rows(db, entries):
+    """Attach player columns to [(rank, telegram_id, total_earned)] from the in-memory ranking."""
+    if not entries:
+        return []
+    cursor = await db.execute(
+        "SELECT telegram_id, username, cash, reputation_fear, reputation_respect FROM players "
+        f"WHERE telegram_id IN ({','.join('?' * len(entries))})",
+        tuple(tid for _, tid, _ in entries),
+    )
+    players = {r["telegram_id"]: dict(r) for r in await cursor.fetchall()}
+    return [
+        dict(players[tid], rank=rank, total_earned=total)
+        for rank, tid, total in entries if tid in players
+    ]
+
 @app.get("/api/leaderboard")
-async def leaderboard():
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT telegram_id, username, cash, total_earned, reputation_fear, reputation_respect FROM players ORDER BY total_earned DESC LIMIT 20")
-        players = [dict(r) for r in await cursor.fetchall()]
-        return {"leaderboard": players}
-    finally:
-        await db.close()
+async def get_leaderboard():
+    async with transaction() as db:
+        players = await leaderboard_rows(db, leaderboard.top(LEADERBOARD_SIZE))
+        return {"leaderboard": players, "total_players": len(leaderboard)}
+
+@app.get("/api/leaderboard/{telegram_id}")
+async def get_leaderboard_rank(telegram_id: int):
+    """The player's place and the players just above and below."""
+    rank = leaderboard.rank(telegram_id)
+    if rank is None: raise HTTPException(404, "Player not found")
+    async with transaction() as db:
+        around = await leaderboard_rows(db, leaderboard.around(telegram_id, LEADERBOARD_RADIUS))
+        return {"rank": rank, "total_players": len(leaderboard), "around": around}
 
 
 # ── Mission Claim ──
 
+async def _do_claim_mission(db, req: MissionClaimRequest):
+    cursor = await db.execute(
+        "SELECT * FROM daily_missions WHERE id=? AND telegram_id=?",
+        (req.mission_id, req.telegram_id),
+    )
+    mission = await cursor.fetchone()
+    if not mission: raise HTTPException(400, "Mission not found")
+    mission = dict(mission)
+    if not mission["completed"]: raise HTTPException(400, "Not completed")
+    if mission["claimed"]: raise HTTPException(400, "Already claimed")
+
+    await db.execute("UPDATE daily_missions SET claimed=1 WHERE id=?", (mission["id"],))
+    await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (mission["reward"], req.telegram_id))
+    return {"mission_id": mission["id"], "reward": mission["reward"]}
+
 @app.post("/api/mission/claim")
 async def claim_mission(req: MissionClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
-        cursor = await db.execute(
-            "SELECT * FROM daily_missions WHERE id=? AND telegram_id=?",
-            (req.mission_id, req.telegram_id),
-        )
-        mission = await cursor.fetchone()
-        if not mission: raise HTTPException(400, "Mission not found")
-        mission = dict(mission)
-        if not mission["completed"]: raise HTTPException(400, "Not completed")
-        if mission["claimed"]: raise HTTPException(400, "Already claimed")
-
-        await db.execute("UPDATE daily_missions SET claimed=1 WHERE id=?", (mission["id"],))
-        await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (mission["reward"], req.telegram_id))
-        await db.commit()
+    async with transaction() as db:
+        await _do_claim_mission(db, req)
 
         player = await get_player(db, req.telegram_id)
         missions = await get_daily_missions(db, req.telegram_id)
         return {"player": player, "daily_missions": missions}
-    finally:
-        await db.close()
+
+
+# ── Batch ──
+
+BATCH_MAX_ACTIONS = int(os.getenv("BATCH_MAX_ACTIONS", "50"))
+
+BATCH_ACTIONS = {
+    "buy": (BuyRequest, _do_buy_business),
+    "manager": (ManagerRequest, _do_hire_manager),
+    "upgrade": (UpgradeRequest, _do_buy_upgrade),
+    "equip": (EquipRequest, _do_equip_item),
+    "mission_claim": (MissionClaimRequest, _do_claim_mission),
+}
+
+@app.post("/api/batch")
+async def run_batch(req: BatchRequest):
+    """Run actions in order under one lock hold, one transaction and one earnings sync.
+
+    Each action runs in its own savepoint: a failed action is rolled back and
+    reported, and the rest still apply — same outcome as separate calls.
+    """
+    if not req.actions:
+        raise HTTPException(400, "No actions")
+    if len(req.actions) > BATCH_MAX_ACTIONS:
+        raise HTTPException(400, f"Too many actions (max {BATCH_MAX_ACTIONS})")
+    for a in req.actions:
+        if a.action not in BATCH_ACTIONS:
+            raise HTTPException(400, f"Unknown action: {a.action}")
+
+    async with get_player_lock(req.telegram_id):
+        async with transaction() as db:
+            await sync_player(db, req.telegram_id)
+            results = []
+            for i, a in enumerate(req.actions):
+                model, handler = BATCH_ACTIONS[a.action]
+                try:
+                    action_req = model(**{**a.params, "telegram_id": req.telegram_id})
+                except ValueError as e:
+                    results.append({"ok": False, "status": 422, "detail": str(e)})
+                    continue
+                try:
+                    async with savepoint(db, f"batch_{i}"):
+                        result = await handler(db, action_req)
+                    results.append({"ok": True, **result})
+                except HTTPException as e:
+                    results.append({"ok": False, "status": e.status_code, "detail": e.detail})
+
+            player = await get_player(db, req.telegram_id)
+            owned = await get_owned_businesses(db, req.telegram_id)
+            profile = await get_income_profile(db, player)
+            income_per_sec, suspicion_per_sec = calc_player_income(player, owned, profile)
+            return {
+                "results": results,
+                "player": player,
+                "businesses": owned,
+                "upgrades": await get_upgrades(db, req.telegram_id),
+                "character": await get_character(db, req.telegram_id),
+                "inventory": await get_inventory(db, req.telegram_id),
+                "daily_missions": await get_daily_missions(db, req.telegram_id),
+                "income_per_sec": income_per_sec,
+                "suspicion_per_sec": suspicion_per_sec,
+                "player_level": get_player_level(owned),
+            }
 
 
 # ── Login Claim ──
@@ -2510,8 +3045,7 @@ async def claim_mission(req: MissionClaimRequest):
 @app.post("/api/login/claim")
 async def claim_login(req: LoginClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         login_data = await check_login_streak(db, req.telegram_id)
         if not login_data["can_claim"]:
             raise HTTPException(400, "Already claimed today")
@@ -2537,7 +3071,6 @@ async def claim_login(req: LoginClaimRequest):
             await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (reward_cfg["amount"], req.telegram_id))
             await db.execute("INSERT INTO player_cases (telegram_id, case_id) VALUES (?,?)", (req.telegram_id, reward_cfg["case_id"]))
 
-        await db.commit()
         player = await get_player(db, req.telegram_id)
         player_cases = await get_player_cases(db, req.telegram_id)
 
@@ -2549,8 +3082,6 @@ async def claim_login(req: LoginClaimRequest):
             "streak": new_streak,
             "login_data": {"can_claim": False, "streak": new_streak, "reward_day": reward_day},
         }
-    finally:
-        await db.close()
 
 
 # ── Prestige ──
@@ -2558,8 +3089,7 @@ async def claim_login(req: LoginClaimRequest):
 @app.post("/api/prestige")
 async def do_prestige(req: PrestigeRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -2593,15 +3123,17 @@ async def do_prestige(req: PrestigeRequest):
                     await db.execute("UPDATE gangs SET cash_bank=0 WHERE id=?", (player["gang_id"],))
 
             # Reset businesses, cash, reputation — keep items, gang, prestige, talents
+            await add_gang_totals(db, player.get("gang_id"), business_level=-player_level, fear=start_fear - player["reputation_fear"])
             await db.execute("DELETE FROM player_businesses WHERE telegram_id=?", (req.telegram_id,))
             await db.execute("DELETE FROM player_upgrades WHERE telegram_id=?", (req.telegram_id,))
+            await invalidate_income_profile(db, req.telegram_id)
             await db.execute(
                 "UPDATE players SET cash=?, suspicion=0, reputation_fear=?, reputation_respect=0, "
                 "total_earned=0, total_robberies=0, robbery_cooldown_ts=0, pvp_cooldown_ts=0, "
                 "prestige_level=?, prestige_multiplier=?, talent_points=talent_points+1 WHERE telegram_id=?",
                 (start_cash, start_fear, new_prestige, new_multiplier, req.telegram_id),
             )
-            await db.commit()
+            db.on_commit(lambda: leaderboard.update(req.telegram_id, 0.0))
 
             player = await get_player(db, req.telegram_id)
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -2616,17 +3148,13 @@ async def do_prestige(req: PrestigeRequest):
                 "talent_points": player.get("talent_points", 0),
             }
 
-        finally:
-            await db.close()
-
 
 # ── Talent Tree ──
 
 @app.post("/api/talent/assign")
 async def assign_talent(req: TalentAssignRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
 
@@ -2647,11 +3175,11 @@ async def assign_talent(req: TalentAssignRequest):
                 "ON CONFLICT(telegram_id, talent_id) DO UPDATE SET level=level+1",
                 (req.telegram_id, req.talent_id),
             )
+            await invalidate_income_profile(db, req.telegram_id)
             await db.execute(
                 "UPDATE players SET talent_points=talent_points-1 WHERE telegram_id=?",
                 (req.telegram_id,),
             )
-            await db.commit()
 
             player = await get_player(db, req.telegram_id)
             talents = await get_player_talents(db, req.telegram_id)
@@ -2661,30 +3189,23 @@ async def assign_talent(req: TalentAssignRequest):
                 "talent_points": player.get("talent_points", 0),
             }
 
-        finally:
-            await db.close()
-
 
 # ── Territories ──
 
 @app.get("/api/territories")
 async def get_territories():
-    db = await get_db()
-    try:
+    async with transaction() as db:
         cursor = await db.execute(
             "SELECT t.*, g.name as gang_name, g.tag as gang_tag FROM territories t LEFT JOIN gangs g ON g.id=t.owner_gang_id"
         )
         territories = [dict(r) for r in await cursor.fetchall()]
         return {"territories": territories}
-    finally:
-        await db.close()
 
 
 @app.post("/api/territory/attack")
 async def territory_attack(req: TerritoryAttackRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if not player["gang_id"]: raise HTTPException(400, "Not in a gang")
@@ -2718,13 +3239,7 @@ async def territory_attack(req: TerritoryAttackRequest):
             # Calculate attacker strength (includes gang armory bonus)
             atk_gang_ups = await get_gang_upgrades(db, player["gang_id"])
             atk_armory_bonus = get_gang_attack_bonus(atk_gang_ups)
-            cursor = await db.execute(
-                "SELECT SUM(pb.level) as total_level FROM gang_members gm JOIN player_businesses pb ON pb.telegram_id=gm.telegram_id WHERE gm.gang_id=?",
-                (player["gang_id"],),
-            )
-            atk_row = await cursor.fetchone()
-            atk_level = (atk_row["total_level"] or 0) if atk_row else 0
-            atk_power = atk_level + gang["power"] + atk_armory_bonus + random.randint(0, 30)
+            atk_power = gang["total_business_level"] + gang["power"] + atk_armory_bonus + random.randint(0, 30)
 
             # Defender strength (includes their armory bonus)
             def_power = 0
@@ -2732,16 +3247,10 @@ async def territory_attack(req: TerritoryAttackRequest):
             if defender_gang_id:
                 def_gang_ups = await get_gang_upgrades(db, defender_gang_id)
                 def_armory_bonus = get_gang_attack_bonus(def_gang_ups)
-                cursor = await db.execute(
-                    "SELECT SUM(pb.level) as total_level FROM gang_members gm JOIN player_businesses pb ON pb.telegram_id=gm.telegram_id WHERE gm.gang_id=?",
-                    (defender_gang_id,),
-                )
-                def_row = await cursor.fetchone()
-                def_level = (def_row["total_level"] or 0) if def_row else 0
-                cursor = await db.execute("SELECT power FROM gangs WHERE id=?", (defender_gang_id,))
+                cursor = await db.execute("SELECT power, total_business_level FROM gangs WHERE id=?", (defender_gang_id,))
                 def_gang = await cursor.fetchone()
-                def_gang_power = def_gang["power"] if def_gang else 0
-                def_power = def_level + def_gang_power + def_armory_bonus + 10 + random.randint(0, 30)  # +10 defender bonus
+                def_strength = def_gang["total_business_level"] + def_gang["power"] if def_gang else 0
+                def_power = def_strength + def_armory_bonus + 10 + random.randint(0, 30)  # +10 defender bonus
 
             win = atk_power > def_power
 
@@ -2749,11 +3258,16 @@ async def territory_attack(req: TerritoryAttackRequest):
             await db.execute("UPDATE gangs SET last_territory_attack_ts=? WHERE id=?", (now, player["gang_id"]))
 
             if win:
+                await checkpoint_gang_earnings(db, player["gang_id"])
+                await checkpoint_gang_earnings(db, defender_gang_id)
                 await db.execute(
                     "UPDATE territories SET owner_gang_id=?, captured_at=? WHERE id=?",
                     (player["gang_id"], now, req.territory_id),
                 )
+                await invalidate_gang_income_profiles(db, player["gang_id"])
+                await invalidate_gang_income_profiles(db, defender_gang_id)
                 await track_action(db, req.telegram_id, "territory_capture")
+                await check_gang_achievements(db, player["gang_id"])
                 # Increment gang war score for territory capture
                 await increment_war_score(db, player["gang_id"], "territory_capture")
                 # Notify defender gang
@@ -2768,7 +3282,6 @@ async def territory_attack(req: TerritoryAttackRequest):
                 "INSERT INTO territory_wars_log (territory_id, attacker_gang_id, defender_gang_id, winner_gang_id, attacker_power, defender_power) VALUES (?,?,?,?,?,?)",
                 (req.territory_id, player["gang_id"], defender_gang_id, player["gang_id"] if win else defender_gang_id, atk_power, def_power),
             )
-            await db.commit()
 
             # Fetch updated territories
             cursor = await db.execute(
@@ -2784,28 +3297,21 @@ async def territory_attack(req: TerritoryAttackRequest):
                 "territories": territories,
             }
 
-        finally:
-            await db.close()
-
 
 # ── Achievements ──
 
 @app.get("/api/achievements/{telegram_id}")
 async def get_achievements(telegram_id: int):
-    db = await get_db()
-    try:
-        await check_achievements(db, telegram_id)
+    async with transaction() as db:
+        await check_achievements(db, telegram_id, tuple(ACHIEVEMENTS_BY_FIELD))
         achievements = await get_player_achievements(db, telegram_id)
         return {"achievements": achievements, "achievements_config": ACHIEVEMENTS}
-    finally:
-        await db.close()
 
 
 @app.post("/api/achievement/claim")
 async def claim_achievement(req: AchievementClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         cursor = await db.execute(
             "SELECT * FROM player_achievements WHERE telegram_id=? AND achievement_id=?",
             (req.telegram_id, req.achievement_id),
@@ -2818,15 +3324,12 @@ async def claim_achievement(req: AchievementClaimRequest):
         ach_cfg = next((a for a in ACHIEVEMENTS if a["id"] == req.achievement_id), None)
         if not ach_cfg: raise HTTPException(400, "Unknown achievement")
 
-        await db.execute("UPDATE player_achievements SET claimed=1 WHERE id=?", (ach["id"],))
+        await db.execute("UPDATE player_achievements SET claimed=1 WHERE id=? AND telegram_id=?", (ach["id"], req.telegram_id))
         await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (ach_cfg["reward"], req.telegram_id))
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         achievements = await get_player_achievements(db, req.telegram_id)
         return {"player": player, "achievements": achievements}
-    finally:
-        await db.close()
 
 
 # ── Ad Reward ──
@@ -2834,8 +3337,7 @@ async def claim_achievement(req: AchievementClaimRequest):
 @app.post("/api/ad/reward")
 async def ad_reward(req: AdRewardRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
 
@@ -2879,13 +3381,9 @@ async def ad_reward(req: AdRewardRequest):
             else:
                 raise HTTPException(400, "Unknown reward type")
 
-            await db.commit()
             player = await get_player(db, req.telegram_id)
             return {"player": player, "reward": result}
 
-        finally:
-            await db.close()
-
 
 # ── Stars Invoice ──
 
@@ -2911,7 +3409,7 @@ async def create_stars_invoice(req: StarsInvoiceRequest):
     try:
         async with httpx.AsyncClient() as client:
             resp = await client.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/createInvoiceLink",
+                f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/createInvoiceLink",
                 json={
                     "title": f"Shadow Empire — {label}",
                     "description": label,
@@ -2933,21 +3431,20 @@ async def create_stars_invoice(req: StarsInvoiceRequest):
 
 @app.get("/api/vip/status/{telegram_id}")
 async def get_vip_status(telegram_id: int):
-    db = await get_db()
-    try:
-        player = await get_player(db, telegram_id)
-        if not player: raise HTTPException(404, "Player not found")
-        vip = is_vip_active(player)
-        days_left = 0
-        if vip:
-            days_left = max(0, int((player.get("vip_until", 0) - time.time()) / 86400))
-        return {
-            "is_vip": vip,
-            "vip_until": player.get("vip_until", 0),
-            "days_left": days_left,
-        }
-    finally:
-        await db.close()
+    player = player_cache.peek(telegram_id, "players")
+    if player is None:
+        async with transaction() as db:
+            player = await get_player(db, telegram_id)
+    if not player: raise HTTPException(404, "Player not found")
+    vip = is_vip_active(player)
+    days_left = 0
+    if vip:
+        days_left = max(0, int((player.get("vip_until", 0) - time.time()) / 86400))
+    return {
+        "is_vip": vip,
+        "vip_until": player.get("vip_until", 0),
+        "days_left": days_left,
+    }
 
 
 # ── VIP Daily Case ──
@@ -2955,8 +3452,7 @@ async def get_vip_status(telegram_id: int):
 @app.post("/api/vip/daily-case")
 async def claim_vip_daily_case(req: VipDailyCaseRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player: raise HTTPException(404, "Player not found")
         if not is_vip_active(player): raise HTTPException(400, "VIP not active")
@@ -2974,13 +3470,10 @@ async def claim_vip_daily_case(req: VipDailyCaseRequest):
             "UPDATE players SET last_vip_case_claim=? WHERE telegram_id=?",
             (today, req.telegram_id),
         )
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         player_cases = await get_player_cases(db, req.telegram_id)
         return {"player": player, "player_cases": player_cases, "message": "Бесплатный премиум кейс получен!"}
-    finally:
-        await db.close()
 
 
 # ── VIP Item Claim ──
@@ -2988,8 +3481,7 @@ async def claim_vip_daily_case(req: VipDailyCaseRequest):
 @app.post("/api/vip/claim-item")
 async def claim_vip_item(req: VipItemClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player: raise HTTPException(404, "Player not found")
         if not is_vip_active(player): raise HTTPException(400, "VIP not active")
@@ -3009,13 +3501,10 @@ async def claim_vip_item(req: VipItemClaimRequest):
             "INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)",
             (req.telegram_id, req.item_id),
         )
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         inventory = await get_inventory(db, req.telegram_id)
         return {"player": player, "inventory": inventory, "item": item}
-    finally:
-        await db.close()
 
 
 # ── Business Skins ──
@@ -3028,40 +3517,34 @@ async def get_equipped_skins(db, telegram_id):
     cursor = await db.execute("SELECT business_id, skin_id FROM business_equipped_skins WHERE telegram_id=?", (telegram_id,))
     return {r["business_id"]: r["skin_id"] for r in await cursor.fetchall()}
 
+# Skin pools and the cumulative rarity table, built once: roll_skin is a bisect and a choice
+SKINS_BY_RARITY: dict[str, list] = {}
+for _sid, _skin in BUSINESS_SKINS.items():
+    SKINS_BY_RARITY.setdefault(_skin["rarity"], []).append(_sid)
+SKIN_RARITY_IDS = list(SKIN_RARITIES)
+SKIN_RARITY_CUMULATIVE = list(itertools.accumulate(r["chance"] for r in SKIN_RARITIES.values()))
+
 def roll_skin(vip_boost=False):
     """Roll a random skin based on rarity chances."""
-    skins_by_rarity = {}
-    for sid, s in BUSINESS_SKINS.items():
-        skins_by_rarity.setdefault(s["rarity"], []).append(sid)
-
-    # Build weighted rarity list
-    rarities = list(SKIN_RARITIES.items())
     roll = random.random()
     if vip_boost:
         roll *= 0.7  # VIP gets 30% better odds (shifts toward rarer)
 
-    cumulative = 0
-    chosen_rarity = "common"
-    for rarity_id, rarity_cfg in rarities:
-        cumulative += rarity_cfg["chance"]
-        if roll < cumulative:
-            chosen_rarity = rarity_id
-            break
-
-    pool = skins_by_rarity.get(chosen_rarity, skins_by_rarity["common"])
+    i = bisect.bisect_right(SKIN_RARITY_CUMULATIVE, roll)
+    chosen_rarity = SKIN_RARITY_IDS[i] if i < len(SKIN_RARITY_IDS) else "common"
+    pool = SKINS_BY_RARITY.get(chosen_rarity, SKINS_BY_RARITY["common"])
     return random.choice(pool)
 
 
 @app.post("/api/skin/open")
 async def open_skin_case(req: SkinCaseOpenRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player: raise HTTPException(404, "Player not found")
 
         vip = is_vip_active(player)
-        count = max(1, min(req.count, 50))
+        count = max(1, min(req.count, SKIN_CASE_OPEN_MAX_COUNT))
         results = []
 
         if req.case_type == "vip":
@@ -3084,16 +3567,20 @@ async def open_skin_case(req: SkinCaseOpenRequest):
             case_rows = await cursor.fetchall()
             if not case_rows: raise HTTPException(400, "No skin cases")
 
-            for case_row in case_rows:
-                await db.execute("DELETE FROM player_cases WHERE id=?", (case_row["id"],))
-                skin_id = roll_skin(vip_boost=False)
-                await db.execute("INSERT INTO player_skins (telegram_id, skin_id) VALUES (?, ?)", (req.telegram_id, skin_id))
+            case_ids = [r["id"] for r in case_rows]
+            await db.execute(
+                f"DELETE FROM player_cases WHERE id IN ({','.join('?' * len(case_ids))})", tuple(case_ids)
+            )
+            skin_ids = [roll_skin(vip_boost=False) for _ in case_ids]
+            await db.executemany(
+                "INSERT INTO player_skins (telegram_id, skin_id) VALUES (?, ?)",
+                [(req.telegram_id, skin_id) for skin_id in skin_ids],
+            )
+            for skin_id in skin_ids:
                 skin_cfg = BUSINESS_SKINS[skin_id]
-                rarity_cfg = SKIN_RARITIES[skin_cfg["rarity"]]
-                results.append({"skin_id": skin_id, "skin": skin_cfg, "rarity": rarity_cfg})
-
-        await db.commit()
+                results.append({"skin_id": skin_id, "skin": skin_cfg, "rarity": SKIN_RARITIES[skin_cfg["rarity"]]})
 
+        await check_achievements(db, req.telegram_id, ("skins_count",))
         player_skins = await get_player_skins(db, req.telegram_id)
         player_cases = await get_player_cases(db, req.telegram_id)
 
@@ -3113,15 +3600,12 @@ async def open_skin_case(req: SkinCaseOpenRequest):
             "player_skins": player_skins,
             "player_cases": player_cases,
         }
-    finally:
-        await db.close()
 
 
 @app.post("/api/skin/equip")
 async def equip_skin(req: SkinEquipRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player: raise HTTPException(404, "Player not found")
 
@@ -3143,12 +3627,9 @@ async def equip_skin(req: SkinEquipRequest):
                 "INSERT INTO business_equipped_skins (telegram_id, business_id, skin_id) VALUES (?,?,?) ON CONFLICT(telegram_id, business_id) DO UPDATE SET skin_id=?",
                 (req.telegram_id, req.business_id, req.skin_id, req.skin_id),
             )
-        await db.commit()
 
         equipped = await get_equipped_skins(db, req.telegram_id)
         return {"equipped_skins": equipped}
-    finally:
-        await db.close()
 
 
 @app.get("/api/skins/config")
@@ -3183,45 +3664,42 @@ async def ton_create_payment(req: TonCreateRequest):
     }
 
 
+async def claim_ton_payment(db, telegram_id: int, comment: str, min_value: int):
+    """Mark the oldest unclaimed indexed transfer with this comment as used; its hash, or None."""
+    cursor = await db.execute(
+        "UPDATE ton_transactions SET claimed_by=?, claimed_at=? WHERE hash=("
+        "SELECT hash FROM ton_transactions WHERE comment=? AND value>=? AND claimed_at IS NULL ORDER BY lt LIMIT 1"
+        ") RETURNING hash",
+        (telegram_id, time.time(), comment, min_value),
+    )
+    row = await cursor.fetchone()
+    await cursor.fetchall()
+    return row["hash"] if row else None
+
+
 @app.post("/api/ton/verify")
 async def ton_verify_payment(req: TonVerifyRequest):
-    """Verify a TON transaction on-chain and activate the purchase."""
-    db = await get_db()
-    try:
+    """Activate a purchase paid on-chain, looked up in the local TON transaction index."""
+    ton_price = TON_PRICES.get(req.package_id)
+    if ton_price is None:
+        raise HTTPException(400, "Unknown package")
+    # Comments come from /api/ton/create and name the buyer and the package
+    if not req.comment.startswith(f"se_{req.telegram_id}_{req.package_id}_"):
+        raise HTTPException(400, "Invalid payment comment")
+    min_value = int(int(ton_price * 1e9) * 0.95)  # 5% tolerance
+
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player: raise HTTPException(404, "Player not found")
 
-        # Check if tx_hash was already used
-        cursor = await db.execute(
-            "SELECT id FROM premium_transactions WHERE amount=? AND payment_method='ton'",
-            (req.tx_hash,),
-        )
-        if await cursor.fetchone():
-            raise HTTPException(400, "Transaction already processed")
-
-        # Verify on-chain via TON Center API
-        verified = False
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            resp = await client.get(
-                f"https://toncenter.com/api/v2/getTransactions",
-                params={"address": TON_WALLET_ADDRESS, "limit": 20},
+        tx_hash = await claim_ton_payment(db, req.telegram_id, req.comment, min_value)
+        if tx_hash is None:
+            cursor = await db.execute(
+                "SELECT 1 FROM ton_transactions WHERE comment=? AND claimed_at IS NOT NULL", (req.comment,)
             )
-            if resp.status_code == 200:
-                data = resp.json()
-                for tx in data.get("result", []):
-                    msg = tx.get("in_msg", {})
-                    body = msg.get("message", "")
-                    value = int(msg.get("value", "0"))
-                    if req.comment and req.comment in body and value > 0:
-                        # Verify amount matches expected price
-                        ton_price = TON_PRICES.get(req.package_id, {}).get("ton", 999)
-                        expected_nano = int(float(ton_price) * 1e9)
-                        if value < int(expected_nano * 0.95):  # 5% tolerance
-                            continue
-                        verified = True
-                        break
-
-        if not verified:
+            if await cursor.fetchone():
+                raise HTTPException(400, "Transaction already processed")
+            ton_indexer.poke()
             return {"status": "pending", "message": "Транзакция ещё не найдена. Подожди 1-2 минуты и нажми проверить снова."}
 
         # Activate purchase
@@ -3248,6 +3726,7 @@ async def ton_verify_payment(req: TonVerifyRequest):
                 base = max(current_until, now)
                 new_until = base + days * 86400
                 await db.execute("UPDATE players SET is_vip=1, vip_until=? WHERE telegram_id=?", (new_until, req.telegram_id))
+                await scheduler.schedule(db, "vip_expire", req.telegram_id, new_until)
 
         elif req.package_id in CASH_PACKAGES:
             await db.execute("UPDATE players SET cash=cash+? WHERE telegram_id=?", (pkg["cash"], req.telegram_id))
@@ -3260,32 +3739,29 @@ async def ton_verify_payment(req: TonVerifyRequest):
         # Log transaction
         await db.execute(
             "INSERT INTO premium_transactions (telegram_id, package_id, payment_method, amount) VALUES (?,?,?,?)",
-            (req.telegram_id, req.package_id, "ton", req.tx_hash),
+            (req.telegram_id, req.package_id, "ton", tx_hash),
         )
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         return {"status": "ok", "message": "Покупка активирована!", "player": player}
-    finally:
-        await db.close()
 
 
 # ── Tournament Leaderboard ──
 
 @app.get("/api/tournament/leaderboard")
 async def tournament_leaderboard():
-    db = await get_db()
-    try:
+    async with transaction() as db:
         day = today_utc()
-        cursor = await db.execute(
-            "SELECT ts.telegram_id, ts.score, p.username FROM tournament_scores ts "
-            "JOIN players p ON p.telegram_id=ts.telegram_id WHERE ts.day=? ORDER BY ts.score DESC LIMIT 20",
-            (day,),
-        )
-        rows = [dict(r) for r in await cursor.fetchall()]
+        top = await get_tournament_top(db, day, 20)
+        names = {}
+        if top:
+            cursor = await db.execute(
+                f"SELECT telegram_id, username FROM players WHERE telegram_id IN ({','.join('?' * len(top))})",
+                tuple(tid for tid, _ in top),
+            )
+            names = {r["telegram_id"]: r["username"] for r in await cursor.fetchall()}
+        rows = [{"telegram_id": tid, "score": score, "username": names[tid]} for tid, score in top if tid in names]
         return {"leaderboard": rows, "day": day, "prizes": TOURNAMENT_PRIZES}
-    finally:
-        await db.close()
 
 
 # ── Event Claim ──
@@ -3293,8 +3769,7 @@ async def tournament_leaderboard():
 @app.post("/api/event/claim")
 async def claim_event_milestone(req: EventClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         ev = get_active_event()
         if not ev:
             raise HTTPException(400, "No active event")
@@ -3329,13 +3804,10 @@ async def claim_event_milestone(req: EventClaimRequest):
             "UPDATE player_event_progress SET rewards_claimed=? WHERE telegram_id=? AND event_id=?",
             (new_claimed, req.telegram_id, ev["id"]),
         )
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         event_progress = await get_event_progress(db, req.telegram_id, ev["id"])
         return {"player": player, "event_progress": event_progress}
-    finally:
-        await db.close()
 
 
 # ── Season Pass Claim ──
@@ -3343,8 +3815,7 @@ async def claim_event_milestone(req: EventClaimRequest):
 @app.post("/api/season/claim")
 async def claim_season_reward(req: SeasonClaimRequest):
   async with get_player_lock(req.telegram_id):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         sp = await get_season_pass(db, req.telegram_id)
         level = calc_season_level(sp["xp"])
 
@@ -3387,14 +3858,11 @@ async def claim_season_reward(req: SeasonClaimRequest):
             f"ON CONFLICT(telegram_id) DO UPDATE SET {claimed_field}=?",
             (req.telegram_id, season_id, new_claimed, new_claimed),
         )
-        await db.commit()
 
         player = await get_player(db, req.telegram_id)
         season_pass = await get_season_pass(db, req.telegram_id)
         player_cases = await get_player_cases(db, req.telegram_id)
         return {"player": player, "season_pass": season_pass, "player_cases": player_cases}
-    finally:
-        await db.close()
 
 
 # ── Boss Attack ──
@@ -3402,8 +3870,7 @@ async def claim_season_reward(req: SeasonClaimRequest):
 @app.post("/api/boss/attack")
 async def boss_attack(req: BossAttackRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if not player.get("gang_id") or player["gang_id"] != req.gang_id:
@@ -3416,12 +3883,9 @@ async def boss_attack(req: BossAttackRequest):
                 remaining = int(BOSS_ATTACK_COOLDOWN - (now - last_attack))
                 raise HTTPException(400, f"Cooldown: {remaining}s")
 
-            # Get boss
-            cursor = await db.execute("SELECT * FROM active_bosses WHERE gang_id=? AND defeated=0", (req.gang_id,))
-            boss_row = await cursor.fetchone()
-            if not boss_row:
+            cursor = await db.execute("SELECT 1 FROM active_bosses WHERE gang_id=? AND defeated=0", (req.gang_id,))
+            if not await cursor.fetchone():
                 raise HTTPException(400, "No active boss")
-            boss_row = dict(boss_row)
 
             # Calculate damage
             owned = await get_owned_businesses(db, req.telegram_id)
@@ -3433,15 +3897,17 @@ async def boss_attack(req: BossAttackRequest):
                 armory_bonus = get_gang_attack_bonus(gang_ups)
             damage = calc_attack_damage(player_level, player["reputation_fear"], equip_bonus, armory_bonus)
 
-            new_hp = max(0, boss_row["current_health"] - damage)
-            defeated = 1 if new_hp <= 0 else 0
-
-            await db.execute("UPDATE active_bosses SET current_health=?, defeated=? WHERE gang_id=? AND defeated=0",
-                             (new_hp, defeated, req.gang_id))
-            await db.execute("INSERT INTO boss_attack_log (gang_id, telegram_id, damage) VALUES (?,?,?)",
-                             (req.gang_id, req.telegram_id, damage))
+            boss_row = await add_boss_damage(db, req.gang_id, damage)
+            if not boss_row:
+                raise HTTPException(400, "No active boss")
+            defeated = boss_row["defeated"]
+            await db.execute(
+                "INSERT INTO boss_damage (gang_id, boss_id, telegram_id, damage, updated_at) VALUES (?,?,?,?,?) "
+                "ON CONFLICT(gang_id, boss_id, telegram_id) DO UPDATE SET "
+                "damage=damage+excluded.damage, updated_at=excluded.updated_at",
+                (req.gang_id, boss_row["boss_id"], req.telegram_id, damage, now),
+            )
             await db.execute("UPDATE players SET last_boss_attack_ts=? WHERE telegram_id=?", (now, req.telegram_id))
-            await db.commit()
 
             rewards = None
             if defeated:
@@ -3450,9 +3916,7 @@ async def boss_attack(req: BossAttackRequest):
                 boss_name = boss_row["boss_id"]
                 boss_cfg = next((b for b in BOSSES if b["id"] == boss_name), None)
                 display_name = boss_cfg["name"] if boss_cfg else boss_name
-                cursor_members = await db.execute("SELECT telegram_id FROM players WHERE gang_id=?", (req.gang_id,))
-                for m in await cursor_members.fetchall():
-                    await notify_player(db, m["telegram_id"], f"👹 Босс {display_name} повержен! Награды распределены 💰")
+                await notify_gang(db, req.gang_id, f"👹 Босс {display_name} повержен! Награды распределены 💰")
                 # Spawn next boss
                 await spawn_boss_for_gang(db, req.gang_id)
                 rewards = {"boss_defeated": True, "boss_name": boss_name}
@@ -3461,39 +3925,38 @@ async def boss_attack(req: BossAttackRequest):
             player = await get_player(db, req.telegram_id)
             return {"damage": damage, "boss_data": boss_data, "player": player, "rewards": rewards}
 
-        finally:
-            await db.close()
-
 
 @app.get("/api/boss/{gang_id}")
 async def get_boss(gang_id: int):
-    db = await get_db()
-    try:
-        await spawn_boss_for_gang(db, gang_id)
+    async with transaction() as db:
         boss_data = await get_boss_data(db, gang_id)
         return {"boss_data": boss_data}
-    finally:
-        await db.close()
 
 
 # ── Telegram Notifications ──
 
-async def send_telegram_notification(telegram_id: int, text: str):
-    """Send a Telegram notification to a player. Non-blocking, graceful failure."""
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            await client.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                json={"chat_id": telegram_id, "text": text, "parse_mode": "HTML"},
-            )
-    except Exception:
-        pass  # graceful failure (user blocked bot, etc.)
-
 async def notify_player(db, telegram_id: int, text: str):
-    """Send notification if player has notifications enabled."""
+    """Notify once the transaction commits: over the stream to open sessions, and
+    through the Telegram dispatcher if the player has notifications enabled."""
     player = await get_player(db, telegram_id)
-    if player and player.get("notifications_enabled", 1):
-        asyncio.create_task(send_telegram_notification(telegram_id, text))
+    if not player:
+        return
+    db.on_commit(lambda: stream_hub.publish(telegram_id, "notification", {"text": text}))
+    if player.get("notifications_enabled", 1):
+        db.on_commit(lambda: notifier.enqueue(telegram_id, text))
+
+async def notify_gang(db, gang_id: int, text: str):
+    """notify_player for every member of a gang, with one query."""
+    cursor = await db.execute(
+        "SELECT p.telegram_id, p.notifications_enabled FROM gang_members gm "
+        "JOIN players p ON p.telegram_id=gm.telegram_id WHERE gm.gang_id=?",
+        (gang_id,),
+    )
+    for row in await cursor.fetchall():
+        tid = row["telegram_id"]
+        db.on_commit(lambda tid=tid: stream_hub.publish(tid, "notification", {"text": text}))
+        if row["notifications_enabled"]:
+            db.on_commit(lambda tid=tid: notifier.enqueue(tid, text))
 
 
 class NotificationToggleRequest(BaseModel):
@@ -3501,17 +3964,13 @@ class NotificationToggleRequest(BaseModel):
 
 @app.post("/api/notifications/toggle")
 async def toggle_notifications(req: NotificationToggleRequest):
-    db = await get_db()
-    try:
+    async with transaction() as db:
         player = await get_player(db, req.telegram_id)
         if not player:
             raise HTTPException(404, "Player not found")
         new_val = 0 if player.get("notifications_enabled", 1) else 1
         await db.execute("UPDATE players SET notifications_enabled=? WHERE telegram_id=?", (new_val, req.telegram_id))
-        await db.commit()
         return {"notifications_enabled": new_val}
-    finally:
-        await db.close()
 
 
 # ── Gang Wars ──
@@ -3523,8 +3982,7 @@ class GangWarDeclareRequest(BaseModel):
 @app.post("/api/gang/war/declare")
 async def gang_war_declare(req: GangWarDeclareRequest):
     async with get_player_lock(req.telegram_id):
-        db = await get_db()
-        try:
+        async with transaction() as db:
             player = await get_player(db, req.telegram_id)
             if not player: raise HTTPException(404, "Player not found")
             if not player["gang_id"]: raise HTTPException(400, "Not in a gang")
@@ -3558,10 +4016,11 @@ async def gang_war_declare(req: GangWarDeclareRequest):
 
             # Deduct cost and create war
             await db.execute("UPDATE gangs SET cash_bank=cash_bank-? WHERE id=?", (GANG_WAR_CONFIG["declare_cost"], player["gang_id"]))
-            await db.execute(
+            cursor = await db.execute(
                 "INSERT INTO gang_wars (attacker_gang_id, defender_gang_id) VALUES (?,?)",
                 (player["gang_id"], req.target_gang_id),
             )
+            await scheduler.schedule(db, "war_finalize", cursor.lastrowid, time.time() + GANG_WAR_CONFIG["duration"])
             await gang_log(db, player["gang_id"], f"⚔️ Объявлена война банде #{req.target_gang_id}!")
             await gang_log(db, req.target_gang_id, f"⚔️ Банда #{player['gang_id']} объявила войну!")
 
@@ -3569,62 +4028,55 @@ async def gang_war_declare(req: GangWarDeclareRequest):
             target_gang = dict(target_gang)
             await notify_player(db, target_gang["leader_id"], f"⚔️ Вашей банде объявлена война!")
 
-            await db.commit()
             return {"status": "war_declared", "target_gang_id": req.target_gang_id}
-        finally:
-            await db.close()
 
 
-async def check_and_finalize_wars(db):
-    """Auto-finalize expired wars."""
+@scheduler.job("war_finalize")
+async def finalize_war(db, war_id, payload):
+    """Settle a war whose time is up: pay both banks, log and notify the leaders."""
     now = time.time()
-    cursor = await db.execute(
-        "SELECT * FROM gang_wars WHERE status='active' AND started_at + ? < ?",
-        (GANG_WAR_CONFIG["duration"], now),
-    )
-    wars = [dict(r) for r in await cursor.fetchall()]
-    for war in wars:
-        if war["attacker_score"] > war["defender_score"]:
-            winner = war["attacker_gang_id"]
-            loser = war["defender_gang_id"]
-        elif war["defender_score"] > war["attacker_score"]:
-            winner = war["defender_gang_id"]
-            loser = war["attacker_gang_id"]
-        else:
-            winner = 0
-            loser = 0
+    cursor = await db.execute("SELECT * FROM gang_wars WHERE id=? AND status='active'", (int(war_id),))
+    war = await cursor.fetchone()
+    if not war:
+        return
+    war = dict(war)
+    if war["attacker_score"] > war["defender_score"]:
+        winner = war["attacker_gang_id"]
+        loser = war["defender_gang_id"]
+    elif war["defender_score"] > war["attacker_score"]:
+        winner = war["defender_gang_id"]
+        loser = war["attacker_gang_id"]
+    else:
+        winner = 0
+        loser = 0
 
-        await db.execute(
-            "UPDATE gang_wars SET status='finished', ended_at=?, winner_gang_id=? WHERE id=?",
-            (now, winner, war["id"]),
-        )
-        if winner:
-            await db.execute("UPDATE gangs SET cash_bank=cash_bank+? WHERE id=?", (GANG_WAR_CONFIG["winner_reward"], winner))
-            await db.execute("UPDATE gangs SET cash_bank=cash_bank+? WHERE id=?", (GANG_WAR_CONFIG["loser_reward"], loser))
-            await gang_log(db, winner, f"🏆 Война выиграна! +${GANG_WAR_CONFIG['winner_reward']:,} в банк")
-            await gang_log(db, loser, f"😞 Война проиграна. +${GANG_WAR_CONFIG['loser_reward']:,} утешительный приз")
-            # Notify both gang leaders
-            for gid, result in [(winner, "🏆 Ваша банда победила!"), (loser, "😞 Ваша банда проиграла.")]:
-                c = await db.execute("SELECT leader_id FROM gangs WHERE id=?", (gid,))
-                g = await c.fetchone()
-                if g:
-                    await notify_player(db, g["leader_id"], f"⚔️ Война окончена! {result}")
-        else:
-            for gid in [war["attacker_gang_id"], war["defender_gang_id"]]:
-                await gang_log(db, gid, "🤝 Война окончена ничьей")
-                c = await db.execute("SELECT leader_id FROM gangs WHERE id=?", (gid,))
-                g = await c.fetchone()
-                if g:
-                    await notify_player(db, g["leader_id"], "⚔️ Война окончена! 🤝 Ничья.")
-    if wars:
-        await db.commit()
+    await db.execute(
+        "UPDATE gang_wars SET status='finished', ended_at=?, winner_gang_id=? WHERE id=?",
+        (now, winner, war["id"]),
+    )
+    if winner:
+        await db.execute("UPDATE gangs SET cash_bank=cash_bank+? WHERE id=?", (GANG_WAR_CONFIG["winner_reward"], winner))
+        await db.execute("UPDATE gangs SET cash_bank=cash_bank+? WHERE id=?", (GANG_WAR_CONFIG["loser_reward"], loser))
+        await gang_log(db, winner, f"🏆 Война выиграна! +${GANG_WAR_CONFIG['winner_reward']:,} в банк")
+        await gang_log(db, loser, f"😞 Война проиграна. +${GANG_WAR_CONFIG['loser_reward']:,} утешительный приз")
+        # Notify both gang leaders
+        for gid, result in [(winner, "🏆 Ваша банда победила!"), (loser, "😞 Ваша банда проиграла.")]:
+            c = await db.execute("SELECT leader_id FROM gangs WHERE id=?", (gid,))
+            g = await c.fetchone()
+            if g:
+                await notify_player(db, g["leader_id"], f"⚔️ Война окончена! {result}")
+    else:
+        for gid in [war["attacker_gang_id"], war["defender_gang_id"]]:
+            await gang_log(db, gid, "🤝 Война окончена ничьей")
+            c = await db.execute("SELECT leader_id FROM gangs WHERE id=?", (gid,))
+            g = await c.fetchone()
+            if g:
+                await notify_player(db, g["leader_id"], "⚔️ Война окончена! 🤝 Ничья.")
 
 
 @app.get("/api/gang/war/{gang_id}")
 async def get_gang_war(gang_id: int):
-    db = await get_db()
-    try:
-        await check_and_finalize_wars(db)
+    async with transaction() as db:
         cursor = await db.execute(
             "SELECT gw.*, g1.name as attacker_name, g1.tag as attacker_tag, g2.name as defender_name, g2.tag as defender_tag "
             "FROM gang_wars gw "
@@ -3636,8 +4088,6 @@ async def get_gang_war(gang_id: int):
         )
         wars = [dict(r) for r in await cursor.fetchall()]
         return {"wars": wars, "config": GANG_WAR_CONFIG}
-    finally:
-        await db.close()
 
 
 # Increment war scores in territory_attack and pvp_attack
@@ -3660,7 +4110,41 @@ async def increment_war_score(db, gang_id: int, score_type: str):
         await db.execute("UPDATE gang_wars SET attacker_score=attacker_score+? WHERE id=?", (score, war["id"]))
     else:
         await db.execute("UPDATE gang_wars SET defender_score=defender_score+? WHERE id=?", (score, war["id"]))
-    await db.commit()
+
+
+# ── Scheduled jobs ──
+
+async def schedule_pending_jobs(db):
+    """Queue jobs for state that predates the scheduler (or lost its row); safe to run on every boot."""
+    now = time.time()
+    await db.execute(
+        "INSERT OR IGNORE INTO scheduled_jobs (kind, key, due_at) "
+        "SELECT 'bounty_expire', id, created_at + ? FROM bounties WHERE status='active'",
+        (BOUNTY_CONFIG["duration"],),
+    )
+    await db.execute(
+        "INSERT OR IGNORE INTO scheduled_jobs (kind, key, due_at) "
+        "SELECT 'war_finalize', id, started_at + ? FROM gang_wars WHERE status='active'",
+        (GANG_WAR_CONFIG["duration"],),
+    )
+    await db.execute(
+        "INSERT OR IGNORE INTO scheduled_jobs (kind, key, due_at) "
+        "SELECT 'vip_expire', telegram_id, vip_until FROM players WHERE is_vip=1",
+    )
+    await db.execute(
+        "INSERT OR IGNORE INTO scheduled_jobs (kind, key, due_at) "
+        "SELECT 'boss_spawn', g.id, ? FROM gangs g "
+        "WHERE NOT EXISTS (SELECT 1 FROM active_bosses b WHERE b.gang_id=g.id AND b.defeated=0)",
+        (now,),
+    )
+    # Yesterday's settlement is a no-op if it already ran
+    await db.execute(
+        "INSERT OR IGNORE INTO scheduled_jobs (kind, key, due_at) VALUES ('tournament_settle', ?, ?)",
+        (yesterday_utc(), now),
+    )
+    cursor = await db.execute("SELECT 1 FROM scheduled_jobs WHERE kind='tournament_settle' AND key=?", (today_utc(),))
+    if not await cursor.fetchone():
+        await schedule_tournament_settlement(db, today_utc())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+"""
+PvP matchmaking index (GET /api/pvp/targets).
+
+Players are bucketed by defensive power — the d_power formula in pvp_attack:
+level + fear + respect — in PVP_BUCKET_WIDTH-wide buckets. Each bucket is a
+list plus a position map, so adding, moving, removing and drawing a random
+member are all O(1). Targets are drawn from the requester's bucket first and
+then from neighbouring buckets outward until enough are found.
+
+Only players seen within PVP_ACTIVE_WINDOW are kept; stale entries are
+dropped when a draw lands on them. Entries are snapshots refreshed whenever
+the player logs in, looks for targets or fights, so the caller re-checks gang
+and cooldown against the live row before showing a target.
+"""
+
+import logging
+import os
+import random
+import time
+
+PVP_BUCKET_WIDTH = int(os.getenv("PVP_BUCKET_WIDTH", "10"))
+PVP_ACTIVE_WINDOW = float(os.getenv("PVP_ACTIVE_WINDOW", str(3 * 86400)))
+
+logger = logging.getLogger(__name__)
+
+
+class _Bucket:
+    __slots__ = ("members", "pos")
+
+    def __init__(self):
+        self.members: list[int] = []
+        self.pos: dict[int, int] = {}
+
+    def add(self, tid):
+        self.pos[tid] = len(self.members)
+        self.members.append(tid)
+
+    def remove(self, tid):
+        i = self.pos.pop(tid)
+        last = self.members.pop()
+        if last != tid:
+            self.members[i] = last
+            self.pos[last] = i
+
+
+class PvpIndex:
+    def __init__(self, bucket_width=PVP_BUCKET_WIDTH, active_window=PVP_ACTIVE_WINDOW):
+        self.bucket_width = bucket_width
+        self.active_window = active_window
+        self._buckets: dict[int, _Bucket] = {}
+        # tid -> (bucket, power, gang_id, cooldown_until, last_seen)
+        self._players: dict[int, tuple] = {}
+
+    def __len__(self):
+        return len(self._players)
+
+    def power(self, tid):
+        entry = self._players.get(tid)
+        return entry[1] if entry else None
+
+    # ── Updates ──
+
+    def update(self, tid, power, gang_id, cooldown_until, last_seen=None):
+        bucket = max(0, int(power)) // self.bucket_width
+        old = self._players.get(tid)
+        if old is None or old[0] != bucket:
+            if old is not None:
+                self._remove_from_bucket(tid, old[0])
+            self._buckets.setdefault(bucket, _Bucket()).add(tid)
+        self._players[tid] = (bucket, power, gang_id or 0, cooldown_until or 0, last_seen or time.time())
+
+    def remove(self, tid):
+        old = self._players.pop(tid, None)
+        if old is not None:
+            self._remove_from_bucket(tid, old[0])
+
+    def _remove_from_bucket(self, tid, bucket):
+        members = self._buckets[bucket]
+        members.remove(tid)
+        if not members.members:
+            del self._buckets[bucket]
+
+    async def load(self, db):
+        """Index players active within the window, powers computed in SQL."""
+        self._buckets, self._players = {}, {}
+        cursor = await db.execute(
+            "SELECT p.telegram_id, p.reputation_fear + p.reputation_respect + COALESCE(SUM(b.level), 0) AS power, "
+            "p.gang_id, p.pvp_cooldown_ts, p.last_collect_ts FROM players p "
+            "LEFT JOIN player_businesses b ON b.telegram_id=p.telegram_id "
+            "WHERE p.last_collect_ts > ? GROUP BY p.telegram_id",
+            (time.time() - self.active_window,),
+        )
+        for row in await cursor.fetchall():
+            self.update(row["telegram_id"], row["power"], row["gang_id"], row["pvp_cooldown_ts"], row["last_collect_ts"])
+        logger.info("PvP index loaded: %d active players in %d buckets", len(self), len(self._buckets))
+
+    # ── Sampling ──
+
+    def _draw(self, bucket, draws):
+        """Random members of a bucket: a shuffle when it is small, else independent picks."""
+        members = self._buckets[bucket].members
+        if len(members) <= draws:
+            return random.sample(members, len(members))
+        return [members[random.randrange(len(members))] for _ in range(draws)]
+
+    def sample(self, power, count, exclude_tid=None, exclude_gang=0):
+        """Up to count distinct eligible tids, nearest power buckets first."""
+        now = time.time()
+        home = max(0, int(power)) // self.bucket_width
+        highest = max(self._buckets, default=-1)
+        picked: list[int] = []
+        seen = {exclude_tid}
+        for distance in range(max(home, highest - home) + 1):
+            for bucket in ((home,) if distance == 0 else (home - distance, home + distance)):
+                if bucket not in self._buckets:
+                    continue
+                for tid in self._draw(bucket, count * 2):
+                    if tid in seen or tid not in self._players:
+                        continue
+                    seen.add(tid)
+                    _, _, gang_id, cooldown_until, last_seen = self._players[tid]
+                    if now - last_seen > self.active_window:
+                        self.remove(tid)
+                    elif cooldown_until <= now and not (exclude_gang and gang_id == exclude_gang):
+                        picked.append(tid)
+                        if len(picked) >= count:
+                            return picked
+        return picked
+
+
+pvp_index = PvpIndex()
@@ -0,0 +1,212 @@
+"""
+Telegram notification dispatcher.
+
+notify_player() hands committed messages to notifier.enqueue(), which never
+blocks a request. One background loop sends them over a single keep-alive
+httpx client:
+
+- Messages for a chat that is already waiting are merged into one message
+  (coalescing), so a burst of events reaches the player as a single message.
+- Token buckets keep to Telegram's limits: about NOTIFY_GLOBAL_RATE messages
+  per second overall, and NOTIFY_CHAT_RATE per second to a single chat. A
+  chat over its limit is put back for later instead of holding up the others.
+- On 429 the sender waits for Telegram's retry_after. On 5xx or a network
+  error it backs off exponentially, up to NOTIFY_MAX_ATTEMPTS tries. Other
+  4xx errors (for example, the user blocked the bot) are final.
+- The queue is bounded by NOTIFY_QUEUE_SIZE chats. When it is full, new
+  chats are dropped and counted.
+
+TELEGRAM_API_BASE points the client at another Bot API server, such as a
+local fake in tests. stats() returns the counters.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "10000"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "8"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+NOTIFY_BACKOFF = float(os.getenv("NOTIFY_BACKOFF", "1"))
+NOTIFY_TIMEOUT = float(os.getenv("NOTIFY_TIMEOUT", "10"))
+MAX_MESSAGE_LENGTH = 4096
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Take a token if one is available (0.0); otherwise seconds until one is."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class NotificationDispatcher:
+    def __init__(self, token="", base_url=TELEGRAM_API_BASE):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self._pending: dict[int, list[str]] = {}  # chat -> texts not yet sent
+        self._attempts: dict[int, int] = {}
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._global = TokenBucket(NOTIFY_GLOBAL_RATE)
+        self._ready: asyncio.Queue | None = None
+        self._inflight: set[asyncio.Task] = set()
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+        self.metrics = {"enqueued": 0, "coalesced": 0, "sent": 0, "retried": 0, "failed": 0, "dropped": 0}
+
+    # ── Enqueueing ──
+
+    def enqueue(self, chat_id, text):
+        """Queue text for chat_id; merged into the chat's pending message if it has one."""
+        self.metrics["enqueued"] += 1
+        if self._ready is None:
+            self.metrics["dropped"] += 1
+            return
+        texts = self._pending.get(chat_id)
+        if texts is not None:
+            texts.append(text)
+            self.metrics["coalesced"] += 1
+            return
+        if self._ready.qsize() >= NOTIFY_QUEUE_SIZE:
+            self.metrics["dropped"] += 1
+            logger.warning("Notification queue full; dropped message for %s", chat_id)
+            return
+        self._pending[chat_id] = [text]
+        self._ready.put_nowait(chat_id)
+
+    def _requeue_later(self, chat_id, delay):
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    # ── Dispatch ──
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        while True:
+            chat_id = await self._ready.get()
+            if chat_id not in self._pending:
+                continue
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(NOTIFY_CHAT_RATE, 1))
+            wait = bucket.delay()
+            if wait > 0:
+                self._requeue_later(chat_id, wait)
+                continue
+            while (wait := self._global.delay()) > 0:
+                await asyncio.sleep(wait)
+            await semaphore.acquire()
+            texts = self._pending.pop(chat_id)
+            task = asyncio.get_running_loop().create_task(self._deliver(chat_id, texts))
+            self._inflight.add(task)
+
+            def done(t):
+                self._inflight.discard(t)
+                semaphore.release()
+            task.add_done_callback(done)
+            if len(self._chat_buckets) > NOTIFY_QUEUE_SIZE:
+                self._prune_buckets()
+
+    def _prune_buckets(self):
+        """Forget chats whose bucket has refilled; a fresh bucket is equivalent."""
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chat_buckets.items() if now - b.updated > 1 / b.rate and c not in self._pending]:
+            del self._chat_buckets[chat_id]
+
+    async def _deliver(self, chat_id, texts):
+        text = "\n\n".join(texts)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+        retry_after = None
+        try:
+            resp = await self._client.post(
+                f"{self.base_url}/bot{self.token}/sendMessage",
+                json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
+            )
+            if resp.status_code == 200:
+                self.metrics["sent"] += 1
+                self._attempts.pop(chat_id, None)
+                return
+            if resp.status_code == 429:
+                try:
+                    retry_after = float(resp.json().get("parameters", {}).get("retry_after", 1))
+                except ValueError:
+                    retry_after = 1.0
+            elif resp.status_code < 500:
+                self._fail(chat_id, f"HTTP {resp.status_code}: {resp.text[:200]}")
+                return
+        except httpx.HTTPError as e:
+            logger.debug("Notification to %s failed: %r", chat_id, e)
+        self._retry(chat_id, texts, retry_after)
+
+    def _retry(self, chat_id, texts, retry_after=None):
+        attempt = self._attempts.get(chat_id, 0) + 1
+        if attempt >= NOTIFY_MAX_ATTEMPTS:
+            self._fail(chat_id, f"gave up after {attempt} attempts")
+            return
+        self._attempts[chat_id] = attempt
+        self.metrics["retried"] += 1
+        if retry_after is None:
+            retry_after = NOTIFY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+        # Keep the order: anything enqueued meanwhile goes after the retried texts
+        queued = chat_id in self._pending
+        self._pending[chat_id] = texts + self._pending.get(chat_id, [])
+        if not queued:
+            self._requeue_later(chat_id, retry_after)
+
+    def _fail(self, chat_id, reason):
+        self.metrics["failed"] += 1
+        self._attempts.pop(chat_id, None)
+        logger.info("Notification to %s dropped: %s", chat_id, reason)
+
+    # ── Lifecycle ──
+
+    def start(self):
+        if self._task is None:
+            self._ready = asyncio.Queue()
+            self._client = httpx.AsyncClient(
+                timeout=NOTIFY_TIMEOUT,
+                limits=httpx.Limits(max_connections=NOTIFY_CONCURRENCY, max_keepalive_connections=NOTIFY_CONCURRENCY),
+            )
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, drain_timeout=5.0):
+        """Give queued and in-flight messages up to drain_timeout seconds, then shut down."""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + drain_timeout
+        while (self._pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        await self._client.aclose()
+        self._task = self._client = self._ready = None
+        self._pending.clear()
+
+    def stats(self):
+        return dict(self.metrics, pending_chats=len(self._pending), in_flight=len(self._inflight))
+
+
+notifier = NotificationDispatcher(os.getenv("BOT_TOKEN", "").strip())
@@ -0,0 +1,169 @@
+"""
+In-process scheduler for time-based state transitions: bounty expiry, gang war
+finalization, boss spawns, VIP expiry and the daily tournament settlement.
+
+Jobs are rows in scheduled_jobs, one per (kind, key), so scheduling the same
+thing again just moves its due time. The scheduler keeps the due times it
+knows about in a heapq and sleeps until the earliest. Every
+SCHEDULER_POLL_INTERVAL seconds it also reads the rows coming due from the
+table, which picks up jobs written by other processes (bot.py) and anything
+left over from before a restart.
+
+A job's handler runs in the same transaction that deletes its row, so its
+effects commit exactly once. If the handler fails, everything rolls back, the
+row stays, and the job is retried SCHEDULER_RETRY_DELAY seconds later. If
+another process claims the row first, the DELETE finds nothing and the job
+is skipped.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+from backend.database import transaction
+
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "30"))
+SCHEDULER_RETRY_DELAY = float(os.getenv("SCHEDULER_RETRY_DELAY", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    def __init__(self, poll_interval=SCHEDULER_POLL_INTERVAL, retry_delay=SCHEDULER_RETRY_DELAY):
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._handlers = {}
+        self._heap: list[tuple] = []  # (due_at, kind, key)
+        self._queued: set[tuple] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def job(self, kind):
+        """Decorator registering async handler(db, key, payload) for a job kind."""
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    # ── Scheduling ──
+
+    async def schedule(self, db, kind, key, due_at, payload=None):
+        """Run kind/key at due_at, replacing any pending run; takes effect on commit."""
+        key = str(key)
+        await db.execute(
+            "INSERT INTO scheduled_jobs (kind, key, due_at, payload) VALUES (?,?,?,?) "
+            "ON CONFLICT(kind, key) DO UPDATE SET due_at=excluded.due_at, payload=excluded.payload, attempts=0",
+            (kind, key, due_at, json.dumps(payload) if payload is not None else None),
+        )
+        db.on_commit(lambda: self._push(due_at, kind, key))
+
+    async def cancel(self, db, kind, key):
+        await db.execute("DELETE FROM scheduled_jobs WHERE kind=? AND key=?", (kind, str(key)))
+
+    def _push(self, due_at, kind, key):
+        item = (due_at, kind, key)
+        if item in self._queued:
+            return
+        self._queued.add(item)
+        heapq.heappush(self._heap, item)
+        if self._heap[0] is item:
+            self._wakeup.set()
+
+    async def _load_due(self, horizon):
+        async with transaction() as db:
+            cursor = await db.execute(
+                "SELECT kind, key, due_at FROM scheduled_jobs WHERE due_at <= ? ORDER BY due_at", (horizon,)
+            )
+            rows = await cursor.fetchall()
+        for row in rows:
+            self._push(row["due_at"], row["kind"], row["key"])
+
+    # ── Running ──
+
+    async def _run(self, kind, key):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning("No handler for scheduled job %s/%s", kind, key)
+            return
+        try:
+            async with transaction() as db:
+                cursor = await db.execute(
+                    "DELETE FROM scheduled_jobs WHERE kind=? AND key=? AND due_at <= ? RETURNING payload",
+                    (kind, key, time.time()),
+                )
+                row = await cursor.fetchone()
+                await cursor.fetchall()  # finish the statement before running the handler
+                if row is None:
+                    return  # rescheduled, cancelled or already run elsewhere
+                await handler(db, key, json.loads(row["payload"]) if row["payload"] else None)
+        except Exception:
+            logger.exception("Scheduled job %s/%s failed; retrying in %ss", kind, key, self.retry_delay)
+            retry_at = time.time() + self.retry_delay
+            try:
+                async with transaction() as db:
+                    cursor = await db.execute(
+                        "UPDATE scheduled_jobs SET due_at=MAX(due_at, ?), attempts=attempts+1 "
+                        "WHERE kind=? AND key=? RETURNING due_at",
+                        (retry_at, kind, key),
+                    )
+                    row = await cursor.fetchone()
+                    await cursor.fetchall()
+                if row is None:
+                    return
+                retry_at = row["due_at"]
+            except Exception:
+                logger.exception("Could not reschedule %s/%s; the next poll will pick it up", kind, key)
+                return
+            self._push(retry_at, kind, key)
+
+    async def run_due(self):
+        """Run every queued job whose time has come. Returns how many were attempted."""
+        ran = 0
+        while self._heap and self._heap[0][0] <= time.time():
+            item = heapq.heappop(self._heap)
+            self._queued.discard(item)
+            await self._run(item[1], item[2])
+            ran += 1
+        return ran
+
+    async def _loop(self):
+        next_poll = 0.0
+        while True:
+            now = time.time()
+            if now >= next_poll:
+                next_poll = now + self.poll_interval
+                try:
+                    await self._load_due(next_poll)
+                except Exception:
+                    logger.exception("Scheduler poll failed")
+            await self.run_due()
+            wake_at = min(next_poll, self._heap[0][0]) if self._heap else next_poll
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()  # bound to the loop that first waits on it
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._heap, self._queued = [], set()
+
+    def stats(self):
+        return {"queued": len(self._heap), "next_due": self._heap[0][0] if self._heap else None}
+
+
+scheduler = Scheduler()
@@ -0,0 +1,196 @@
+"""
+Per-player server-sent event stream (GET /api/stream/{telegram_id}).
+
+The hub keeps one queue per open connection and a short ring buffer of recent
+events per online player, so an EventSource that reconnects with Last-Event-ID
+gets exactly what it missed. Event ids are "<boot>-<seq>"; an id from another
+boot, or one that fell out of the buffer, makes the client resync from a fresh
+state event instead.
+
+Nothing here polls. backend.main wires the hub to the player cache (state is
+recomputed and pushed only after a commit touched the player) and to per-player
+wake-up timers for changes driven by the clock (offline cap, raid threshold,
+boost/VIP expiry). Offline players have no buffer and cost nothing.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "20"))
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", "32"))
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "120"))
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class StreamHub:
+    def __init__(self):
+        self.boot = uuid.uuid4().hex[:8]
+        self._seq = itertools.count(1)
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        self._buffers: dict[int, deque] = {}
+        self._idle_since: dict[int, float] = {}
+        self._last_state: dict[int, dict] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._pending: set[int] = set()
+        self._refresh_all = False
+        self._flush_task: asyncio.Task | None = None
+        # Set by backend.main: async (tid) -> state dict | None, async (tid) -> None,
+        # and the state keys that drift with the clock (ignored when deduplicating)
+        self.load_state = None
+        self.wake = None
+        self.volatile_keys = ("ts",)
+
+    def is_online(self, tid):
+        return tid in self._subscribers
+
+    # ── Connections ──
+
+    def subscribe(self, tid):
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(tid, set()).add(queue)
+        self._idle_since.pop(tid, None)
+        if tid not in self._buffers:
+            self._buffers[tid] = deque(maxlen=STREAM_BUFFER)
+        return queue
+
+    def unsubscribe(self, tid, queue):
+        queues = self._subscribers.get(tid)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[tid]
+            self._idle_since[tid] = time.monotonic()
+            timer = self._timers.pop(tid, None)
+            if timer:
+                timer.cancel()
+        self._prune()
+
+    def _prune(self):
+        cutoff = time.monotonic() - STREAM_RESUME_GRACE
+        for tid in [t for t, since in self._idle_since.items() if since < cutoff]:
+            del self._idle_since[tid]
+            self._buffers.pop(tid, None)
+            self._last_state.pop(tid, None)
+
+    def replay(self, tid, last_event_id):
+        """Events after last_event_id, or None if the gap can't be bridged."""
+        if not last_event_id:
+            return None
+        boot, _, seq = last_event_id.partition("-")
+        if boot != self.boot or not seq.isdigit():
+            return None
+        seq = int(seq)
+        buffered = list(self._buffers.get(tid, ()))
+        if not buffered or int(buffered[0][0].split("-")[1]) > seq + 1:
+            return None
+        return [item for item in buffered if int(item[0].split("-")[1]) > seq]
+
+    # ── Publishing ──
+
+    def publish(self, tid, event, data):
+        buffer = self._buffers.get(tid)
+        if buffer is None:
+            return
+        item = (f"{self.boot}-{next(self._seq)}", event, data)
+        buffer.append(item)
+        for queue in self._subscribers.get(tid, ()):
+            queue.put_nowait(item)
+
+    def publish_state(self, tid, state):
+        """Push a state event unless it matches the last one sent."""
+        if state is None:
+            return
+        comparable = {k: v for k, v in state.items() if k not in self.volatile_keys}
+        if self._last_state.get(tid) == comparable:
+            return
+        self._last_state[tid] = comparable
+        self.publish(tid, "state", state)
+
+    def forget_state(self, tid):
+        self._last_state.pop(tid, None)
+
+    # ── Change notifications ──
+
+    def players_changed(self, tid=None):
+        """Cache listener: tid's rows changed (None = possibly every player)."""
+        if tid is None:
+            if not self._subscribers:
+                return
+            self._refresh_all = True
+        elif tid in self._subscribers:
+            self._pending.add(tid)
+        else:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush())
+            except RuntimeError:
+                pass  # no running loop (e.g. migrations at import time)
+
+    async def _flush(self):
+        # Let the committing request finish first; bursts of commits coalesce here
+        await asyncio.sleep(0)
+        while self._pending or self._refresh_all:
+            if self._refresh_all:
+                self._refresh_all = False
+                self._pending.update(self._subscribers)
+            tids, self._pending = self._pending, set()
+            for tid in tids:
+                if tid in self._subscribers:
+                    await self._refresh(tid)
+
+    async def _refresh(self, tid):
+        try:
+            self.publish_state(tid, await self.load_state(tid))
+        except Exception:
+            logger.exception("Stream state refresh failed for %s", tid)
+
+    # ── Clock-driven wake-ups ──
+
+    def wake_at(self, tid, ts):
+        """Call self.wake(tid) at unix time ts while tid stays online (earliest wins)."""
+        if tid not in self._subscribers:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, ts - time.time())
+        when = loop.time() + delay
+        timer = self._timers.get(tid)
+        if timer is not None and not timer.cancelled() and timer.when() <= when:
+            return
+        if timer is not None:
+            timer.cancel()
+        self._timers[tid] = loop.call_at(when, self._fire, tid)
+
+    def _fire(self, tid):
+        self._timers.pop(tid, None)
+        if tid in self._subscribers and self.wake is not None:
+            asyncio.get_running_loop().create_task(self._run_wake(tid))
+
+    async def _run_wake(self, tid):
+        try:
+            await self.wake(tid)
+        except Exception:
+            logger.exception("Stream wake-up failed for %s", tid)
+
+    def stats(self):
+        return {
+            "online": len(self._subscribers),
+            "connections": sum(len(q) for q in self._subscribers.values()),
+            "buffers": len(self._buffers),
+            "timers": len(self._timers),
+        }
+
+
+stream_hub = StreamHub()
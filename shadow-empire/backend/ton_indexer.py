@@ -0,0 +1,170 @@
+"""
+Incremental indexer for payments to TON_WALLET_ADDRESS (POST /api/ton/verify).
+
+A background loop walks the wallet's transactions through toncenter's
+getTransactions, newest first, page by page, until it reaches the logical time
+(lt) it stopped at last time. Incoming transfers are stored in ton_transactions
+keyed by transaction hash and indexed by comment, and the new cursor is saved
+in ton_indexer_state in the same commit, so a restart resumes where it left
+off. On the very first run only the latest page is read.
+
+Verification is then a local lookup by comment. When it misses, the endpoint
+calls poke() so the next poll runs right away (but never closer than
+TON_INDEXER_MIN_GAP after the previous one, to stay inside toncenter's rate
+limit). TONCENTER_API_BASE points the poller at another server, such as a
+local stand-in in tests; TON_INDEXER_INTERVAL <= 0 disables it.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+from backend.database import transaction
+from backend.game_config import TON_WALLET_ADDRESS
+
+TONCENTER_API_BASE = os.getenv("TONCENTER_API_BASE", "https://toncenter.com/api/v2")
+TONCENTER_API_KEY = os.getenv("TONCENTER_API_KEY", "")
+TON_INDEXER_INTERVAL = float(os.getenv("TON_INDEXER_INTERVAL", "15"))
+TON_INDEXER_MIN_GAP = float(os.getenv("TON_INDEXER_MIN_GAP", "2"))
+TON_INDEXER_PAGE_SIZE = int(os.getenv("TON_INDEXER_PAGE_SIZE", "50"))
+TON_INDEXER_MAX_PAGES = int(os.getenv("TON_INDEXER_MAX_PAGES", "20"))
+
+logger = logging.getLogger(__name__)
+
+
+class TonIndexer:
+    def __init__(self, address, base_url=TONCENTER_API_BASE, api_key=TONCENTER_API_KEY,
+                 interval=TON_INDEXER_INTERVAL, page_size=TON_INDEXER_PAGE_SIZE, max_pages=TON_INDEXER_MAX_PAGES):
+        self.address = address
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.interval = interval
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self._client: httpx.AsyncClient | None = None
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.metrics = {"polls": 0, "pages": 0, "indexed": 0, "errors": 0, "last_lt": 0}
+
+    # ── Fetching ──
+
+    async def _fetch(self, client, **params):
+        resp = await client.get(
+            f"{self.base_url}/getTransactions",
+            params={"address": self.address, "limit": self.page_size, **params},
+            headers={"X-API-Key": self.api_key} if self.api_key else None,
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        if not data.get("ok", True):
+            raise ValueError(f"toncenter error: {data.get('error')}")
+        self.metrics["pages"] += 1
+        return data.get("result", [])
+
+    async def _load_cursor(self, db):
+        cursor = await db.execute("SELECT last_lt FROM ton_indexer_state WHERE address=?", (self.address,))
+        row = await cursor.fetchone()
+        return row["last_lt"] if row else 0
+
+    async def poll_once(self, client=None):
+        """Index everything newer than the stored cursor. Returns how many transfers were added."""
+        client = client or self._client
+        async with transaction() as db:
+            last_lt = await self._load_cursor(db)
+        self.metrics["polls"] += 1
+
+        fresh, newest, reached = [], None, False
+        params = {"to_lt": last_lt} if last_lt else {}
+        for _ in range(self.max_pages):
+            page = await self._fetch(client, **params)
+            full = len(page) >= self.page_size
+            if "hash" in params and page and page[0]["transaction_id"]["hash"] == params["hash"]:
+                page = page[1:]  # a page starting at (lt, hash) repeats that transaction
+            for tx in page:
+                lt = int(tx["transaction_id"]["lt"])
+                if lt <= last_lt:
+                    reached = True
+                    break
+                newest = newest or (lt, tx["transaction_id"]["hash"])
+                fresh.append(tx)
+            if reached or not full or not page or not last_lt:
+                break
+            params = {"to_lt": last_lt, "lt": page[-1]["transaction_id"]["lt"], "hash": page[-1]["transaction_id"]["hash"]}
+        else:
+            logger.warning("TON indexer read %d pages without reaching lt %d; older transfers skipped", self.max_pages, last_lt)
+
+        if newest is None:
+            return 0
+        rows = []
+        for tx in fresh:
+            msg = tx.get("in_msg") or {}
+            value = int(msg.get("value") or 0)
+            if value > 0 and msg.get("source"):
+                rows.append((
+                    tx["transaction_id"]["hash"], int(tx["transaction_id"]["lt"]), tx.get("utime", 0),
+                    msg["source"], value, (msg.get("message") or "").strip(),
+                ))
+        async with transaction() as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO ton_transactions (hash, lt, utime, source, value, comment) VALUES (?,?,?,?,?,?)",
+                rows,
+            )
+            await db.execute(
+                "INSERT INTO ton_indexer_state (address, last_lt, last_hash, updated_at) VALUES (?,?,?,?) "
+                "ON CONFLICT(address) DO UPDATE SET last_lt=excluded.last_lt, last_hash=excluded.last_hash, "
+                "updated_at=excluded.updated_at",
+                (self.address, newest[0], newest[1], time.time()),
+            )
+        self.metrics["indexed"] += len(rows)
+        self.metrics["last_lt"] = newest[0]
+        return len(rows)
+
+    # ── Lifecycle ──
+
+    def poke(self):
+        """Ask for a poll as soon as the rate limit allows."""
+        self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            started = time.monotonic()
+            try:
+                await self.poll_once()
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                self.metrics["errors"] += 1
+                logger.warning("TON indexer poll failed: %r", e)
+            except Exception:
+                self.metrics["errors"] += 1
+                logger.exception("TON indexer poll failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.sleep(max(0.0, TON_INDEXER_MIN_GAP - (time.monotonic() - started)))
+
+    def start(self):
+        if self._task is None and self.interval > 0 and self.address:
+            self._wakeup = asyncio.Event()
+            self._client = httpx.AsyncClient(timeout=15.0)
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return dict(self.metrics, running=self._task is not None)
+
+
+ton_indexer = TonIndexer(TON_WALLET_ADDRESS)
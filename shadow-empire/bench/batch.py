@@ -0,0 +1,82 @@
+"""
+Individual action calls vs one /api/batch (user-009).
+
+Each sequence is 8 actions (4 buys, a manager, 2 upgrades, a buy) for a fresh
+player; CONC sequences run at a time, first as separate requests, then as one
+batch each. Prints p50/p99 per sequence and sequences per second, and checks
+that both paths end in the same state.
+
+    python bench/batch.py              # from shadow-empire/
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp()
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ.setdefault("TON_INDEXER_INTERVAL", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+
+import backend.main as m
+from backend.database import transaction
+
+SEQUENCES = int(os.getenv("SEQUENCES", "100"))
+CONC = int(os.getenv("CONC", "16"))
+
+
+async def main():
+    await m.init_db()
+    upgrade = next(iter(m.UPGRADES))
+    seq = [("buy", "/api/buy", {"business_id": "car_wash"})] * 4 + [
+        ("manager", "/api/manager", {"business_id": "car_wash"}),
+        ("upgrade", "/api/upgrade", {"upgrade_id": upgrade}),
+        ("upgrade", "/api/upgrade", {"upgrade_id": upgrade}),
+        ("buy", "/api/buy", {"business_id": "car_wash"}),
+    ]
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=m.app), base_url="http://bench") as c:
+        for tid in range(1, 2 * SEQUENCES + 1):
+            await c.post("/api/init", json={"telegram_id": tid, "username": f"p{tid}"})
+        async with transaction() as db:
+            await db.execute("UPDATE players SET cash=1e12")
+
+        async def individual(tid):
+            for _, url, params in seq:
+                r = await c.post(url, json={"telegram_id": tid, **params})
+                assert r.status_code == 200, r.text
+
+        async def batched(tid):
+            r = await c.post("/api/batch", json={
+                "telegram_id": tid,
+                "actions": [{"action": action, "params": params} for action, _, params in seq],
+            })
+            assert r.status_code == 200 and all(x["ok"] for x in r.json()["results"]), r.text
+
+        for name, run, first in [("individual", individual, 1), ("batch", batched, SEQUENCES + 1)]:
+            lat = []
+            sem = asyncio.Semaphore(CONC)
+
+            async def timed(tid):
+                async with sem:
+                    started = time.perf_counter()
+                    await run(tid)
+                    lat.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(timed(tid) for tid in range(first, first + SEQUENCES)))
+            elapsed = time.perf_counter() - started
+            lat.sort()
+            print(f"{name}: sequences={len(lat)} p50={lat[len(lat) // 2]:.1f}ms "
+                  f"p99={lat[int(len(lat) * 0.99) - 1]:.1f}ms seq/s={len(lat) / elapsed:.0f}")
+
+        a = (await c.post("/api/collect", json={"telegram_id": 1})).json()
+        b = (await c.post("/api/collect", json={"telegram_id": SEQUENCES + 1})).json()
+        print("same end state:", round(a["income_per_sec"], 4) == round(b["income_per_sec"], 4))
+    await m.close_db()
+
+
+asyncio.run(main())
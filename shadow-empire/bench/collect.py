@@ -0,0 +1,81 @@
+"""
+/api/collect under concurrent load (connection pool, user-001).
+
+Seeds PLAYERS players in a throwaway database, then CONC clients each send
+CALLS collect requests through the in-process ASGI transport and the
+latency percentiles and throughput are printed for each mode in MODES:
+
+- unpooled: the pre-pool behaviour, a fresh aiosqlite connection (worker
+  thread plus PRAGMAs) per unit of work, closed when it ends
+- pooled: the ConnectionPool behind get_db()
+
+    python bench/collect.py            # from shadow-empire/
+    CONC=32 MODES=pooled python bench/collect.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp()
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ.setdefault("TON_INDEXER_INTERVAL", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+
+import backend.database as database
+import backend.main as m
+from backend.cache import player_cache
+from backend.database import ConnectionPool
+
+PLAYERS = int(os.getenv("PLAYERS", "50"))
+CONC = int(os.getenv("CONC", "16"))
+CALLS = int(os.getenv("CALLS", "40"))
+MODES = os.getenv("MODES", "unpooled,pooled").split(",")
+
+
+class UnpooledConnections(ConnectionPool):
+    """Opens a connection on every acquire and closes it on release."""
+
+    def __init__(self, path):
+        super().__init__(path, size=10**6)
+
+    async def release(self, pc):
+        await super().release(pc)
+        if pc in self._idle:
+            self._idle.remove(pc)
+            await self._discard(pc)
+
+
+async def main():
+    await m.init_db()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=m.app), base_url="http://bench") as c:
+        for i in range(PLAYERS):
+            await c.post("/api/init", json={"telegram_id": i + 1, "username": f"p{i}"})
+
+        for mode in MODES:
+            await database.get_pool().close()
+            database._pool = UnpooledConnections(database.DB_PATH) if mode == "unpooled" else None
+            player_cache.clear()
+            lat = []
+
+            async def worker(w):
+                for k in range(CALLS):
+                    started = time.perf_counter()
+                    r = await c.post("/api/collect", json={"telegram_id": (w * CALLS + k) % PLAYERS + 1})
+                    assert r.status_code == 200, r.text
+                    lat.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(w) for w in range(CONC)))
+            elapsed = time.perf_counter() - started
+            lat.sort()
+            print(f"collect ({mode}): n={len(lat)} p50={lat[len(lat) // 2]:.1f}ms "
+                  f"p99={lat[int(len(lat) * 0.99)]:.1f}ms throughput={len(lat) / elapsed:.0f} req/s")
+    await m.close_db()
+
+
+asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+track_action cost per call (mission index, user-011).
+
+Runs CALLS track_action calls over six action types in one transaction for a
+single player and prints microseconds and SQL statements per call.
+
+    python bench/track_action.py       # from shadow-empire/
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp()
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ.setdefault("TON_INDEXER_INTERVAL", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+
+import backend.main as m
+from backend.database import transaction
+
+CALLS = int(os.getenv("CALLS", "3000"))
+KINDS = ["buy_business", "robbery", "casino_play", "earn_cash", "case_open", "nothing"]
+
+
+async def main():
+    await m.init_db()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=m.app), base_url="http://bench") as c:
+        await c.post("/api/init", json={"telegram_id": 1, "username": "p"})
+
+    async with transaction() as db:
+        started = time.perf_counter()
+        for i in range(CALLS):
+            await m.track_action(db, 1, KINDS[i % len(KINDS)], 1)
+        elapsed = time.perf_counter() - started
+
+    statements = 0
+    async with transaction() as db:
+        execute = db._conn.execute
+
+        async def counting(sql, *args, **kwargs):
+            nonlocal statements
+            statements += 1
+            return await execute(sql, *args, **kwargs)
+
+        db._conn.execute = counting
+        for i in range(len(KINDS) * 100):
+            await m.track_action(db, 1, KINDS[i % len(KINDS)], 1)
+    print(f"track_action: {elapsed / CALLS * 1e6:.1f} us/call, {statements / (len(KINDS) * 100):.2f} SQL statements/call")
+    await m.close_db()
+
+
+asyncio.run(main())
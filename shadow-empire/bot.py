@@ -38,7 +38,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     url = WEBAPP_URL
     sep = "&" if "?" in url else "?"
-    url += f"{sep}_v=41"
+    url += f"{sep}_v=45"
     if ref_param:
         url += f"&ref={ref_param}"
 
@@ -122,6 +122,15 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     "UPDATE players SET is_vip=1, vip_until=? WHERE telegram_id=?",
                     (new_until, tid),
                 )
+                # Picked up by the backend scheduler, which clears is_vip when it runs
+                try:
+                    await db.execute(
+                        "INSERT INTO scheduled_jobs (kind, key, due_at) VALUES ('vip_expire', ?, ?) "
+                        "ON CONFLICT(kind, key) DO UPDATE SET due_at=excluded.due_at, attempts=0",
+                        (str(tid), new_until),
+                    )
+                except aiosqlite.OperationalError as e:
+                    logger.warning(f"VIP expiry not scheduled for {tid}: {e}")
             logger.info(f"VIP activated for {tid}: {package_id}")
 
         elif package_id in CASH_PACKAGES:
@@ -168,6 +177,14 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "INSERT INTO premium_transactions (telegram_id, package_id, payment_method, amount) VALUES (?,?,?,?)",
             (tid, package_id, "stars", str(payment.total_amount)),
         )
+        # Tell the backend to drop its cached copy of this player
+        try:
+            await db.execute(
+                "INSERT INTO cache_invalidations (telegram_id, created_at) VALUES (?, ?)",
+                (tid, now),
+            )
+        except aiosqlite.OperationalError as e:
+            logger.warning(f"Cache invalidation not recorded for {tid}: {e}")
         await db.commit()
 
     except Exception as e:
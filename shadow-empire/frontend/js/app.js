@@ -68,6 +68,53 @@ function escapeHtml(str) {
     return str.replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;').replace(/'/g,'&#039;');
 }
 
+// ── Static config (cached in localStorage per config_version) ──
+const CONFIG_STORAGE_KEY = 'se_config';
+
+async function loadConfig(version) {
+    try {
+        const cached = JSON.parse(localStorage.getItem(CONFIG_STORAGE_KEY) || 'null');
+        if (cached && cached.version === version) return cached;
+    } catch(e) {}
+    const r = await fetch(API + '/api/config?v=' + encodeURIComponent(version));
+    if (!r.ok) throw new Error('config ' + r.status);
+    const cfg = await r.json();
+    try { localStorage.setItem(CONFIG_STORAGE_KEY, JSON.stringify(cfg)); } catch(e) {}
+    return cfg;
+}
+
+function applyConfig(c) {
+    S.legalCfg = c.legal_businesses; S.shadowCfg = c.shadow_businesses;
+    S.robberiesCfg = c.robberies; S.casinoCfg = c.casino_games;
+    S.shopItems = c.shop_items;
+    S.upgradesCfg = c.upgrades_config || {};
+    S.casesCfg = c.cases_config || {};
+    S.rarities = c.rarities || {};
+    S.loginRewards = c.login_rewards || [];
+    S.achievementsCfg = c.achievements_config || [];
+    S.prestigeCfg = c.prestige_config || {};
+    S.vipPackages = c.vip_packages || {};
+    S.cashPackages = c.cash_packages || {};
+    S.casePackages = c.case_packages || {};
+    S.tonPrices = c.ton_prices || {};
+    S.vipItems = c.vip_items || {};
+    S.skinsCfg = c.skins_config || {};
+    S.skinRarities = c.skin_rarities || {};
+    S.skinCase = c.skin_case || {};
+    S.skinCaseVip = c.skin_case_vip || {};
+    S.achievementCategories = c.achievement_categories || {};
+    S.tierInfo = c.tier_info || {};
+    S.talentTreeCfg = c.talent_tree_config || {};
+    S.gangWarCfg = c.gang_war_config || {};
+    S.seasonPassCfg = c.season_pass_config || {};
+    S.seasonPassRewards = c.season_pass_rewards || {};
+    S.ranksCfg = c.ranks_config || [];
+    S.bribeConfig = c.bribe_config || {};
+    S.bountyConfig = c.bounty_config || {};
+    S.itemSets = c.item_sets || {};
+    S.tradeUpConfig = c.trade_up_config || {};
+}
+
 // ── Init ──
 async function init() {
     if (tg) { tg.ready(); tg.expand(); tg.setHeaderColor('#0a0a0f'); tg.setBackgroundColor('#0a0a0f'); }
@@ -82,43 +129,27 @@ async function init() {
     const refCode = refFromUrl || refFromTg;
     try {
         const r = await api('/api/init', { telegram_id: tid, username: uname, referral_code: refCode, init_data: initData });
+        applyConfig(await loadConfig(r.config_version));
         S.player = r.player; S.businesses = r.businesses;
-        S.legalCfg = r.legal_businesses; S.shadowCfg = r.shadow_businesses;
-        S.robberiesCfg = r.robberies; S.casinoCfg = r.casino_games;
-        S.shopItems = r.shop_items; S.character = r.character;
+        S.character = r.character;
         S.inventory = r.inventory; S.incomePerSec = r.income_per_sec;
         S.suspicionPerSec = r.suspicion_per_sec; S.playerLevel = r.player_level;
         S.displayCash = r.player.cash; S.lastTick = Date.now();
         S.referralCount = r.referral_count || 0;
-        S.upgradesCfg = r.upgrades_config || {};
         S.upgrades = r.upgrades || [];
-        S.casesCfg = r.cases_config || {};
         S.playerCases = r.player_cases || [];
-        S.rarities = r.rarities || {};
         // New features
         S.dailyMissions = r.daily_missions || [];
         S.loginData = r.login_data || null;
-        S.loginRewards = r.login_rewards || [];
         S.achievements = r.achievements || [];
-        S.achievementsCfg = r.achievements_config || [];
-        S.prestigeCfg = r.prestige_config || {};
         S.territories = r.territories || [];
         S.territoryBonus = r.territory_bonus || 0;
         // VIP & Monetization
         S.vipStatus = r.vip_status || { active: false, until: 0, days_left: 0 };
         S.adBoostUntil = r.ad_boost_until || 0;
-        S.vipPackages = r.vip_packages || {};
-        S.cashPackages = r.cash_packages || {};
-        S.casePackages = r.case_packages || {};
-        S.tonPrices = r.ton_prices || {};
-        S.vipItems = r.vip_items || {};
         // Skins
         S.playerSkins = r.player_skins || [];
         S.equippedSkins = r.equipped_skins || {};
-        S.skinsCfg = r.skins_config || {};
-        S.skinRarities = r.skin_rarities || {};
-        S.skinCase = r.skin_case || {};
-        S.skinCaseVip = r.skin_case_vip || {};
         // Tournament
         S.tournamentScore = r.tournament_score || 0;
         S.tournamentPrize = r.tournament_prize || null;
@@ -127,31 +158,18 @@ async function init() {
         S.eventProgress = r.event_progress || null;
         // Boss
         S.bossData = r.boss_data || null;
-        // Achievement categories
-        S.achievementCategories = r.achievement_categories || {};
-        S.tierInfo = r.tier_info || {};
         // Talent Tree
-        S.talentTreeCfg = r.talent_tree_config || {};
         S.playerTalents = r.player_talents || {};
         S.talentPoints = r.talent_points || 0;
         // Weekly event
         S.weeklyEvent = r.weekly_event || null;
-        // Gang wars
-        S.gangWarCfg = r.gang_war_config || {};
         // Season Pass
         S.seasonPass = r.season_pass || {};
-        S.seasonPassCfg = r.season_pass_config || {};
-        S.seasonPassRewards = r.season_pass_rewards || {};
-        // New features: Ranks, Bribes, Bounties, Sets, TradeUp
+        // New features: Ranks, Bribes, Bounties, Sets
         S.rank = r.rank || null;
         S.rankScore = r.rank_score || 0;
-        S.ranksCfg = r.ranks_config || [];
         S.bountiesOnMe = r.bounties_on_me || [];
-        S.bribeConfig = r.bribe_config || {};
-        S.bountyConfig = r.bounty_config || {};
-        S.itemSets = r.item_sets || {};
         S.completedSets = r.completed_sets || {};
-        S.tradeUpConfig = r.trade_up_config || {};
 
         renderAll(); hideLoading(); startLoop();
 
@@ -170,9 +188,33 @@ async function init() {
     } catch(e) { document.querySelector('.loading-sub').textContent = 'Ошибка подключения'; }
 }
 
+function idempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+}
+
+// Safe to repeat as-is; the server ignores keys on these too
+const IDEMPOTENCY_EXEMPT = new Set(['/api/collect', '/api/init']);
+
+// Mutating POSTs carry an Idempotency-Key, so retrying after a dropped connection never runs the action twice
 async function api(url, body) {
-    const opt = body ? { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body) } : {};
-    const r = await fetch(API + url, opt);
+    const headers = {'Content-Type':'application/json'};
+    if (body && !IDEMPOTENCY_EXEMPT.has(url)) headers['Idempotency-Key'] = idempotencyKey();
+    const opt = body ? { method:'POST', headers, body: JSON.stringify(body) } : {};
+    let r;
+    for (let attempt = 0; ; attempt++) {
+        try { r = await fetch(API + url, opt); }
+        catch(e) {
+            if (!body || attempt >= 2) throw e;
+            await new Promise(res => setTimeout(res, 500 * (attempt + 1)));
+            continue;
+        }
+        if (body && r.status >= 502 && r.status <= 504 && attempt < 2) {
+            await new Promise(res => setTimeout(res, 500 * (attempt + 1)));
+            continue;
+        }
+        break;
+    }
     if (!r.ok) { const e = await r.json(); throw e; }
     return r.json();
 }
@@ -195,7 +237,7 @@ function startLoop() {
             renderUpgrades(); renderCases(); renderShop();
         }
     }, 200);
-    setInterval(sync, 10000);
+    startStream();
 }
 
 async function sync() {
@@ -207,6 +249,35 @@ async function sync() {
     } catch(e) {}
 }
 
+// ── Live state stream (falls back to polling while disconnected) ──
+let _stream = null, _pollTimer = null;
+function startPolling() { if (!_pollTimer) _pollTimer = setInterval(sync, 10000); }
+function stopPolling() { if (_pollTimer) { clearInterval(_pollTimer); _pollTimer = null; } }
+
+function applyState(st) {
+    const age = Math.max(0, Date.now() / 1000 - st.ts);
+    S.player = st.player; S.player.suspicion = st.suspicion;
+    S.incomePerSec = st.income_per_sec; S.suspicionPerSec = st.suspicion_per_sec;
+    S.displayCash = st.player.cash + st.pending_cash + st.income_per_sec * age;
+    S.lastTick = Date.now();
+    updateHUD();
+}
+
+function startStream() {
+    if (!window.EventSource) { startPolling(); return; }
+    _stream = new EventSource(`${API}/api/stream/${S.player.telegram_id}`);
+    _stream.onopen = () => stopPolling();
+    _stream.onerror = () => {
+        // EventSource reconnects by itself (resuming with Last-Event-ID); poll meanwhile
+        startPolling();
+        if (_stream.readyState === EventSource.CLOSED) { _stream = null; setTimeout(startStream, 30000); }
+    };
+    _stream.addEventListener('state', e => applyState(JSON.parse(e.data)));
+    _stream.addEventListener('notification', e => {
+        if ($('#popup-overlay').classList.contains('hidden')) showPopup('🔔', 'Уведомление', JSON.parse(e.data).text, '', '');
+    });
+}
+
 // ── Helpers ──
 function $(sel) { return document.querySelector(sel); }
 function fmt(n) {
@@ -286,6 +357,8 @@ function renderBusiness(type) {
         const susp = type==='shadow'
             ? `<span class="business-suspicion-up">🔥+${c.suspicion_add}/с</span>`
             : `<span class="business-suspicion-down">🛡-${c.suspicion_reduce}/с</span>`;
+        const buyMax = lvl && S.displayCash >= cost * (1 + c.cost_multiplier)
+            ? `<button class="btn-manager" onclick="buyBizMax('${c.id}')">⏫ MAX</button>` : '';
         const mgr = owned && !owned.has_manager
             ? `<button class="btn-manager" onclick="hireManager('${c.id}')" ${S.displayCash>=c.manager_cost?'':'disabled'}>👔 $${fmt(c.manager_cost)}</button>`
             : owned?.has_manager ? `<span class="manager-badge">👔</span>` : '';
@@ -310,7 +383,7 @@ function renderBusiness(type) {
             <div class="business-actions">
                 ${locked?`<span class="locked-text">🔒 Ур.${c.unlock_level}</span>`
                 :`<button class="btn-buy ${type==='shadow'?'shadow-btn':''}" onclick="buyBiz('${c.id}')" ${afford?'':'disabled'}>${lvl?'⬆️':'Купить'}</button>
-                <span class="business-cost">$${fmt(cost)}</span>${mgr}${skinBtn}`}
+                <span class="business-cost">$${fmt(cost)}</span>${buyMax}${mgr}${skinBtn}`}
             </div></div>`;
     }
 }
@@ -735,14 +808,16 @@ async function loadLeaderboard() {
     const el = $('#leaderboard-list');
     if (!el) return;
     try {
-        const r = await fetch(API + '/api/leaderboard').then(r => r.json());
+        const [r, me] = await Promise.all([
+            fetch(API + '/api/leaderboard').then(r => r.json()),
+            S.player ? fetch(API + '/api/leaderboard/' + S.player.telegram_id).then(r => r.ok ? r.json() : null).catch(() => null) : null,
+        ]);
         if (!r.leaderboard.length) { el.innerHTML = '<div class="inv-empty">Пока нет игроков</div>'; return; }
         const medals = ['🥇', '🥈', '🥉'];
-        let html = '';
-        r.leaderboard.forEach((p, i) => {
+        const row = p => {
             const isMe = S.player && p.telegram_id === S.player.telegram_id;
-            const medal = i < 3 ? medals[i] : `#${i + 1}`;
-            html += `<div class="lb-row ${isMe ? 'lb-me' : ''}">
+            const medal = p.rank <= 3 ? medals[p.rank - 1] : `#${p.rank}`;
+            return `<div class="lb-row ${isMe ? 'lb-me' : ''}">
                 <span class="lb-rank">${medal}</span>
                 <div class="lb-info">
                     <div class="lb-name">${escapeHtml(p.username) || 'Игрок'}</div>
@@ -750,7 +825,14 @@ async function loadLeaderboard() {
                 </div>
                 <div class="lb-cash">$${fmt(p.cash)}</div>
             </div>`;
-        });
+        };
+        let html = r.leaderboard.map(row).join('');
+        // Own place and neighbours when outside the top
+        const last = r.leaderboard[r.leaderboard.length - 1].rank;
+        if (me && me.rank > last) {
+            html += `<div class="inv-empty">Твоё место: #${me.rank} из ${me.total_players}</div>`;
+            html += me.around.filter(p => p.rank > last).map(row).join('');
+        }
         el.innerHTML = html;
     } catch(e) { el.innerHTML = '<div class="inv-empty">Ошибка загрузки</div>'; }
 }
@@ -1062,21 +1144,45 @@ function shareRefLink() {
     }
 }
 
+// ── Batched actions: taps within BATCH_WINDOW_MS go out as one /api/batch ──
+const BATCH_WINDOW_MS = 150;
+let _batch = null;
+function batchAction(action, params) {
+    return new Promise((resolve, reject) => {
+        if (!_batch) { _batch = []; setTimeout(flushBatch, BATCH_WINDOW_MS); }
+        _batch.push({ action, params, resolve, reject });
+    });
+}
+
+async function flushBatch() {
+    const items = _batch; _batch = null;
+    try {
+        const r = await api('/api/batch', { telegram_id: S.player.telegram_id, actions: items.map(i => ({ action: i.action, params: i.params })) });
+        S.player = r.player; S.businesses = r.businesses; S.upgrades = r.upgrades;
+        S.character = r.character; S.inventory = r.inventory; S.dailyMissions = r.daily_missions;
+        S.displayCash = r.player.cash; S.incomePerSec = r.income_per_sec; S.suspicionPerSec = r.suspicion_per_sec;
+        S.playerLevel = r.player_level; renderAll();
+        r.results.forEach((res, k) => res.ok ? items[k].resolve(res) : items[k].reject(res));
+    } catch(e) { items.forEach(i => i.reject(e)); }
+}
+
 // ── Actions ──
 async function buyBiz(id) {
     try {
-        const r = await api('/api/buy', { telegram_id: S.player.telegram_id, business_id: id });
-        if (r.cash_before !== undefined) S.displayCash = r.cash_before;
-        S.player = r.player; S.businesses = r.businesses; S.displayCash = r.player.cash;
-        S.incomePerSec = r.income_per_sec; S.suspicionPerSec = r.suspicion_per_sec;
-        S.playerLevel = r.player_level; renderAll();
+        await batchAction('buy', { business_id: id });
+    } catch(e) { showPopup('❌', 'Не хватает', '', e.detail || 'Ошибка', ''); }
+}
+
+async function buyBizMax(id) {
+    try {
+        const r = await batchAction('buy', { business_id: id, max: true });
+        showPopup('⏫', 'Прокачано!', `+${r.count} ур. → Ур.${r.level}`, '-$' + fmt(r.cost), '');
     } catch(e) { showPopup('❌', 'Не хватает', '', e.detail || 'Ошибка', ''); }
 }
 
 async function hireManager(id) {
     try {
-        const r = await api('/api/manager', { telegram_id: S.player.telegram_id, business_id: id });
-        S.player = r.player; S.businesses = r.businesses; S.displayCash = r.player.cash; renderAll();
+        await batchAction('manager', { business_id: id });
     } catch(e) {}
 }
 
@@ -1093,11 +1199,9 @@ async function doRobbery(id) {
 
 async function buyUpgrade(id) {
     try {
-        const r = await api('/api/upgrade', { telegram_id: S.player.telegram_id, upgrade_id: id });
-        S.player = r.player; S.upgrades = r.upgrades; S.displayCash = r.player.cash;
+        await batchAction('upgrade', { upgrade_id: id });
         const cfg = S.upgradesCfg[id];
         showPopup(cfg.emoji, cfg.name, cfg.description, '', '');
-        renderAll();
     } catch(e) { showPopup('❌', 'Ошибка', '', e.detail || '', ''); }
 }
 
@@ -1113,9 +1217,7 @@ async function buyItem(id) {
 
 async function equipItem(id) {
     try {
-        const r = await api('/api/shop/equip', { telegram_id: S.player.telegram_id, item_id: id });
-        S.character = r.character; S.inventory = r.inventory;
-        renderCharacter(); renderShop(); renderInventory();
+        await batchAction('equip', { item_id: id });
     } catch(e) {}
 }
 
@@ -1497,6 +1599,21 @@ async function playCasino(game, choice) {
     } catch(e) { showPopup('❌', 'Ошибка', '', e.detail || 'Нет денег', ''); }
 }
 
+async function autoplayCasino(game, choice, rounds) {
+    const bet = parseFloat($(`#bet-${game}`).value);
+    if (!bet || bet <= 0) return;
+    try {
+        const r = await api('/api/casino/autoplay', { telegram_id: S.player.telegram_id, game, bet, choice, rounds });
+        S.player = r.player; S.displayCash = r.player.cash;
+        const last = r.rounds[r.rounds.length - 1];
+        if (game === 'slots' && last) $('#slot-display').textContent = last.result.reels.join(' ');
+        const summary = `${r.played} игр, ${r.wins} побед`;
+        if (r.net >= 0) showPopup('🔁', 'Автоигра', summary, '+$' + fmt(r.net), '');
+        else showPopup('🔁', 'Автоигра', summary, '-$' + fmt(-r.net), '');
+        updateHUD();
+    } catch(e) { showPopup('❌', 'Ошибка', '', e.detail || 'Нет денег', ''); }
+}
+
 function adjBet(game, amount) {
     const el = $(`#bet-${game}`);
     let v = parseFloat(el.value) + amount;
@@ -1809,7 +1926,7 @@ async function loadPvpTargets() {
         for (const t of r.targets) {
             el.innerHTML += `<div class="pvp-target">
                 <div class="pvp-target-info"><strong>${escapeHtml(t.username)||'Игрок'}</strong><br>
-                <small>😈${t.reputation_fear} 🤝${t.reputation_respect}</small></div>
+                <small>💪${t.power} 😈${t.reputation_fear} 🤝${t.reputation_respect}</small></div>
                 <button class="btn-attack" onclick="pvpAttack(${t.telegram_id})">⚔️ Напасть</button></div>`;
         }
     } catch(e) {}
@@ -1828,11 +1945,8 @@ async function pvpAttack(targetId) {
 // ── Mission Claim ──
 async function claimMission(missionId) {
     try {
-        const r = await api('/api/mission/claim', { telegram_id: S.player.telegram_id, mission_id: missionId });
-        const oldCash = S.displayCash;
-        S.player = r.player; S.dailyMissions = r.daily_missions; S.displayCash = r.player.cash;
-        showPopup('📋', 'Миссия выполнена!', '', '+$' + fmt(r.player.cash - oldCash), '');
-        renderMissions(); updateHUD();
+        const r = await batchAction('mission_claim', { mission_id: missionId });
+        showPopup('📋', 'Миссия выполнена!', '', '+$' + fmt(r.reward), '');
     } catch(e) { showPopup('❌', 'Ошибка', '', e.detail || '', ''); }
 }
 
@@ -2257,7 +2371,7 @@ async function buyWithTon(packageId) {
                 payload: r.comment,
             }],
         };
-        const result = await tonConnectUI.sendTransaction(tx);
+        await tonConnectUI.sendTransaction(tx);
         showPopup('💎', 'Транзакция отправлена!', '', 'Проверяем оплату...', '');
         // Verify with retries
         const verifyPayment = async (attempts) => {
@@ -2266,7 +2380,6 @@ async function buyWithTon(packageId) {
                 try {
                     const vr = await api('/api/ton/verify', {
                         telegram_id: S.player.telegram_id,
-                        tx_hash: result.boc || 'manual',
                         comment: r.comment,
                         package_id: packageId,
                     });
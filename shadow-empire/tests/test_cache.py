@@ -0,0 +1,205 @@
+"""
+backend.cache attributes each write to one player only when _analyze_write
+can locate its telegram_id parameter. These tests run every write statement
+in the backend and bot.py through it and compare with the expected
+(table, parameter index), so a new statement shape can't silently evict the
+wrong player's rows.
+"""
+
+import ast
+import itertools
+import re
+from pathlib import Path
+
+import pytest
+
+from backend.cache import CACHED_TABLES, CacheTransaction, _analyze_write
+
+ROOT = Path(__file__).resolve().parent.parent
+SOURCES = sorted(ROOT.glob("backend/*.py")) + [ROOT / "bot.py"]
+
+_WRITE_SQL_RE = re.compile(r"^\s*(INSERT|REPLACE|UPDATE|DELETE)\s")
+
+# What the interpolated parts of f-string statements can expand to
+RENDERINGS = {
+    "table": list(CACHED_TABLES) + ["player_cases", "gang_members"],
+    "rep_col": ["reputation_fear", "reputation_respect"],
+    "slot": ["hat", "car"],
+    "claimed_field": ["claimed_free", "claimed_premium"],
+    "', '.join(profile)": ["telegram_id, gang_id, territory_bonus, updated_at"],
+    "', '.join('?' * len(profile))": ["?, ?, ?, ?"],
+    "','.join('?' * len(ids))": ["?,?,?"],
+    "','.join('?' * len(case_ids))": ["?,?"],
+}
+
+# Every distinct write on a cached table, as it reaches SQLite
+EXPECTED = {
+    'DELETE FROM player_achievements WHERE telegram_id=?': ('player_achievements', 0),
+    'INSERT OR IGNORE INTO player_achievements (telegram_id, achievement_id) VALUES (?,?)': ('player_achievements', 0),
+    'UPDATE player_achievements SET claimed=1 WHERE id=? AND telegram_id=?': ('player_achievements', 1),
+    'DELETE FROM player_businesses WHERE telegram_id=?': ('player_businesses', 0),
+    'INSERT INTO player_businesses (telegram_id, business_id, level) VALUES (?, ?, ?)': ('player_businesses', 0),
+    'UPDATE player_businesses SET has_manager = 1 WHERE id = ? AND telegram_id = ?': ('player_businesses', 1),
+    'UPDATE player_businesses SET level = level + ? WHERE id = ? AND telegram_id = ?': ('player_businesses', 2),
+    'DELETE FROM player_character WHERE telegram_id=?': ('player_character', 0),
+    'INSERT INTO player_character (telegram_id) VALUES (?)': ('player_character', 0),
+    'UPDATE player_character SET car=? WHERE telegram_id=?': ('player_character', 1),
+    'UPDATE player_character SET hat=? WHERE telegram_id=?': ('player_character', 1),
+    'UPDATE player_character SET nickname=? WHERE telegram_id=?': ('player_character', 1),
+    'DELETE FROM player_income_profile WHERE telegram_id=?': ('player_income_profile', 0),
+    'INSERT INTO player_income_profile (telegram_id, gang_id, territory_bonus, updated_at) VALUES (?, ?, ?, ?)': ('player_income_profile', 0),
+    'DELETE FROM player_inventory WHERE telegram_id=?': ('player_inventory', 0),
+    'DELETE FROM player_inventory WHERE telegram_id=? AND item_id=?': ('player_inventory', 0),
+    'INSERT INTO player_inventory (telegram_id, item_id) VALUES (?, ?)': ('player_inventory', 0),
+    'INSERT OR IGNORE INTO player_inventory (telegram_id, item_id) VALUES (?,?)': ('player_inventory', 0),
+    'UPDATE player_inventory SET equipped=0 WHERE id=? AND telegram_id=?': ('player_inventory', 1),
+    'UPDATE player_inventory SET equipped=1 WHERE telegram_id=? AND item_id=?': ('player_inventory', 0),
+    'DELETE FROM player_talents WHERE telegram_id=?': ('player_talents', 0),
+    'INSERT INTO player_talents (telegram_id, talent_id, level) VALUES (?,?,1) ON CONFLICT(telegram_id, talent_id) DO UPDATE SET level=level+1': ('player_talents', 0),
+    'DELETE FROM player_upgrades WHERE telegram_id=?': ('player_upgrades', 0),
+    'INSERT INTO player_upgrades (telegram_id, upgrade_id, level) VALUES (?,?,1)': ('player_upgrades', 0),
+    'UPDATE player_upgrades SET level=? WHERE id=? AND telegram_id=?': ('player_upgrades', 2),
+    'DELETE FROM players WHERE telegram_id=?': ('players', 0),
+    'INSERT INTO players (telegram_id, username, last_collect_ts, referral_code) VALUES (?, ?, ?, ?)': ('players', 0),
+    'UPDATE players SET cash = cash + ? WHERE telegram_id = ?': ('players', 1),
+    'UPDATE players SET cash = cash + ?, casino_plays = casino_plays + 1, casino_wins = casino_wins + ? WHERE telegram_id = ?': ('players', 2),
+    'UPDATE players SET cash = cash + ?, casino_plays = casino_plays + ?, casino_wins = casino_wins + ? WHERE telegram_id = ?': ('players', 3),
+    'UPDATE players SET cash = cash + ?, referred_by = ? WHERE telegram_id = ?': ('players', 2),
+    'UPDATE players SET cash = cash + ?, suspicion = ?, last_collect_ts = ?, total_earned = total_earned + ? WHERE telegram_id = ? AND last_collect_ts = ?': ('players', 4),
+    'UPDATE players SET cash = cash - ? WHERE telegram_id = ?': ('players', 1),
+    'UPDATE players SET cash = cash - ?, reputation_fear = reputation_fear + ? WHERE telegram_id = ?': ('players', 2),
+    'UPDATE players SET cash = cash - ?, reputation_respect = reputation_respect + ? WHERE telegram_id = ?': ('players', 2),
+    'UPDATE players SET cash=?, suspicion=0, reputation_fear=?, reputation_respect=0, total_earned=0, total_robberies=0, robbery_cooldown_ts=0, pvp_cooldown_ts=0, prestige_level=?, prestige_multiplier=?, talent_points=talent_points+1 WHERE telegram_id=?': ('players', 4),
+    'UPDATE players SET cash=MAX(0, cash-?) WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash+? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash+?, bosses_killed=bosses_killed+1 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash+?, pvp_wins=pvp_wins+1 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash+?, suspicion=?, robbery_cooldown_ts=?, reputation_fear=reputation_fear+2, total_robberies=total_robberies+1 WHERE telegram_id=?': ('players', 3),
+    'UPDATE players SET cash=cash+?, tournament_top10=tournament_top10+?, tournament_top3=tournament_top3+? WHERE telegram_id=?': ('players', 3),
+    'UPDATE players SET cash=cash-? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+3, reputation_fear=reputation_fear+3 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+5 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash-?, reputation_respect=reputation_respect+5, reputation_fear=reputation_fear+5 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash-?, suspicion=0 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET cash=cash-?, suspicion=?, bribe_cooldown_ts=? WHERE telegram_id=?': ('players', 3),
+    'UPDATE players SET gang_id=0 WHERE telegram_id=?': ('players', 0),
+    'UPDATE players SET gang_id=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET gang_id=?, cash=cash-? WHERE telegram_id=?': ('players', 2),
+    'UPDATE players SET is_vip=0 WHERE telegram_id=? AND is_vip=1 AND vip_until <= ?': ('players', 0),
+    'UPDATE players SET is_vip=1, vip_until=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET last_ad_ts=?, ad_boost_until=? WHERE telegram_id=?': ('players', 2),
+    'UPDATE players SET last_ad_ts=?, cash=cash+1000 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET last_ad_ts=?, robbery_cooldown_ts=0 WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET last_boss_attack_ts=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET last_vip_case_claim=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET last_vip_skin_claim=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET notifications_enabled=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET pvp_cooldown_ts=? WHERE telegram_id=?': ('players', 1),
+    'UPDATE players SET talent_points = prestige_level WHERE prestige_level > 0 AND talent_points = 0': ('players', None),
+    'UPDATE players SET talent_points=talent_points-1 WHERE telegram_id=?': ('players', 0),
+}
+
+
+def _render(node):
+    """Renderings of a str literal, f-string or concatenation of them; None for anything else."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _render(node.left), _render(node.right)
+        if left is None or right is None:
+            return None
+        return [a + b for a, b in itertools.product(left, right)]
+    if isinstance(node, ast.JoinedStr):
+        exprs = sorted({ast.unparse(v.value) for v in node.values if isinstance(v, ast.FormattedValue)})
+        missing = [e for e in exprs if e not in RENDERINGS]
+        if missing:
+            raise AssertionError(f"No RENDERINGS entry for {missing} in {ast.unparse(node)}")
+        out = []
+        for combo in itertools.product(*(RENDERINGS[e] for e in exprs)):
+            values = dict(zip(exprs, combo))
+            out.append("".join(
+                v.value if isinstance(v, ast.Constant) else str(values[ast.unparse(v.value)])
+                for v in node.values
+            ))
+        return out
+    return None
+
+
+def _collect(node, path, found):
+    try:
+        rendered = _render(node)
+    except AssertionError:
+        if isinstance(node, ast.JoinedStr) and any(
+            isinstance(v, ast.Constant) and _WRITE_SQL_RE.match(v.value) for v in node.values[:1]
+        ):
+            raise
+        rendered = None
+    if rendered is not None:
+        for sql in rendered:
+            if _WRITE_SQL_RE.match(sql):
+                found.append((f"{path.name}:{node.lineno}", " ".join(sql.split())))
+        return
+    for child in ast.iter_child_nodes(node):
+        _collect(child, path, found)
+
+
+def write_statements():
+    """(location, whitespace-normalized SQL) for every write statement literal in the sources."""
+    found = []
+    for path in SOURCES:
+        _collect(ast.parse(path.read_text(encoding="utf-8")), path, found)
+    return found
+
+
+def test_every_write_statement_is_attributed_as_expected():
+    seen = set()
+    for where, sql in write_statements():
+        result = _analyze_write(sql)
+        if result is None:
+            assert sql not in EXPECTED, f"{where}: expected {EXPECTED[sql]}, not analyzed: {sql}"
+            continue
+        assert sql in EXPECTED, f"{where}: new write on a cached table, add it to EXPECTED: {sql} -> {result}"
+        assert result == EXPECTED[sql], f"{where}: {sql}"
+        seen.add(sql)
+    assert not set(EXPECTED) - seen, f"EXPECTED has statements no longer in the code: {set(EXPECTED) - seen}"
+
+
+@pytest.mark.parametrize("sql", [
+    # telegram_id inside a subquery or a nested expression
+    "UPDATE players SET cash=cash+? WHERE id=(SELECT id FROM players WHERE telegram_id=?) AND telegram_id=?",
+    "UPDATE players SET cash=cash+? WHERE telegram_id IN (SELECT telegram_id FROM gang_members WHERE gang_id=?)",
+    "DELETE FROM player_inventory WHERE telegram_id IN (?,?)",
+    "UPDATE players SET cash=? WHERE telegram_id=? OR gang_id=?",
+    "UPDATE players SET cash=? WHERE (telegram_id=?)",
+    "UPDATE players SET x=1 WHERE telegram_id=? AND telegram_id=?",
+    "UPDATE players SET cash=(SELECT MAX(cash) FROM players) WHERE telegram_id=?",
+    "UPDATE players SET telegram_id=? WHERE telegram_id=?",
+    "UPDATE players SET cash=0 WHERE gang_id=?",
+    # INSERTs that don't bind telegram_id to one plain parameter
+    "INSERT INTO players (telegram_id, username) VALUES (?, ?), (?, ?)",
+    "INSERT INTO players (username, telegram_id) VALUES (lower(?), ?)",
+    "INSERT INTO players (telegram_id, username) VALUES (abs(?), ?)",
+    "INSERT INTO players (telegram_id) SELECT telegram_id FROM gang_members",
+    "INSERT INTO players (username) VALUES (?)",
+    "INSERT INTO player_talents (telegram_id, talent_id, level) VALUES (?,?,1) ON CONFLICT(id) DO UPDATE SET level=level+1",
+    "INSERT INTO player_talents (telegram_id, talent_id, level) VALUES (?,?,1) "
+    "ON CONFLICT(telegram_id, talent_id) DO UPDATE SET telegram_id=excluded.telegram_id",
+])
+def test_unrecognized_shapes_flush_the_table(sql):
+    table, index = _analyze_write(sql)
+    assert index is None
+    tx = CacheTransaction()
+    tx.record_write(sql, (1, 2, 3, 4))
+    assert table in tx.flushed and not tx.writes
+
+
+@pytest.mark.parametrize("sql, params, tid", [
+    ("UPDATE players SET cash=MAX(0, cash-?) WHERE cash>=? AND telegram_id=? RETURNING cash", (5, 5, 42), 42),
+    ("DELETE FROM player_inventory WHERE item_id=? AND telegram_id = ?", ("hat", 42), 42),
+    ("INSERT INTO player_talents (talent_id, telegram_id, level) VALUES (?, ?, 1) "
+     "ON CONFLICT(telegram_id, talent_id) DO UPDATE SET level=level+?", ("x", 42, 1), 42),
+])
+def test_strict_shapes_are_attributed_to_one_player(sql, params, tid):
+    tx = CacheTransaction()
+    tx.record_write(sql, params)
+    assert not tx.flushed and set(tx.writes) == {(tid, _analyze_write(sql)[0])}